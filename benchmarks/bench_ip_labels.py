@@ -0,0 +1,84 @@
+"""
+Memory used to aggregate a synthetic catalog by directory: nested dicts vs IpLabels
+
+    PYTHONPATH=. python benchmarks/bench_ip_labels.py [rows]
+
+The rows are allocated before measuring, so file name strings, held by both, are not
+counted.
+"""
+
+import json
+import random
+import re
+import sys
+import tracemalloc
+from collections import defaultdict
+
+from protect_with_atakama.labels import IpLabels, LabelFilter
+from protect_with_atakama.paths import PathGrouper
+
+LABEL_SETS = [
+    ["classifier.Email"],
+    ["classifier.SSN", "classifier.Phone"],
+    ["classifier.IBAN"],
+]
+
+
+def catalog(rows: int) -> list:
+    """
+    Catalog rows in 10000 directories
+    """
+    rnd = random.Random(0)
+    dirs = [f"projects/{i // 100}/{i}" for i in range(10000)]
+    return json.loads(
+        json.dumps(
+            [
+                {
+                    "containerName": "share",
+                    "fullObjectName": f"share/{rnd.choice(dirs)}/file-{i}.docx",
+                    "objectName": f"file-{i}.docx",
+                    "attribute": rnd.choice(LABEL_SETS),
+                }
+                for i in range(rows)
+            ]
+        )
+    )
+
+
+def nested_dicts(rows: list):
+    regex = re.compile(".*", re.I)
+    ip_labels = defaultdict(lambda: {"files": {}})
+    for f in rows:
+        full = f["fullObjectName"]
+        share = f["containerName"]
+        parent = (share, full[len(share) + 1 :].rpartition("/")[0])
+        labels = [l for l in f["attribute"] if regex.match(l)]
+        ip_labels[parent]["files"][f["objectName"]] = {"labels": labels}
+    return ip_labels
+
+
+def ip_labels(rows: list):
+    label_filter = LabelFilter(re.compile(".*", re.I))
+    paths = PathGrouper()
+    result = IpLabels()
+    for f in rows:
+        parent = paths.key(f["containerName"], f["fullObjectName"])
+        result.add(parent, f["objectName"], label_filter(f["attribute"]))
+    return result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    rows = catalog(count)
+
+    for name, func in (("nested dicts", nested_dicts), ("IpLabels", ip_labels)):
+        tracemalloc.start()
+        result = func(rows)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print(f"{name:12} {size / count:8.1f} bytes/file")
+        del result
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Label filtering of a synthetic catalog: per-row regex matching vs LabelFilter
+
+    PYTHONPATH=. python benchmarks/bench_labels.py [rows]
+"""
+
+import json
+import random
+import re
+import sys
+import time
+
+from protect_with_atakama.labels import LabelFilter
+
+CLASSIFIERS = ["Email", "SSN", "Credit Card", "Phone", "Address", "Name", "DOB", "IBAN"]
+VOCABULARY = [f"classifier.{c}.{i}" for i in range(5) for c in CLASSIFIERS]
+FILTERS = [r"classifier\.(SSN|Credit Card)\..*", ".*(ssn|credit|iban).*"]
+
+
+def catalog(rows: int) -> list:
+    """
+    Label lists of `rows` catalog rows, using 200 distinct label sets
+    """
+    rnd = random.Random(0)
+    label_sets = [rnd.sample(VOCABULARY, rnd.randint(1, 4)) for _ in range(200)]
+    # decoded from json, so that every row has its own label strings, as from BigID
+    return json.loads(json.dumps([rnd.choice(label_sets) for _ in range(rows)]))
+
+
+def per_row(rows: list, regex) -> int:
+    kept = 0
+    for labels in rows:
+        if [l for l in labels if regex.match(l)]:
+            kept += 1
+    return kept
+
+
+def memoized(rows: list, regex) -> int:
+    label_filter = LabelFilter(regex)
+    kept = 0
+    for labels in rows:
+        if label_filter(labels):
+            kept += 1
+    return kept
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    rows = catalog(count)
+
+    for pattern in FILTERS:
+        regex = re.compile(pattern, re.I)
+        print(f"filter: {pattern}")
+        results = {}
+        for name, func in (("per row", per_row), ("LabelFilter", memoized)):
+            start = time.perf_counter()
+            results[name] = func(rows, regex)
+            elapsed = time.perf_counter() - start
+            print(f"  {name:12} {count / elapsed:12,.0f} rows/sec")
+        assert len(set(results.values())) == 1
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Per-row debug logging of a synthetic catalog: a synchronous file handler vs the
+queue handler, with and without LogSampler
+
+    PYTHONPATH=. python benchmarks/bench_logging.py [rows]
+
+Times the row loop on the calling thread, and the total including draining the queue.
+"""
+
+import logging
+import os
+import queue
+import sys
+import time
+from logging.handlers import RotatingFileHandler
+from tempfile import TemporaryDirectory
+
+from protect_with_atakama.utils import (
+    LOG_QUEUE_SIZE,
+    BlockingQueueHandler,
+    BlockingQueueListener,
+    LogSampler,
+)
+
+FORMAT = "%(asctime)s.%(msecs)03d %(levelname)-8s %(process)d:%(thread)d [%(filename)s:%(lineno)d] %(message)s"
+
+
+def catalog(rows: int) -> list:
+    return [
+        {
+            "attribute": ["classifier.Email", "classifier.SSN"],
+            "objectName": f"file-{i}.txt",
+            "fullObjectName": f"share/dir-{i % 1000}/file-{i}.txt",
+            "containerName": "share",
+        }
+        for i in range(rows)
+    ]
+
+
+def per_row(log: logging.Logger, rows: list) -> None:
+    for f in rows:
+        log.debug("processing: %s", f)
+
+
+def sampled(log: logging.Logger, rows: list) -> None:
+    row_log = LogSampler(log, logging.DEBUG)
+    for f in rows:
+        row_log.log("processing: %s", f)
+
+
+def file_handler(log_dir: str) -> logging.Handler:
+    handler = RotatingFileHandler(
+        os.path.join(log_dir, "log.txt"),
+        maxBytes=5000000,
+        backupCount=5,
+        encoding="utf-8",
+    )
+    handler.setFormatter(logging.Formatter(FORMAT, datefmt="%Y%m%d.%H%M%S"))
+    return handler
+
+
+def run(name: str, loop, rows: list, queued: bool) -> None:
+    log = logging.getLogger(f"bench.{name}")
+    log.propagate = False
+    log.setLevel(logging.DEBUG)
+    with TemporaryDirectory() as log_dir:
+        handler = file_handler(log_dir)
+        listener = None
+        if queued:
+            records: queue.Queue = queue.Queue(LOG_QUEUE_SIZE)
+            listener = BlockingQueueListener(records, handler)
+            listener.start()
+            log.addHandler(BlockingQueueHandler(records))
+        else:
+            log.addHandler(handler)
+
+        start = time.perf_counter()
+        loop(log, rows)
+        looped = time.perf_counter() - start
+        if listener:
+            listener.stop()
+        total = time.perf_counter() - start
+        handler.close()
+
+    count = len(rows)
+    print(
+        f"  {name:16} loop {count / looped:12,.0f} rows/sec"
+        f"   total {count / total:12,.0f} rows/sec"
+    )
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    rows = catalog(count)
+
+    print(f"rows: {count}")
+    run("file", per_row, rows, queued=False)
+    run("queue", per_row, rows, queued=True)
+    run("queue, sampled", sampled, rows, queued=True)
+
+
+if __name__ == "__main__":
+    main()
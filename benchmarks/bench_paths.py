@@ -0,0 +1,59 @@
+"""
+Grouping of a synthetic catalog by directory: pathlib vs PathGrouper
+
+    PYTHONPATH=. python benchmarks/bench_paths.py [rows]
+"""
+
+import json
+import random
+import sys
+import time
+
+from protect_with_atakama.paths import PathGrouper, parent_key
+
+PATH_FILTER = "share/projects"
+
+
+def catalog(rows: int) -> list:
+    """
+    (share, full path) of `rows` catalog rows, in 2000 directories
+    """
+    rnd = random.Random(0)
+    dirs = [
+        "/".join(
+            rnd.choice(["projects", "hr", "finance", "2023", "q1", "archive"])
+            for _ in range(rnd.randint(1, 5))
+        )
+        for _ in range(2000)
+    ]
+    return json.loads(
+        json.dumps(
+            [("share", f"share/{rnd.choice(dirs)}/file-{i}.docx") for i in range(rows)]
+        )
+    )
+
+
+def with_pathlib(rows: list) -> int:
+    return sum(1 for share, full in rows if parent_key(share, full, PATH_FILTER))
+
+
+def with_grouper(rows: list) -> int:
+    paths = PathGrouper(PATH_FILTER)
+    return sum(1 for share, full in rows if paths.key(share, full))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    rows = catalog(count)
+
+    results = {}
+    for name, func in (("pathlib", with_pathlib), ("PathGrouper", with_grouper)):
+        start = time.perf_counter()
+        results[name] = func(rows)
+        elapsed = time.perf_counter() - start
+        print(f"{name:12} {count / elapsed:12,.0f} rows/sec")
+    assert len(set(results.values())) == 1
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,22 @@
 import logging
+import os
 
 import falcon
 
 from protect_with_atakama.resources import (
     ManifestResource,
     LogsResource,
+    LogLevelsResource,
     ExecuteResource,
     IconResource,
+    MetricsResource,
+    TraceResource,
+    TracesResource,
 )
 from protect_with_atakama.utils import init_logging
 
-init_logging()
+# "json" for JSON lines, indexed by execution id
+init_logging(json_lines=os.environ.get("LOG_FORMAT", "").lower() == "json")
 log = logging.getLogger(__name__)
 
 
@@ -19,8 +25,12 @@ def get_app() -> falcon.App:
     atakama = falcon.App()
     atakama.add_route("/manifest", ManifestResource())
     atakama.add_route("/logs", LogsResource())
+    atakama.add_route("/logs/levels", LogLevelsResource())
     atakama.add_route("/execute", ExecuteResource())
     atakama.add_route("/assets/icon", IconResource())
+    atakama.add_route("/metrics", MetricsResource())
+    atakama.add_route("/traces", TracesResource())
+    atakama.add_route("/traces/{execution_id}", TraceResource())
     return atakama
 
 
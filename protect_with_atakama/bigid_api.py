@@ -1,9 +1,17 @@
+import hashlib
 import json
 import logging
+import threading
+import time
 from enum import Enum, unique
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from protect_with_atakama.metrics import BIGID_REQUEST_SECONDS, BIGID_REQUESTS
+from protect_with_atakama.tracing import span
+from protect_with_atakama.utils import TtlCache
 
 log = logging.getLogger(__name__)
 
@@ -32,8 +40,26 @@ class BigID:
         'tpaId': 'tpa-id-str'
     }
 
+    HTTP requests go through a keep-alive `requests.Session`, shared by all instances
+    that talk to the same BigID base URL.
+
+    Successful token validations and data source connection info are cached for all
+    instances, keyed by base URL and token hash / data source name.
     """
 
+    # number of hosts with pooled connections, per session
+    pool_connections: int = 4
+    # max pooled connections per host
+    pool_maxsize: int = 16
+    # if set, block when all connections to a host are in use instead of opening more
+    pool_block: bool = False
+
+    _sessions: Dict[str, requests.Session] = {}
+    _sessions_lock = threading.Lock()
+
+    _token_cache = TtlCache(maxsize=256, ttl=300.0)
+    _connection_cache = TtlCache(maxsize=4096, ttl=600.0)
+
     def __init__(self, params: Dict[str, Any]):
         self._action_name: str = params["actionName"]
         self._base_url: str = params["bigidBaseUrl"]
@@ -50,8 +76,67 @@ class BigID:
             "Content-Type": "application/json; charset=UTF-8",
             "Authorization": params["bigidToken"],
         }
+        self._session: requests.Session = self._get_session(self._base_url)
         log.info("init: %s", self._action_name)
 
+    @classmethod
+    def _get_session(cls, base_url: str) -> requests.Session:
+        with cls._sessions_lock:
+            session = cls._sessions.get(base_url)
+            if session is None:
+                log.info("new session: %s", base_url)
+                adapter = HTTPAdapter(
+                    pool_connections=cls.pool_connections,
+                    pool_maxsize=cls.pool_maxsize,
+                    pool_block=cls.pool_block,
+                )
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                cls._sessions[base_url] = session
+            return session
+
+    @classmethod
+    def close_sessions(cls) -> None:
+        """
+        Close all pooled sessions and their connections
+        """
+        with cls._sessions_lock:
+            for session in cls._sessions.values():
+                session.close()
+            cls._sessions.clear()
+
+    @classmethod
+    def clear_caches(cls) -> None:
+        cls._token_cache.clear()
+        cls._connection_cache.clear()
+
+    def validate_token(self) -> bool:
+        """
+        Check the token against BigID, unless it was validated recently
+        """
+        token = self._headers["Authorization"]
+        key = (self._base_url, hashlib.sha256(token.encode()).hexdigest())
+        if self._token_cache.get(key):
+            return True
+
+        valid = self.get("ds-connections-types").status_code == 200
+        if valid:
+            self._token_cache.set(key, True)
+        return valid
+
+    def cached_connections(self, name: str) -> Optional[List[dict]]:
+        """
+        Returns the cached ds-connections entries of a data source, if any
+        """
+        return self._connection_cache.get((self._base_url, name))
+
+    def cache_connections(self, name: str, connections: List[dict]) -> None:
+        self._connection_cache.set((self._base_url, name), connections)
+
+    def invalidate_connections(self, name: str) -> None:
+        self._connection_cache.invalidate((self._base_url, name))
+
     @property
     def global_params(self) -> Dict[str, Any]:
         return self._global_params
@@ -64,31 +149,65 @@ class BigID:
     def action_name(self) -> str:
         return self._action_name
 
-    def get(self, endpoint: str, params: Optional[Dict] = None) -> requests.Response:
+    @property
+    def execution_id(self) -> str:
+        return self._execution_id
+
+    def get(
+        self, endpoint: str, params: Optional[Dict] = None, data_source: str = ""
+    ) -> requests.Response:
         log.info("get: %s %s", endpoint, params)
-        return requests.get(
-            f"{self._base_url}{endpoint}", params=params, headers=self._headers
+        return self._request(
+            "GET",
+            endpoint,
+            f"{self._base_url}{endpoint}",
+            data_source=data_source,
+            params=params,
         )
 
     def post(self, endpoint, data) -> requests.Response:
         log.info("post: %s", endpoint)
-        return requests.post(
-            f"{self._base_url}{endpoint}", headers=self._headers, data=data
-        )
+        return self._request("POST", endpoint, f"{self._base_url}{endpoint}", data=data)
 
     def put(self, endpoint, data) -> requests.Response:
         log.info("put: %s", endpoint)
-        return requests.put(
-            f"{self._base_url}{endpoint}", headers=self._headers, data=data
-        )
-
-    def send_progress_update(self, progress: float, message: str) -> requests.Response:
-        log.info("send progress: %s %s", progress, message)
-        data = self._progress_update(Status.IN_PROGRESS, progress, message)
-        return requests.put(self._update_url, headers=self._headers, data=data)
-
-    def get_progress_completed(self) -> str:
-        return json.dumps(self._progress_update(Status.COMPLETED, 1.0, "Done"))
+        return self._request("PUT", endpoint, f"{self._base_url}{endpoint}", data=data)
+
+    def _request(
+        self, method: str, endpoint: str, url: str, data_source: str = "", **kwargs
+    ) -> requests.Response:
+        """
+        Send a request with the session, counting, timing and tracing it by endpoint
+
+        `data_source` labels the metrics of requests made for one data source, and is
+        empty for the others.
+        """
+        status = "error"
+        start = time.perf_counter()
+        try:
+            send = getattr(self._session, method.lower())
+            with span(f"bigid.{method}", sampled=True, endpoint=endpoint):
+                response = send(url, headers=self._headers, **kwargs)
+            status = str(response.status_code)
+            return response
+        finally:
+            BIGID_REQUEST_SECONDS.observe(
+                time.perf_counter() - start, data_source, method, endpoint
+            )
+            BIGID_REQUESTS.inc(data_source, method, endpoint, status)
+
+    def send_progress_update(
+        self, progress: float, message: str, status: Status = Status.IN_PROGRESS
+    ) -> requests.Response:
+        log.info("send progress: %s %s %s", status.name, progress, message)
+        data = json.dumps(self._progress_update(status, progress, message))
+        return self._request("PUT", "updateResultCallback", self._update_url, data=data)
+
+    def get_progress_started(self) -> str:
+        return json.dumps(self._progress_update(Status.IN_PROGRESS, 0.0, "Started"))
+
+    def get_progress_completed(self, message: str = "Done") -> str:
+        return json.dumps(self._progress_update(Status.COMPLETED, 1.0, message))
 
     def _progress_update(
         self, status: Status, progress: float, message: str
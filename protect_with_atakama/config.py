@@ -1,18 +1,53 @@
+import copy
+import dataclasses
+import functools
+import hashlib
 import inspect
 import json
 import logging
+import re
+import threading
+from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import List
+from typing import Generator, List, Optional, Pattern
+
+from protect_with_atakama.labels import IpLabels
+from protect_with_atakama.utils import TtlCache
 
 log = logging.getLogger(__name__)
 
 
+@functools.lru_cache(maxsize=256)
+def compile_label_filter(label_filter: str) -> Pattern:
+    return re.compile(label_filter, re.I)
+
+
 @dataclass
 class DataSourceBase:
+    """
+    Data source metadata common to all kinds of data source
+    """
+
     name: str
     kind: str
     label_filter: str
     path_filter: str
+    page_size: int
+    write_concurrency: int
+    verify_max_age: float
+    spill_rows: int
+    spill_dir: Optional[str]
+
+    @property
+    def label_regex(self) -> Pattern:
+        """
+        Compiled label filter - compiled once per distinct filter
+        """
+        return compile_label_filter(self.label_filter)
+
+    @property
+    def path_prefix(self) -> str:
+        return self.path_filter.lstrip("/")
 
     def add_api_info(self, info: dict) -> None:
         pass  # pragma: no cover
@@ -49,6 +84,8 @@ class Config:
     """
     {
         "version": 1,
+        "max_concurrent_data_sources": 1,
+        "max_data_sources_per_server": 1,
         "data_sources": [
             {
                 "name": "prod_file_share",
@@ -56,7 +93,12 @@ class Config:
                 "username": "user",
                 "password": "pass",
                 "label_filter": ".*",
-                "path_filter": ""
+                "path_filter": "",
+                "page_size": 1000,
+                "write_concurrency": 4,
+                "verify_max_age": 604800,
+                "spill_rows": 2000000,
+                "spill_dir": "/var/tmp"
             },
             ...
         ]
@@ -64,15 +106,79 @@ class Config:
     """
 
     max_warnings: int = 100
+    default_page_size: int = 1000
+    default_write_concurrency: int = 4
+    # seconds after which a directory's stored hash is checked against the share again
+    default_verify_max_age: float = 7 * 24 * 3600
+    # catalog rows grouped in memory before they are spilled to disk
+    default_spill_rows: int = IpLabels.spill_rows
+    # None for the system temp dir
+    default_spill_dir: Optional[str] = None
+    # parsed configs by sha256 of the config string
+    _cache = TtlCache(maxsize=32, ttl=3600)
 
     def __init__(self, cfg: str):
         self._warnings: List[str] = []
+        self._warnings_lock = threading.Lock()
+        self._deferred = threading.local()
         self._data_sources: List[DataSourceBase] = []
 
         cfg_dict: dict = json.loads(cfg)
         self._version: int = cfg_dict["version"]
+        self._max_concurrent_data_sources: int = max(
+            1, int(cfg_dict.get("max_concurrent_data_sources", 1))
+        )
+        self._max_data_sources_per_server: int = max(
+            1, int(cfg_dict.get("max_data_sources_per_server", 1))
+        )
         self._load_data_sources(cfg_dict)
 
+    @classmethod
+    def load(cls, cfg: str) -> "Config":
+        """
+        Parse a config string, or get it from the cache of parsed configs
+
+        Returns a copy, so that an execution can change its config and data sources
+        without affecting the cached one.
+        """
+        key = hashlib.sha256(cfg.encode("utf-8")).hexdigest()
+        parsed = cls._cache.get(key)
+        if parsed is None:
+            parsed = cls(cfg)
+            cls._cache.set(key, parsed)
+        else:
+            log.debug("config cache hit: %s", key[:12])
+        return parsed.copy()
+
+    @classmethod
+    def clear_cache(cls) -> None:
+        cls._cache.clear()
+
+    def copy(self) -> "Config":
+        """
+        Copy with its own warnings and data sources
+        """
+        return copy.copy(self)
+
+    def __copy__(self) -> "Config":
+        cfg = type(self).__new__(type(self))
+        cfg.__dict__.update(
+            self.__dict__,
+            _warnings=list(self._warnings),
+            _warnings_lock=threading.Lock(),
+            _deferred=threading.local(),
+            _data_sources=[dataclasses.replace(ds) for ds in self._data_sources],
+        )
+        return cfg
+
+    @property
+    def max_concurrent_data_sources(self) -> int:
+        return self._max_concurrent_data_sources
+
+    @property
+    def max_data_sources_per_server(self) -> int:
+        return self._max_data_sources_per_server
+
     @property
     def data_sources(self) -> List[DataSourceBase]:
         return self._data_sources
@@ -84,28 +190,80 @@ class Config:
     def warn(self, warning: str) -> None:
         caller = inspect.currentframe().f_back.f_code
         log.warning("%s:%s %s", caller.co_name, caller.co_firstlineno, warning)
-        if len(self._warnings) < self.max_warnings:
-            self._warnings.append(warning)
-        if len(self._warnings) == self.max_warnings:
-            error_limit = f"error limit reached: {self.max_warnings}"
-            self._warnings.append(error_limit)
-            log.warning(error_limit)
+        deferred = getattr(self._deferred, "warnings", None)
+        if deferred is not None:
+            # room for the warning that add_warnings replaces with the limit
+            if len(deferred) <= self.max_warnings:
+                deferred.append(warning)
+        else:
+            self.add_warnings([warning])
+
+    def add_warnings(self, warnings: List[str]) -> None:
+        """
+        Append warnings, up to max_warnings
+        """
+        with self._warnings_lock:
+            for warning in warnings:
+                if len(self._warnings) < self.max_warnings:
+                    self._warnings.append(warning)
+                if len(self._warnings) == self.max_warnings:
+                    error_limit = f"error limit reached: {self.max_warnings}"
+                    self._warnings.append(error_limit)
+                    log.warning(error_limit)
+
+    @contextmanager
+    def deferred_warnings(
+        self, warnings: Optional[List[str]] = None
+    ) -> Generator[List[str], None, None]:
+        """
+        Collect warnings issued by the current thread into a list (a new one, unless
+        given), instead of adding them to the config - the caller decides when to
+        `add_warnings`. At most max_warnings + 1 are collected.
+        """
+        self._deferred.warnings = [] if warnings is None else warnings
+        try:
+            yield self._deferred.warnings
+        finally:
+            self._deferred.warnings = None
 
     def _load_data_sources(self, cfg: dict) -> None:
         for ds in cfg["data_sources"]:
             try:
                 kind = ds["kind"]
+                page_size = int(ds.get("page_size", self.default_page_size))
+                if page_size <= 0:
+                    raise ValueError(f"invalid page_size: {page_size}")
+                write_concurrency = int(
+                    ds.get("write_concurrency", self.default_write_concurrency)
+                )
+                if write_concurrency <= 0:
+                    raise ValueError(f"invalid write_concurrency: {write_concurrency}")
+                verify_max_age = float(
+                    ds.get("verify_max_age", self.default_verify_max_age)
+                )
+                if verify_max_age < 0:
+                    raise ValueError(f"invalid verify_max_age: {verify_max_age}")
+                spill_rows = int(ds.get("spill_rows", self.default_spill_rows))
+                if spill_rows <= 0:
+                    raise ValueError(f"invalid spill_rows: {spill_rows}")
+
                 if kind == "smb":
-                    self._data_sources.append(
-                        DataSourceSmb(
-                            name=ds["name"],
-                            kind=kind,
-                            label_filter=ds.get("label_filter", ".*"),
-                            path_filter=ds.get("path_filter", ""),
-                            username=ds["username"],
-                            password=ds["password"],
-                        )
+                    data_source = DataSourceSmb(
+                        name=ds["name"],
+                        kind=kind,
+                        label_filter=ds.get("label_filter", ".*"),
+                        path_filter=ds.get("path_filter", ""),
+                        page_size=page_size,
+                        write_concurrency=write_concurrency,
+                        verify_max_age=verify_max_age,
+                        spill_rows=spill_rows,
+                        spill_dir=ds.get("spill_dir", self.default_spill_dir),
+                        username=ds["username"],
+                        password=ds["password"],
                     )
+                    # fail on an invalid label filter now, rather than per execution
+                    compile_label_filter(data_source.label_filter)
+                    self._data_sources.append(data_source)
                 else:
                     self.warn(f"unsupported data source: {self._scrub_creds(ds)}")
 
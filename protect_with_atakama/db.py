@@ -0,0 +1,39 @@
+import os
+import sqlite3
+import threading
+
+
+class ThreadConnections:
+    """
+    Per thread connections to a SQLite database in WAL mode, so that writers don't
+    block readers - a sqlite3 connection can't be shared by threads
+
+    The database's directory is created on the first connection.
+    """
+
+    def __init__(self, path: str, busy_timeout: float):
+        self._path = path
+        self._busy_timeout = busy_timeout
+        self._local = threading.local()
+
+    def get(self) -> sqlite3.Connection:
+        """
+        The connection of the current thread, connected on first use
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self._path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self._path, timeout=self._busy_timeout)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def close(self) -> None:
+        """
+        Close the connection of the current thread, if any
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
@@ -1,109 +1,424 @@
+import dataclasses
+import hashlib
 import json
 import logging
 import os
-import pathlib
-import re
-from collections import defaultdict
-from typing import Dict, Any, Generator
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from enum import Enum, unique
+from typing import (
+    Dict,
+    Callable,
+    Deque,
+    Generator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+)
 
 import falcon
 
-from protect_with_atakama.bigid_api import BigID
+from protect_with_atakama.bigid_api import BigID, Status
 from protect_with_atakama.config import DataSourceSmb, DataSourceBase, Config
-from protect_with_atakama.smb_api import Smb
-from protect_with_atakama.utils import ExecutionError
+from protect_with_atakama.labels import IpLabels, LabelFilter
+from protect_with_atakama.metrics import (
+    CATALOG_ROWS,
+    CATALOG_SCAN_SECONDS,
+    DIRECTORIES,
+    EXECUTION_SECONDS,
+)
+from protect_with_atakama.paths import PathGrouper
+from protect_with_atakama.smb_api import DirCache, Smb, smb_pool
+from protect_with_atakama.state import LabelRecord, LabelStore
+from protect_with_atakama.tracing import Trace, activate, span, submit, tracer
+from protect_with_atakama.utils import STATE_FILE, ExecutionError, LogSampler
 
 log = logging.getLogger(__name__)
 
+IP_LABELS = ".ip-labels"
+
+
+@unique
+class WriteResult(Enum):
+    WRITTEN = "written"
+    UNCHANGED = "unchanged"
+    NOT_FOUND = "not found"
+
+
+def ip_labels_payload(files: Dict[str, Tuple[str, ...]]) -> bytes:
+    """
+    Serialize the .ip-labels contents of a directory - same files, same bytes
+    """
+    return json.dumps(IpLabels.payload(files), indent=4, sort_keys=True).encode()
+
+
+def payload_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def _smb(ds: DataSourceSmb) -> Smb:
+    """
+    SMB connection to the server of a data source, from the connection pool
+    """
+    return Smb(
+        ds.username,
+        ds.password,
+        ds.server,
+        ds.domain,
+        pool=smb_pool,
+        data_source=ds.name,
+    )
+
 
 class Executor:
     """
     Encapsulates action execution
     """
 
+    # actions declared with "is_sync": false in the manifest
+    async_actions: Tuple[str, ...] = ("Encrypt",)
+    # min seconds between progress updates sent while an action runs
+    progress_interval: float = 30.0
+    # data source names per ds-connections lookup
+    ds_connections_batch: int = 50
+
     def __init__(self, params: dict):
         self._api: BigID = BigID(params)
-        self._config: Config = Config(self._api.global_params["Config"])
+        self._config: Config = Config.load(self._api.global_params["Config"])
+        self._progress = _Progress()
+        self._write_counts: Counter = Counter()
+        self._store: LabelStore = LabelStore(STATE_FILE)
+        self._run_id: str = uuid.uuid4().hex
+        self._run_started: float = time.time()
+        self._trace: Trace = Trace(self.execution_id, self._api.action_name)
+
+    @property
+    def execution_id(self) -> str:
+        return self._api.execution_id
+
+    @property
+    def is_async(self) -> bool:
+        return self._api.action_name in self.async_actions
+
+    @property
+    def full_run(self) -> bool:
+        """
+        Whether to check every directory against the share, ignoring the state store
+        """
+        value = self._api.action_params.get("Full Run", "")
+        return str(value).strip().lower() in ("true", "yes", "1")
 
     def execute(self) -> str:
         """
         Execute the action specified by input params
         """
-        self._validate_token()
+        tracer.add(self._trace)
+        with activate(self._trace, "execute"):
+            self._validate_token()
+            self._run_action()
+            return self._api.get_progress_completed(self._summary())
 
-        if self._api.action_name == "Encrypt":
-            self._write_ip_labels()
-        elif self._api.action_name == "Verify Config":
-            self._verify_config()
-        else:
-            self._config.warn(f"unrecognized action name: {self._api.action_name}")
+    def start(self) -> str:
+        """
+        Validate input params for an async action - returns IN_PROGRESS status
+
+        The action itself is then run by `execute_async`.
+        """
+        with activate(self._trace, "start"):
+            self._validate_token()
+            return self._api.get_progress_started()
+
+    def execute_async(self) -> None:
+        """
+        Execute the action, sending progress and the final status to BigID
+        """
+        self._progress.report = True
+        # kept once the job runs - a repeated request for a running job never runs
+        tracer.add(self._trace)
+        with activate(self._trace, "execute_async"):
+            try:
+                self._run_action()
+                self._send_progress(1.0, self._summary(), Status.COMPLETED)
+            except ExecutionError as e:
+                self._send_progress(1.0, e.message, Status.ERROR)
+            except Exception as e:
+                log.exception("failed to execute - %s", repr(e))
+                self._send_progress(1.0, repr(e), Status.ERROR)
 
-        if self._config.warnings:
-            text = "\n".join(self._config.warnings)
-            raise ExecutionError(falcon.HTTP_400, text)
+    def _send_progress(
+        self, progress: float, message: str, status: Status = Status.IN_PROGRESS
+    ) -> None:
+        if not self._progress.report:
+            return
+        try:
+            self._api.send_progress_update(progress, message, status)
+        except Exception as e:
+            log.warning("failed to send progress update - %s", repr(e))
 
-        return self._api.get_progress_completed()
+    def _update_progress(
+        self, ds: DataSourceBase, fraction: float, message: str, force: bool = False
+    ):
+        """
+        Record progress of one data source, and send the overall progress if due, or if
+        `force`d
+        """
+        with self._progress.lock:
+            self._progress.fractions[ds.name] = fraction
+            now = time.monotonic()
+            if (
+                not force
+                and fraction < 1.0
+                and now - self._progress.sent < self.progress_interval
+            ):
+                return
+            self._progress.sent = now
+            progress = sum(self._progress.fractions.values()) / max(
+                1, self._progress.total
+            )
+
+        self._send_progress(round(min(progress, 0.99), 2), f"{ds.name}: {message}")
+
+    def _summary(self) -> str:
+        if not self._write_counts:
+            return "Done"
+        counts = ", ".join(
+            f"{result.value}: {self._write_counts[result]}" for result in WriteResult
+        )
+        return f"Done - directories {counts}"
+
+    def _run_action(self) -> None:
+        outcome = "error"
+        start = time.perf_counter()
+        try:
+            if self._api.action_name == "Encrypt":
+                self._write_ip_labels()
+            elif self._api.action_name == "Verify Config":
+                self._verify_config()
+            else:
+                self._config.warn(f"unrecognized action name: {self._api.action_name}")
+
+            if self._config.warnings:
+                text = "\n".join(self._config.warnings)
+                raise ExecutionError(falcon.HTTP_400, text)
+            outcome = "ok"
+        finally:
+            elapsed = time.perf_counter() - start
+            log.info(
+                "finished %s: %s",
+                self._api.action_name,
+                outcome,
+                extra={"duration": round(elapsed, 3)},
+            )
+            action = self._api.action_name
+            if action not in ("Encrypt", "Verify Config"):
+                action = "other"
+            EXECUTION_SECONDS.observe(elapsed, action, outcome)
 
     def _validate_token(self):
-        resp = self._api.get("ds-connections-types")
-        if resp.status_code != 200:
+        with span("executor.validate_token"):
+            valid = self._api.validate_token()
+        if not valid:
             raise ExecutionError(falcon.HTTP_400, "Token validation failed")
 
     def _data_sources(self) -> Generator[DataSourceBase, None, None]:
+        """
+        Configured data sources, filtered by action params
+        """
         name_filter = self._api.action_params.get("Data Source Name", "")
         label_filter = self._api.action_params.get("Label Filter", "")
-        data_source_count = 0
 
         for ds in self._config.data_sources:
-            try:
-                if name_filter and name_filter != ds.name:
-                    log.info(
-                        "filtered out data source: %s (filter=%s)", ds.name, name_filter
-                    )
-                    continue
+            if name_filter and name_filter != ds.name:
+                log.info(
+                    "filtered out data source: %s (filter=%s)", ds.name, name_filter
+                )
+                continue
 
-                if label_filter:
-                    # action param overrides global param
-                    ds.label_filter = label_filter
+            if label_filter:
+                # action param overrides global param
+                ds = dataclasses.replace(ds, label_filter=label_filter)
 
-                query = [{"field": "name", "value": ds.name, "operator": "equal"}]
-                params = {"filter": json.dumps(query)}
-                ds_data = self._api.get("ds-connections", params=params).json()["data"]
-                ds_count = ds_data["totalCount"]
-                if ds_count != 1:
-                    self._config.warn(
-                        f"unexpected count ({ds_count}) for data source: {ds.name}"
-                    )
-                    continue
+            yield ds
 
-                ds_info = ds_data["ds_connections"][0]
-                ds_type = ds_info["type"]
-                if ds_type != ds.kind:
-                    self._config.warn(
-                        f"unexpected type ({ds_type}) for data source: {ds.name}"
-                    )
-                    continue
+    def _fetch_data_source_info(self, names: List[str]) -> Dict[str, List[dict]]:
+        """
+        Fetch BigID connection info of all named data sources - returns name -> infos
 
-                ds.add_api_info(ds_info)
-                data_source_count += 1
-                yield ds
+        Names are looked up `ds_connections_batch` at a time with an "in" filter, and
+        each lookup is paged. Names found in the BigID connection cache are not looked up.
+        """
+        with span("executor.fetch_data_source_info", data_sources=len(names)):
+            index: Dict[str, List[dict]] = defaultdict(list)
+            for name in names:
+                cached = self._api.cached_connections(name)
+                if cached is not None:
+                    index[name] = cached
+            names = [name for name in names if name not in index]
+            cached = len(index)
 
-            except Exception as e:
-                self._config.warn(f"error processing data source: {ds} ex: {repr(e)}")
+            batch_size = self.ds_connections_batch
+            for i in range(0, len(names), batch_size):
+                query = [
+                    {
+                        "field": "name",
+                        "value": names[i : i + batch_size],
+                        "operator": "in",
+                    }
+                ]
+                skip = 0
+                while True:
+                    params = {
+                        "filter": json.dumps(query),
+                        "skip": skip,
+                        "limit": batch_size,
+                    }
+                    ds_data = self._api.get("ds-connections", params=params).json()[
+                        "data"
+                    ]
+                    connections = ds_data.get("ds_connections", [])
+                    for info in connections:
+                        index[info["name"]].append(info)
+
+                    skip += len(connections)
+                    if len(connections) < batch_size or skip >= ds_data["totalCount"]:
+                        break
+
+            for name in names:
+                if name in index:
+                    self._api.cache_connections(name, index[name])
+
+            log.info(
+                "connection info: %s data sources cached, fetched %s of %s",
+                cached,
+                len(index) - cached,
+                len(names),
+            )
+            return index
+
+    def _resolve_data_source(
+        self, ds: DataSourceBase, index: Dict[str, List[dict]]
+    ) -> bool:
+        """
+        Add BigID connection info to a data source - returns False if not usable
+        """
+        try:
+            infos = index[ds.name]
+            if len(infos) != 1:
+                self._api.invalidate_connections(ds.name)
+                self._config.warn(
+                    f"unexpected count ({len(infos)}) for data source: {ds.name}"
+                )
+                return False
+
+            ds_info = infos[0]
+            ds_type = ds_info["type"]
+            if ds_type != ds.kind:
+                self._api.invalidate_connections(ds.name)
+                self._config.warn(
+                    f"unexpected type ({ds_type}) for data source: {ds.name}"
+                )
+                return False
+
+            ds.add_api_info(ds_info)
+            return True
+
+        except Exception as e:
+            self._api.invalidate_connections(ds.name)
+            self._config.warn(f"error processing data source: {ds} ex: {repr(e)}")
+            return False
+
+    def _process_data_sources(self, process: Callable[[DataSourceBase], None]) -> None:
+        """
+        Resolve each data source and call `process` on it - see `_run_by_server`
+
+        Warnings are merged in config order, regardless of the order in which data
+        sources complete.
+        """
+        with span("executor.data_sources"):
+            data_sources = list(self._data_sources())
+        try:
+            index = self._fetch_data_source_info([ds.name for ds in data_sources])
+        except Exception as e:
+            log.exception("failed to fetch data source info")
+            index = _FailedIndex(e)
+
+        # resolved first - the server of a data source comes from its connection info
+        warnings: List[List[str]] = [[] for _ in data_sources]
+        pending: List[Tuple[DataSourceBase, List[str]]] = []
+        for ds, ds_warnings in zip(data_sources, warnings):
+            with self._config.deferred_warnings(ds_warnings):
+                if self._resolve_data_source(ds, index):
+                    pending.append((ds, ds_warnings))
+        data_source_count = len(pending)
+        self._progress.total = len(data_sources)
+
+        def run(ds: DataSourceBase, ds_warnings: List[str]) -> None:
+            with self._config.deferred_warnings(ds_warnings), span(
+                "executor.data_source", data_source=ds.name
+            ):
+                process(ds)
+                self._update_progress(ds, 1.0, "done")
+
+        self._run_by_server(run, pending)
+
+        for ds_warnings in warnings:
+            self._config.add_warnings(ds_warnings)
 
         if data_source_count == 0:
             self._config.warn("no data sources enumerated")
 
+    def _run_by_server(
+        self,
+        run: Callable[[DataSourceBase, List[str]], None],
+        pending: List[Tuple[DataSourceBase, List[str]]],
+    ) -> None:
+        """
+        Call `run` on each (data source, warnings) in `pending`
+
+        Up to max_concurrent_data_sources are run at once, and at most
+        max_data_sources_per_server for any one server. Data sources are started in
+        order, skipping those whose server has no free slot, so that a busy server
+        doesn't hold up the others.
+        """
+        max_workers = self._config.max_concurrent_data_sources
+        per_server = self._config.max_data_sources_per_server
+        running: Dict[Future, str] = {}
+        server_counts: Counter = Counter()
+        with ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="data-source"
+        ) as workers:
+            while pending or running:
+                for item in list(pending):
+                    if len(running) >= max_workers:
+                        break
+                    server = getattr(item[0], "server", "")
+                    if server_counts[server] >= per_server:
+                        continue
+                    pending.remove(item)
+                    server_counts[server] += 1
+                    running[submit(workers, run, *item)] = server
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    server_counts[running.pop(future)] -= 1
+                    future.result()
+
     def _verify_config(self):
-        for ds in self._data_sources():
-            try:
-                if isinstance(ds, DataSourceSmb):
-                    self._verify_smb(ds)
-            except Exception as e:
-                self._config.warn(f"error verifying data source: {ds} ex: {repr(e)}")
+        self._process_data_sources(self._verify_data_source)
+
+    def _verify_data_source(self, ds: DataSourceBase):
+        try:
+            if isinstance(ds, DataSourceSmb):
+                self._verify_smb(ds)
+        except Exception as e:
+            self._config.warn(f"error verifying data source: {ds} ex: {repr(e)}")
 
     def _verify_smb(self, ds: DataSourceSmb):
-        with Smb(ds.username, ds.password, ds.server, ds.domain) as smb:
+        with _smb(ds) as smb:
             if len(ds.shares) == 1 and ds.shares[0] == "":
                 ds.shares = smb.list_shares()
 
@@ -118,76 +433,371 @@ class Executor:
                         f"failed to verify share {share} for data source {ds} - ex: {repr(ex)}"
                     )
 
-    def _get_ip_labels(self, ds: DataSourceBase) -> Dict[tuple, Any]:
-        ip_labels: Dict[tuple, Any] = defaultdict(lambda: {"files": {}})
-        ds_scan = self._api.get(f"data-catalog?filter=system={ds.name}").json()
-        log.info("scan result rows: %s", ds_scan["totalRowsCounter"])
+    def _scan_results(self, ds: DataSourceBase) -> Generator[dict, None, None]:
+        """
+        Page through the data catalog of a data source, yielding one row at a time
 
-        label_filter = re.compile(ds.label_filter, re.I)
-        path_filter = ds.path_filter.lstrip("/")
-        log.debug("filters: label=%s path=%s", label_filter.pattern, path_filter)
-        ds_scan_results = ds_scan.get("results", [])
-        log.debug("scan result count: %s", len(ds_scan_results))
+        Only one page (ds.page_size rows) is held in memory at once. Pages are grouped
+        by directory as they arrive, but no .ip-labels is written until the last page
+        is in: catalog rows aren't ordered by directory, so any later page may add a
+        file to a directory that looks complete.
+        """
+        skip = 0
+        while True:
+            params = {
+                "filter": f"system={ds.name}",
+                "skip": skip,
+                "limit": ds.page_size,
+            }
+            ds_scan = self._api.get(
+                "data-catalog", params=params, data_source=ds.name
+            ).json()
+            total = ds_scan["totalRowsCounter"]
+            rows = ds_scan.get("results", [])
+            log.info(
+                "scan result page: skip=%s rows=%s total=%s", skip, len(rows), total
+            )
 
-        for f in ds_scan_results:
-            try:
-                log.debug("processing: %s", f)
-                labels = f.get("attribute")
-                filtered_labels = [l for l in labels if label_filter.match(l)]
-                if not filtered_labels:
-                    log.debug("filtered out file, labels=%s", labels)
-                    continue
-
-                full = pathlib.Path(f["fullObjectName"])
-                if path_filter:
-                    try:
-                        full.relative_to(path_filter)
-                    except ValueError:
-                        log.debug("filtered out file, path=%s", full)
+            yield from rows
+
+            skip += len(rows)
+            if len(rows) < ds.page_size or skip >= total:
+                break
+
+    def _get_ip_labels(self, ds: DataSourceBase) -> IpLabels:
+        with span("executor.get_ip_labels", data_source=ds.name):
+            ip_labels = IpLabels(ds.spill_rows, ds.spill_dir)
+
+            label_filter = LabelFilter(ds.label_regex)
+            path_filter = ds.path_prefix
+            paths = PathGrouper(path_filter)
+            log.debug("filters: label=%s path=%s", label_filter.pattern, path_filter)
+
+            # counted locally, and added to the metrics once the scan is done
+            rows: Counter = Counter()
+            row_log = LogSampler(log, logging.DEBUG)
+            start = time.perf_counter()
+            for f in self._scan_results(ds):
+                try:
+                    row_log.log("processing: %s", f)
+                    labels = f.get("attribute")
+                    filtered_labels = label_filter(labels)
+                    if not filtered_labels:
+                        row_log.log("filtered out file, labels=%s", labels)
+                        rows["label_filtered"] += 1
+                        continue
+
+                    full = f["fullObjectName"]
+                    parent = paths.key(f["containerName"], full)
+                    if parent is None:
+                        row_log.log("filtered out file, path=%s", full)
+                        rows["path_filtered"] += 1
                         continue
 
-                share = f["containerName"]
-                parent = (share, str(full.relative_to(share).parent).replace("\\", "/"))
-                name = f["objectName"]
-                ip_labels[parent]["files"][name] = {"labels": filtered_labels}
-            except:
-                log.exception("error processing scan result row: %s", f)
+                    ip_labels.add(parent, f["objectName"], filtered_labels)
+                    rows["kept"] += 1
+                except:
+                    log.exception("error processing scan result row: %s", f)
+                    rows["error"] += 1
 
-        log.debug("ip_labels: %s", ip_labels)
-        return ip_labels
+            self._scanned(ds, rows, row_log, time.perf_counter() - start)
+            log.debug("ip_labels: %s", ip_labels)
+            return ip_labels
+
+    @staticmethod
+    def _scanned(
+        ds: DataSourceBase, rows: Counter, row_log: LogSampler, elapsed: float
+    ) -> None:
+        """
+        Log the outcome of a data catalog scan, and add it to the metrics
+        """
+        log.info(
+            "scanned data catalog: %s",
+            dict(rows),
+            extra={"data_source": ds.name, "duration": round(elapsed, 3)},
+        )
+        CATALOG_SCAN_SECONDS.observe(elapsed, ds.name)
+        if row_log.skipped:
+            log.debug(
+                "skipped %s of %s row log records", row_log.skipped, row_log.calls
+            )
+        for outcome, count in rows.items():
+            CATALOG_ROWS.inc(ds.name, outcome, amount=count)
 
     def _write_ip_labels(self) -> None:
-        for ds in self._data_sources():
-            try:
-                ip_labels = self._get_ip_labels(ds)
+        with span("executor.write_ip_labels"):
+            self._store.prune_checkpoints()
+            self._process_data_sources(self._write_data_source_ip_labels)
+        if not self._config.warnings:
+            # finished - a re-issued execution starts over
+            self._store.clear_checkpoints(self.execution_id)
+
+    def _write_data_source_ip_labels(self, ds: DataSourceBase) -> None:
+        try:
+            if self._store.is_data_source_complete(self.execution_id, ds.name):
+                log.info("data source already done by this execution: %s", ds.name)
+                self._update_progress(ds, 1.0, "resumed - already done")
+                return
+
+            with self._get_ip_labels(ds) as ip_labels:
                 if not ip_labels:
                     log.warning("no ip-labels to write for data source: %s", ds.name)
-                    continue
-
-                ds: DataSourceSmb
-                with Smb(ds.username, ds.password, ds.server, ds.domain) as smb:
-                    for (share, path), files in ip_labels.items():
-                        try:
-                            if not smb.is_dir(share, path):
-                                log.warning(
-                                    "path not found, skipping - ds=%s share=%s path=%s",
-                                    ds.name,
-                                    share,
-                                    path,
-                                )
-                                continue
-
-                            smb.atomic_write(
-                                share,
-                                path,
-                                ".ip-labels",
-                                json.dumps(files, indent=4).encode(),
-                            )
-                        except Exception as e:
-                            self._config.warn(
-                                f"failed to write .ip-labels: ds={ds} share={share} path={path} ex={e}"
-                            )
-            except Exception as e:
-                self._config.warn(
-                    f"failed to write .ip-labels for data source: ds={ds} ex={e}"
+                elif not self._write_ds_ip_labels(ds, ip_labels):
+                    return
+
+            self._store.prune(ds.name, self._run_started)
+            self._store.complete_data_source(self.execution_id, ds.name)
+        except Exception as e:
+            self._config.warn(
+                f"failed to write .ip-labels for data source: ds={ds} ex={e}"
+            )
+
+    def _write_ds_ip_labels(self, ds: DataSourceSmb, ip_labels: IpLabels) -> bool:
+        """
+        Write .ip-labels files for one data source, up to ds.write_concurrency at once
+
+        Each directory is written by a worker thread over its own pooled connection.
+        Failures are reported in directory order once each write completes. Directories
+        whose payload matches the hash in the state store are skipped without any SMB
+        traffic, and the outcome of each write is recorded in the store. Directories
+        checkpointed by an earlier attempt of this execution are skipped.
+
+        Returns True if all directories were done.
+        """
+        with span(
+            "executor.write_ds_ip_labels",
+            data_source=ds.name,
+            directories=len(ip_labels),
+        ):
+            # fail fast if the server is unreachable - the connection returns to the pool
+            with _smb(ds):
+                pass
+
+            ctx = _WriteContext(
+                ds,
+                # hashes verified on the share too long ago are checked against it again
+                {} if self.full_run else self._store.hashes(ds.name, ds.verify_max_age),
+                DirCache(ip_labels.keys()),
+                self._store.checkpoints(self.execution_id, ds.name),
+                _StoreBatch(self._store, ds.name, self._run_id, self.execution_id),
+            )
+            pending: Deque[_PendingWrite] = deque()
+            total = len(ip_labels)
+            done = 0
+            failed = 0
+            if ctx.resumed:
+                resumed = len(ctx.resumed)
+                log.info("resuming %s: %s directories already done", ds.name, resumed)
+                self._update_progress(
+                    ds,
+                    resumed / total,
+                    f"resumed - {resumed} of {total} directories already done",
+                    force=True,
+                )
+
+            with ThreadPoolExecutor(
+                max_workers=ds.write_concurrency, thread_name_prefix="ip-labels"
+            ) as workers:
+                for (share, path), files in ip_labels.items():
+                    # labels changed since the earlier attempt are written again
+                    checkpointed = ctx.resumed.get((share, path))
+                    if checkpointed and checkpointed == payload_hash(
+                        ip_labels_payload(files)
+                    ):
+                        done += 1
+                        ctx.batch.mark_seen(share, path)
+                        continue
+
+                    future = submit(
+                        workers, self._write_dir_ip_labels, ctx, share, path, files
+                    )
+                    pending.append(_PendingWrite(share, path, len(files), future))
+                    # bound the number of queued payloads
+                    if len(pending) >= 2 * ds.write_concurrency:
+                        done += 1
+                        failed += not self._write_completed(
+                            ctx, pending.popleft(), done, total
+                        )
+
+                while pending:
+                    done += 1
+                    failed += not self._write_completed(
+                        ctx, pending.popleft(), done, total
+                    )
+
+            ctx.batch.flush()
+            return failed == 0
+
+    def _write_completed(
+        self, ctx: "_WriteContext", write: "_PendingWrite", done: int, total: int
+    ) -> bool:
+        ds, batch = ctx.ds, ctx.batch
+        succeeded = False
+        try:
+            result, digest, verified = write.future.result()
+            with self._progress.lock:
+                self._write_counts[result] += 1
+            DIRECTORIES.inc(ds.name, result.value)
+            if verified:
+                batch.record(write.share, write.path, digest, write.row_count)
+            else:
+                batch.mark_seen(write.share, write.path, digest)
+            succeeded = True
+        except Exception as e:
+            batch.mark_seen(write.share, write.path)
+            DIRECTORIES.inc(ds.name, "failed")
+            self._config.warn(
+                f"failed to write .ip-labels: ds={ds} share={write.share} path={write.path} ex={e}"
+            )
+        self._update_progress(ds, done / total, f"{done} of {total} directories")
+        return succeeded
+
+    @staticmethod
+    def _write_dir_ip_labels(
+        ctx: "_WriteContext", share: str, path: str, files: Dict[str, Tuple[str, ...]]
+    ) -> Tuple[WriteResult, str, bool]:
+        """
+        Write one .ip-labels file - returns the outcome, the hash of the payload, and
+        whether it was written or found on the share
+
+        A payload that matches the hash known to the state store is not verified on
+        the share.
+        """
+        with span(
+            "executor.write_dir", sampled=True, share=share, path=path, files=len(files)
+        ):
+            ds = ctx.ds
+            data = ip_labels_payload(files)
+            digest = payload_hash(data)
+            if digest == ctx.known.get((share, path)):
+                log.debug(
+                    "unchanged since last run, skipping - ds=%s share=%s path=%s",
+                    ds.name,
+                    share,
+                    path,
                 )
+                return WriteResult.UNCHANGED, digest, False
+
+            with _smb(ds) as smb:
+                if not ctx.dir_cache.is_dir(smb, share, path):
+                    log.warning(
+                        "path not found, skipping - ds=%s share=%s path=%s",
+                        ds.name,
+                        share,
+                        path,
+                    )
+                    return WriteResult.NOT_FOUND, digest, False
+
+                existing = smb.read_file(share, f"{path}/{IP_LABELS}")
+                if existing is not None and payload_hash(existing) == digest:
+                    log.debug(
+                        "unchanged, skipping - ds=%s share=%s path=%s",
+                        ds.name,
+                        share,
+                        path,
+                    )
+                    return WriteResult.UNCHANGED, digest, True
+
+                ops = smb.atomic_write(
+                    share, path, IP_LABELS, data, exists=existing is not None
+                )
+                log.debug("wrote %s/%s in %s ops - ds=%s", share, path, ops, ds.name)
+                return WriteResult.WRITTEN, digest, True
+
+
+class _Progress:
+    """
+    Progress of an action by data source, and when it was last sent to BigID
+    """
+
+    def __init__(self):
+        # whether progress is sent - only while running async
+        self.report = False
+        self.fractions: Dict[str, float] = {}
+        self.total = 0
+        self.sent = 0.0
+        self.lock = threading.Lock()
+
+
+class _FailedIndex(dict):
+    """
+    Stands in for the connection info index when fetching it failed - every lookup
+    raises the original error
+    """
+
+    def __init__(self, error: Exception):
+        super().__init__()
+        self._error = error
+
+    def __missing__(self, key):
+        raise self._error
+
+
+class _PendingWrite(NamedTuple):
+    share: str
+    path: str
+    row_count: int
+    future: Future
+
+
+class _WriteContext(NamedTuple):
+    """
+    State shared by the directory writes of one data source
+    """
+
+    ds: DataSourceSmb
+    # (share, path) -> payload hash recorded in the state store
+    known: Dict[Tuple[str, str], str]
+    dir_cache: DirCache
+    # (share, path) -> payload hash of directories done by an earlier attempt of this
+    # execution
+    resumed: Dict[Tuple[str, str], str]
+    batch: "_StoreBatch"
+
+
+class _StoreBatch:
+    """
+    Buffers state store updates of one data source, written `size` at a time
+
+    Each flush also checkpoints the directories done since the last one.
+    """
+
+    size: int = 500
+
+    def __init__(
+        self, store: LabelStore, data_source: str, run_id: str, execution_id: str
+    ):
+        self._store = store
+        self._data_source = data_source
+        self._run_id = run_id
+        self._execution_id = execution_id
+        self._records: List[LabelRecord] = []
+        self._seen: List[Tuple[str, str]] = []
+        # (share, path, payload hash) to checkpoint
+        self._done: List[Tuple[str, str, str]] = []
+
+    def record(self, share: str, path: str, digest: str, row_count: int) -> None:
+        self._records.append((share, path, digest, row_count))
+        self._done.append((share, path, digest))
+        self._flush_if_full()
+
+    def mark_seen(self, share: str, path: str, digest: Optional[str] = None) -> None:
+        """
+        Mark a directory as seen - and as done, if the hash of its payload is given
+        """
+        self._seen.append((share, path))
+        if digest:
+            self._done.append((share, path, digest))
+        self._flush_if_full()
+
+    def _flush_if_full(self) -> None:
+        if len(self._records) + len(self._seen) >= self.size:
+            self.flush()
+
+    def flush(self) -> None:
+        self._store.record(self._data_source, self._run_id, self._records)
+        self._store.mark_seen(self._data_source, self._run_id, self._seen)
+        self._store.checkpoint(self._execution_id, self._data_source, self._done)
+        self._records = []
+        self._seen = []
+        self._done = []
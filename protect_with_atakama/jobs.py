@@ -0,0 +1,49 @@
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Optional
+
+from protect_with_atakama.executor import Executor
+
+log = logging.getLogger(__name__)
+
+
+class JobRunner:
+    """
+    Runs async actions in the background
+
+    At most one job runs per BigID execution id - a repeated request for an execution
+    that is still running does not start another job.
+    """
+
+    max_jobs: int = 4
+
+    def __init__(self):
+        self._workers = ThreadPoolExecutor(
+            max_workers=self.max_jobs, thread_name_prefix="job"
+        )
+        self._jobs: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, executor: Executor) -> str:
+        """
+        Start `executor` in the background - returns the IN_PROGRESS status for BigID
+        """
+        started = executor.start()
+        with self._lock:
+            self._jobs = {k: v for k, v in self._jobs.items() if not v.done()}
+            if executor.execution_id in self._jobs:
+                log.info("job already running: %s", executor.execution_id)
+            else:
+                log.info("start job: %s", executor.execution_id)
+                self._jobs[executor.execution_id] = self._workers.submit(
+                    executor.execute_async
+                )
+        return started
+
+    def job(self, execution_id: str) -> Optional[Future]:
+        with self._lock:
+            return self._jobs.get(execution_id)
+
+
+job_runner = JobRunner()
@@ -0,0 +1,180 @@
+import heapq
+import itertools
+import json
+import logging
+import sys
+import tempfile
+from typing import (
+    IO,
+    Collection,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Pattern,
+    Set,
+    Tuple,
+)
+
+from protect_with_atakama.paths import DirKey
+
+log = logging.getLogger(__name__)
+
+
+class LabelFilter:
+    """
+    Filters the labels of catalog rows with a label regex
+
+    Catalogs repeat a small vocabulary of labels over many rows, so the regex runs once
+    per distinct label, and the result is memoized per distinct label tuple. Filtered
+    labels are interned, and rows with the same labels share one filtered tuple.
+    """
+
+    # memoized label tuples - the memo is reset when it grows beyond this
+    max_memo: int = 65536
+
+    def __init__(self, regex: Pattern):
+        self._regex = regex
+        self._labels: Dict[str, bool] = {}
+        self._tuples: Dict[Tuple[str, ...], Tuple[str, ...]] = {}
+
+    @property
+    def pattern(self) -> str:
+        return self._regex.pattern
+
+    def match(self, label: str) -> bool:
+        matched = self._labels.get(label)
+        if matched is None:
+            matched = self._labels[label] = bool(self._regex.match(label))
+        return matched
+
+    def __call__(self, labels: Iterable[str]) -> Tuple[str, ...]:
+        key = tuple(labels)
+        filtered = self._tuples.get(key)
+        if filtered is None:
+            filtered = tuple(sys.intern(l) for l in key if self.match(l))
+            if len(self._tuples) >= self.max_memo:
+                self._tuples.clear()
+                self._labels.clear()
+            self._tuples[key] = filtered
+        return filtered
+
+
+class IpLabels:
+    """
+    Labels of the files of a data source, grouped by directory
+
+    Holds one {file name: labels} dict per directory, where labels are the tuples
+    shared by rows with the same labels (see LabelFilter), and directory keys are the
+    tuples shared by files in the same directory (see PathGrouper). The .ip-labels
+    payload of a directory is only built when it's written, by `payload`.
+
+    About 34 bytes per file besides its name, vs. 307 for a {"labels": [...]} dict per
+    file (benchmarks/bench_ip_labels.py).
+
+    Catalogs larger than `spill_rows` are grouped externally: every `spill_rows` rows
+    are written to a temp file in `spill_dir` as a run sorted by directory, and `items`
+    merges the runs, so that only the directory keys and one directory's files are
+    kept in memory.
+    """
+
+    __slots__ = ("_dirs", "_rows", "_runs", "_spilled", "_spill_rows", "_spill_dir")
+
+    # rows held in memory before they are spilled to a sorted run on disk, by default
+    spill_rows: int = 2_000_000
+    # directories named in the repr
+    repr_dirs: int = 3
+
+    def __init__(
+        self, spill_rows: Optional[int] = None, spill_dir: Optional[str] = None
+    ):
+        self._spill_rows = self.spill_rows if spill_rows is None else spill_rows
+        # None for the system temp dir - which may be a tmpfs, i.e. memory
+        self._spill_dir = spill_dir
+        self._dirs: Dict[DirKey, Dict[str, Tuple[str, ...]]] = {}
+        self._rows = 0
+        self._runs: List[IO[str]] = []
+        self._spilled: Set[DirKey] = set()
+
+    def __enter__(self) -> "IpLabels":
+        return self
+
+    def __exit__(self, *_) -> None:
+        self.close()
+
+    def close(self) -> None:
+        for run in self._runs:
+            run.close()
+        self._runs = []
+        self._spilled = set()
+
+    def add(self, key: DirKey, name: str, labels: Tuple[str, ...]) -> None:
+        files = self._dirs.get(key)
+        if files is None:
+            files = self._dirs[key] = {}
+        files[name] = labels
+        self._rows += 1
+        if self._rows >= self._spill_rows:
+            self._spill()
+
+    def _spill(self) -> None:
+        run = tempfile.TemporaryFile("w+", encoding="utf-8", dir=self._spill_dir)
+        for key in sorted(self._dirs):
+            share, path = key
+            for name, labels in self._dirs[key].items():
+                run.write(json.dumps([share, path, name, labels]))
+                run.write("\n")
+        self._runs.append(run)
+        self._spilled.update(self._dirs)
+        log.info("spilled %s rows to run %s", self._rows, len(self._runs))
+        self._dirs = {}
+        self._rows = 0
+
+    def keys(self) -> Collection[DirKey]:
+        if not self._runs:
+            return self._dirs.keys()
+        return self._spilled.union(self._dirs)
+
+    def items(self) -> Iterator[Tuple[DirKey, Dict[str, Tuple[str, ...]]]]:
+        """
+        (directory key, files) of each directory - sorted by directory if spilled
+        """
+        if not self._runs:
+            yield from self._dirs.items()
+            return
+
+        if self._dirs:
+            self._spill()
+        for run in self._runs:
+            run.seek(0)
+        rows = heapq.merge(*(map(json.loads, run) for run in self._runs), key=_dir_of)
+        shared: Dict[Tuple[str, ...], Tuple[str, ...]] = {}
+        for key, dir_rows in itertools.groupby(rows, key=_dir_of):
+            files = {}
+            for _, _, name, labels in dir_rows:
+                labels = tuple(labels)
+                files[name] = shared.setdefault(labels, labels)
+            yield key, files
+
+    def __len__(self) -> int:
+        return len(self.keys())
+
+    def __repr__(self) -> str:
+        # a summary - the rows held in memory can be far too many to log
+        sample = list(itertools.islice(self._dirs, self.repr_dirs))
+        return (
+            f"{type(self).__name__}(dirs={len(self)}, rows={self._rows}, "
+            f"runs={len(self._runs)}, sample={sample!r})"
+        )
+
+    @staticmethod
+    def payload(files: Dict[str, Tuple[str, ...]]) -> dict:
+        """
+        .ip-labels contents of a directory
+        """
+        return {"files": {name: {"labels": labels} for name, labels in files.items()}}
+
+
+def _dir_of(row: list) -> DirKey:
+    return row[0], row[1]
@@ -0,0 +1,134 @@
+import logging
+import threading
+import time
+from typing import Dict, Optional, Set, Tuple
+
+from protect_with_atakama.db import ThreadConnections
+from protect_with_atakama.log_reader import TIMESTAMP_FORMAT
+
+# (first, last) timestamps of the records of an execution, as %Y%m%d.%H%M%S
+TimeRange = Tuple[str, str]
+
+
+class LogIndex:
+    """
+    SQLite index of the time range of the log records of each BigID execution
+
+    Lets a reader pick the log files that hold an execution's records, rather than
+    scanning all of them. Ranges are updated in memory as records are written, and
+    saved at most every `flush_interval` seconds - a new execution is saved at once.
+    Connections are per thread.
+    """
+
+    busy_timeout: float = 30.0
+    flush_interval: float = 5.0
+    # executions whose last record is older than this are deleted
+    ttl: float = 30 * 24 * 3600
+
+    def __init__(self, path: str):
+        self._db = ThreadConnections(path, self.busy_timeout)
+        self._ranges: Dict[str, TimeRange] = {}
+        self._dirty: Set[str] = set()
+        self._flushed = time.monotonic()
+        self._lock = threading.Lock()
+        cutoff = time.strftime(TIMESTAMP_FORMAT, time.localtime(time.time() - self.ttl))
+        with self._db.get() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS executions (
+                    execution_id TEXT PRIMARY KEY,
+                    first TEXT NOT NULL,
+                    last TEXT NOT NULL
+                )
+                """)
+            conn.execute("DELETE FROM executions WHERE last < ?", (cutoff,))
+
+    def add(self, execution_id: str, timestamp: str) -> None:
+        """
+        Extend the range of an execution to a record logged at `timestamp`
+        """
+        with self._lock:
+            known = self._ranges.get(execution_id) or self._load(execution_id)
+            if known is None:
+                self._ranges[execution_id] = (timestamp, timestamp)
+                self._dirty.add(execution_id)
+                self._flush()
+                return
+            first, last = known
+            updated = (min(first, timestamp), max(last, timestamp))
+            self._ranges[execution_id] = updated
+            if updated != known:
+                self._dirty.add(execution_id)
+            if self._dirty and time.monotonic() - self._flushed >= self.flush_interval:
+                self._flush()
+
+    def get(self, execution_id: str) -> Optional[TimeRange]:
+        with self._lock:
+            known = self._ranges.get(execution_id)
+        return known if known is not None else self._load(execution_id)
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush()
+
+    def close(self) -> None:
+        self.flush()
+        self._db.close()
+
+    def _load(self, execution_id: str) -> Optional[TimeRange]:
+        row = (
+            self._db.get()
+            .execute(
+                "SELECT first, last FROM executions WHERE execution_id = ?",
+                (execution_id,),
+            )
+            .fetchone()
+        )
+        return tuple(row) if row else None
+
+    def _flush(self) -> None:
+        if self._dirty:
+            with self._db.get() as conn:
+                conn.executemany(
+                    """
+                    INSERT INTO executions (execution_id, first, last)
+                    VALUES (?, ?, ?)
+                    ON CONFLICT (execution_id) DO UPDATE SET
+                        first = min(first, excluded.first),
+                        last = max(last, excluded.last)
+                    """,
+                    [(key, *self._ranges[key]) for key in self._dirty],
+                )
+            self._dirty.clear()
+        self._flushed = time.monotonic()
+
+
+class LogIndexHandler(logging.Handler):
+    """
+    Adds records with an `execution_id` to a `LogIndex` - runs on the log writer thread
+    """
+
+    def __init__(self, index: LogIndex):
+        super().__init__()
+        self.index = index
+        # records come in bursts - format each second once
+        self._second = -1
+        self._timestamp = ""
+
+    def emit(self, record: logging.LogRecord) -> None:
+        execution_id = getattr(record, "execution_id", None)
+        if not execution_id:
+            return
+        try:
+            second = int(record.created)
+            if second != self._second:
+                self._second = second
+                self._timestamp = time.strftime(
+                    TIMESTAMP_FORMAT, time.localtime(second)
+                )
+            self.index.add(execution_id, self._timestamp)
+        except Exception:  # pylint: disable=broad-except
+            self.handleError(record)
+
+    def close(self) -> None:
+        self.index.close()
+        super().close()
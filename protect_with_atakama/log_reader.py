@@ -0,0 +1,294 @@
+import codecs
+import html
+import json
+import logging
+import os
+import re
+from typing import BinaryIO, Dict, Iterable, Iterator, List, NamedTuple, Optional
+
+# timestamp and level at the start of a log record, as text or JSON - see init_logging
+LOG_RECORD = re.compile(
+    rb'(?:\{"time": ")?(\d{8}\.\d{6})\.\d{3}(?: |", "level": ")(\w+)[ "]'
+)
+TIMESTAMP_FORMAT = "%Y%m%d.%H%M%S"
+
+
+def log_files(log_dir: str) -> List[str]:
+    """
+    Paths of the files in `log_dir`, oldest first: log.txt.5, ... log.txt.1, log.txt
+    """
+
+    def age(name: str) -> int:
+        suffix = name.rpartition(".")[2]
+        return int(suffix) if suffix.isdigit() else 0
+
+    names = sorted(os.listdir(log_dir), key=lambda name: (age(name), name))
+    return [os.path.join(log_dir, name) for name in reversed(names)]
+
+
+class _LogFile(NamedTuple):
+    path: str
+    file: BinaryIO
+    # size when opened - later writes are not read
+    size: int
+
+
+def _open_files(files: List[str]) -> List[_LogFile]:
+    """
+    Open log files, listed oldest first - a file rotated away since it was listed is
+    skipped
+
+    Files are opened newest first, and a file already opened under its new name is
+    skipped, so that a rotation while opening doesn't return a file twice.
+    """
+    opened: List[_LogFile] = []
+    inodes = set()
+    for path in reversed(files):
+        try:
+            f = open(path, "rb")  # pylint: disable=consider-using-with
+        except FileNotFoundError:
+            continue
+        stat = os.fstat(f.fileno())
+        if (stat.st_dev, stat.st_ino) in inodes:
+            f.close()
+            continue
+        inodes.add((stat.st_dev, stat.st_ino))
+        opened.append(_LogFile(path, f, stat.st_size))
+    return opened[::-1]
+
+
+def _read_lines(log_file: _LogFile) -> Iterator[bytes]:
+    """
+    Lines of a log file from its start, up to its size when opened
+    """
+    log_file.file.seek(0)
+    remaining = log_file.size
+    while remaining > 0:
+        line = log_file.file.readline(remaining)
+        if not line:
+            return
+        remaining -= len(line)
+        yield line
+
+
+def _oldest_first(lines: List[bytes], count: int) -> List[bytes]:
+    """
+    The newest `count` of lines held newest first, oldest first
+    """
+    return lines[count - 1 :: -1] if count > 0 else []
+
+
+class LogReader:
+    """
+    Reads log files as a stream of html escaped chunks
+
+    Files are read oldest first, as one log. Records can be filtered by timestamp, level
+    and, for JSON records, execution id - the lines that follow the first line of a
+    text record (e.g. a traceback) belong to it. `tail` reads the files backwards from
+    the end, so its cost depends on the number of lines returned, not on the size of
+    the logs.
+
+    The files are opened by the constructor, and closed when a read ends, so that a
+    read returns the logs as they were when the reader was made, even if they are
+    rotated while streaming - a reader is read once.
+    """
+
+    # size of the chunks streamed, and of the blocks read when reading backwards
+    chunk_size: int = 64 * 1024
+
+    def __init__(
+        self,
+        files: List[str],
+        since: Optional[str] = None,
+        level: Optional[int] = None,
+        until: Optional[str] = None,
+        execution: Optional[str] = None,
+    ):
+        """
+        since: %Y%m%d.%H%M%S timestamp of the oldest record returned
+        level: lowest log level returned
+        until: %Y%m%d.%H%M%S timestamp of the newest record returned
+        execution: execution id of the JSON records returned
+        """
+        self._files = _open_files(files)
+        self._since = since.encode() if since else None
+        self._until = until.encode() if until else None
+        self._level = level
+        self._levels: Dict[bytes, int] = {}
+        self._execution = execution
+        self._execution_field = (
+            b'"execution_id": ' + json.dumps(execution, ensure_ascii=False).encode()
+            if execution is not None
+            else None
+        )
+
+    @property
+    def filtered(self) -> bool:
+        return (
+            self._since is not None
+            or self._until is not None
+            or self._level is not None
+            or self._execution is not None
+        )
+
+    def _matches(self, record: "re.Match", line: bytes) -> bool:
+        if self._since is not None and record.group(1) < self._since:
+            return False
+        if self._until is not None and record.group(1) > self._until:
+            return False
+        if self._execution_field is not None and not self._is_execution(line):
+            return False
+        if self._level is not None:
+            name = record.group(2)
+            level = self._levels.get(name)
+            if level is None:
+                level = logging.getLevelName(name.decode())
+                level = self._levels[name] = level if isinstance(level, int) else 0
+            return level >= self._level
+        return True
+
+    def _is_execution(self, line: bytes) -> bool:
+        if self._execution_field not in line:
+            return False
+        try:
+            return json.loads(line).get("execution_id") == self._execution
+        except ValueError:
+            return False
+
+    def read(self) -> Iterator[bytes]:
+        """
+        All records, oldest first
+        """
+        return self._escaped(self._lines())
+
+    def tail(self, count: int) -> Iterator[bytes]:
+        """
+        The last `count` lines of the records, oldest first
+        """
+        return self._escaped(self._tail(count))
+
+    def range(self, offset: int, length: Optional[int] = None) -> Iterator[bytes]:
+        """
+        `length` bytes of the log files from `offset`, unfiltered
+        """
+        return self._escaped(self._range(offset, length))
+
+    def close(self) -> None:
+        for log_file in self._files:
+            log_file.file.close()
+
+    def _lines(self) -> Iterator[bytes]:
+        files = self._files
+        if self._since is not None:
+            # skip the files older than the newest file that starts before `since`
+            for i in range(len(files) - 1, -1, -1):
+                first = self._first_timestamp(files[i])
+                if first is not None and first < self._since:
+                    files = files[i:]
+                    break
+
+        keep = not self.filtered
+        for i, log_file in enumerate(files):
+            if i and self._until is not None:
+                # skip the files newer than `until`
+                first = self._first_timestamp(log_file)
+                if first is not None and first > self._until:
+                    return
+            for line in _read_lines(log_file):
+                record = LOG_RECORD.match(line)
+                if record is not None:
+                    keep = self._matches(record, line)
+                if keep:
+                    yield line
+
+    @staticmethod
+    def _first_timestamp(log_file: _LogFile) -> Optional[bytes]:
+        for line in _read_lines(log_file):
+            record = LOG_RECORD.match(line)
+            if record is not None:
+                return record.group(1)
+        return None
+
+    def _tail(self, count: int) -> List[bytes]:
+        lines: List[bytes] = []  # newest first
+        continued: List[bytes] = []  # lines after the first of a record, newest first
+        for log_file in reversed(self._files):
+            for line in self._reverse_lines(log_file):
+                record = LOG_RECORD.match(line)
+                if record is None:
+                    continued.append(line)
+                    continue
+                if self._since is not None and record.group(1) < self._since:
+                    # all older records are older still
+                    return _oldest_first(lines, count)
+                if self._matches(record, line):
+                    lines.extend(continued)
+                    lines.append(line)
+                    if len(lines) >= count:
+                        return _oldest_first(lines, count)
+                continued = []
+
+        if not self.filtered:
+            lines.extend(continued)
+        return _oldest_first(lines, count)
+
+    def _reverse_lines(self, log_file: _LogFile) -> Iterator[bytes]:
+        f = log_file.file
+        pos = log_file.size
+        partial = b""
+        first = True
+        while pos > 0:
+            size = min(self.chunk_size, pos)
+            pos -= size
+            f.seek(pos)
+            lines = (f.read(size) + partial).split(b"\n")
+            partial = lines.pop(0)
+            if first and lines and not lines[-1]:
+                lines.pop()
+            first = False
+            for line in reversed(lines):
+                yield line + b"\n"
+        if not first:
+            yield partial + b"\n"
+
+    def _range(self, offset: int, length: Optional[int]) -> Iterator[bytes]:
+        for log_file in self._files:
+            if length is not None and length <= 0:
+                return
+            if offset >= log_file.size:
+                offset -= log_file.size
+                continue
+            log_file.file.seek(offset)
+            remaining = log_file.size - offset
+            offset = 0
+            if length is not None:
+                remaining = min(remaining, length)
+                length -= remaining
+            while remaining > 0:
+                data = log_file.file.read(min(self.chunk_size, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+
+    def _escaped(self, data: Iterable[bytes]) -> Iterator[bytes]:
+        """
+        Html escaped chunks of about chunk_size bytes - closes the files when done
+        """
+        try:
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            chunk: List[str] = []
+            size = 0
+            for part in data:
+                chunk.append(decoder.decode(part))
+                size += len(part)
+                if size >= self.chunk_size:
+                    yield html.escape("".join(chunk)).encode()
+                    chunk = []
+                    size = 0
+            chunk.append(decoder.decode(b"", final=True))
+            text = "".join(chunk)
+            if text:
+                yield html.escape(text).encode()
+        finally:
+            self.close()
@@ -0,0 +1,236 @@
+import abc
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Generator, List, Sequence, Tuple
+
+PREFIX = "protect_with_atakama_"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# latency buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return f"{{{pairs}}}"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric(abc.ABC):
+    """
+    A metric and its values, by label values
+    """
+
+    kind: str = ""
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        self.name = PREFIX + name
+        self.description = description
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, values: Sequence[str]) -> Tuple[str, ...]:
+        if len(values) != len(self.labels):
+            raise ValueError(
+                f"{self.name}: expected labels {self.labels}, got {values}"
+            )
+        return tuple(str(value) for value in values)
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.description}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        with self._lock:
+            lines.extend(self._samples())
+        return lines
+
+    @abc.abstractmethod
+    def _samples(self) -> List[str]:
+        """
+        Sample lines of the metric, by label values - called with the lock held
+        """
+
+
+class Counter(Metric):
+    """
+    A total that only goes up, e.g. of requests made
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, description: str, labels: Sequence[str] = ()):
+        super().__init__(name, description, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, *labels: str) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0.0)
+
+    def _samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+            for key, value in sorted(self._values.items())
+        ]
+
+
+class Histogram(Metric):
+    """
+    Counts of observed values, e.g. latencies, in cumulative buckets by upper bound
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        description: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # label values -> ([count per bucket], sum)
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], float]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        key = self._key(labels)
+        index = 0
+        while value > self.buckets[index]:
+            index += 1
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * len(self.buckets), 0.0)
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, *labels: str) -> Generator[None, None, None]:
+        """
+        Observe the duration of the block
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def count(self, *labels: str) -> int:
+        with self._lock:
+            counts, _ = self._values.get(self._key(labels), ([0], 0.0))
+            return sum(counts)
+
+    def _samples(self) -> List[str]:
+        lines = []
+        names = self.labels + ("le",)
+        for key, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(names, key + (_format_value(bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    """
+    Metrics of the app, rendered in the Prometheus text format
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"metric already registered: {metric.name}")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(
+        self, name: str, description: str, labels: Sequence[str] = ()
+    ) -> Counter:
+        return self.register(Counter(name, description, labels))
+
+    def histogram(
+        self,
+        name: str,
+        description: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self.register(Histogram(name, description, labels, buckets))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+BIGID_REQUESTS = registry.counter(
+    "bigid_requests_total",
+    "BigID API requests, by data source, endpoint and response status",
+    ("data_source", "method", "endpoint", "status"),
+)
+BIGID_REQUEST_SECONDS = registry.histogram(
+    "bigid_request_seconds",
+    "BigID API request latency",
+    ("data_source", "method", "endpoint"),
+)
+SMB_OPERATIONS = registry.counter(
+    "smb_operations_total",
+    "SMB operations, by data source and result",
+    ("data_source", "operation", "result"),
+)
+SMB_OPERATION_SECONDS = registry.histogram(
+    "smb_operation_seconds",
+    "SMB operation latency, by data source",
+    ("data_source", "operation"),
+)
+CATALOG_ROWS = registry.counter(
+    "catalog_rows_total",
+    "Data catalog rows processed, by outcome: kept, label_filtered, path_filtered, error",
+    ("data_source", "outcome"),
+)
+CATALOG_SCAN_SECONDS = registry.histogram(
+    "catalog_scan_seconds",
+    "Time to scan the data catalog of a data source",
+    ("data_source",),
+)
+DIRECTORIES = registry.counter(
+    "directories_total",
+    "Directories processed, by result: written, unchanged, not found, failed",
+    ("data_source", "result"),
+)
+EXECUTION_SECONDS = registry.histogram(
+    "execution_seconds",
+    "Duration of executions, by action and outcome",
+    ("action", "outcome"),
+    buckets=(1, 5, 10, 30, 60, 300, 600, 1800, 3600, 4 * 3600, 12 * 3600),
+)
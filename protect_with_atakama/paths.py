@@ -0,0 +1,105 @@
+import pathlib
+from typing import Dict, Optional, Tuple, Union
+
+# (share, parent directory relative to the share)
+DirKey = Tuple[str, str]
+
+_IRREGULAR = object()
+_NOT_IN_SHARE = object()
+
+
+def parent_key(share: str, full: str, path_filter: str = "") -> Optional[DirKey]:
+    """
+    Key of the directory holding `full`, or None if it's filtered out by `path_filter`
+
+    Reference implementation with pathlib, used for paths that `PathGrouper` can't
+    handle as plain strings. Raises ValueError if `full` is not in `share`.
+    """
+    path = pathlib.PurePosixPath(full)
+    if path_filter:
+        try:
+            path.relative_to(path_filter)
+        except ValueError:
+            return None
+    return share, str(path.relative_to(share).parent).replace("\\", "/")
+
+
+def _is_regular(path: str) -> bool:
+    """
+    True if pathlib would leave `path` as is: relative, and no empty or "." components
+    """
+    return (
+        bool(path)
+        and path[0] != "/"
+        and path[-1] != "/"
+        and "//" not in path
+        and path != "."
+        and not path.startswith("./")
+        and not path.endswith("/.")
+        and "/./" not in path
+    )
+
+
+class PathGrouper:
+    """
+    Groups catalog rows by directory - returns the same keys as `parent_key`
+
+    Works on plain strings, and caches the key of each directory seen, so that a row
+    costs a split of its path and a dict lookup. Irregular paths (absolute, or with
+    empty or "." components) fall back to `parent_key`.
+    """
+
+    # directories cached - the cache is reset when it grows beyond this
+    max_cache: int = 65536
+
+    def __init__(self, path_filter: str = ""):
+        self._path_filter = path_filter
+        self._filter: Optional[str] = None
+        if path_filter:
+            self._filter = str(pathlib.PurePosixPath(path_filter))
+        self._shares: Dict[str, Optional[str]] = {}
+        self._dirs: Dict[DirKey, Union[DirKey, None, object]] = {}
+
+    def key(self, share: str, full: str) -> Optional[DirKey]:
+        """
+        Key of the directory holding `full`, or None if it's filtered out
+
+        Raises ValueError if `full` is not in `share`.
+        """
+        head, _, name = full.rpartition("/")
+        if name in ("", ".") or self._filter == ".":
+            return parent_key(share, full, self._path_filter)
+
+        cached = self._dirs.get((share, head), _IRREGULAR)
+        if cached is _IRREGULAR:
+            if len(self._dirs) >= self.max_cache:
+                self._dirs.clear()
+            cached = self._dirs[(share, head)] = self._dir_key(share, head)
+
+        if (
+            cached is _IRREGULAR
+            or cached is _NOT_IN_SHARE
+            or (cached is None and full == self._filter)
+        ):
+            # pathlib has the last word on rows that are not plainly in a directory
+            return parent_key(share, full, self._path_filter)
+        return cached
+
+    def _dir_key(self, share: str, head: str) -> Union[DirKey, None, object]:
+        norm_share = self._shares.get(share, _IRREGULAR)
+        if norm_share is _IRREGULAR:
+            norm_share = str(pathlib.PurePosixPath(share))
+            if not _is_regular(norm_share):
+                norm_share = None
+            self._shares[share] = norm_share
+        if norm_share is None or not _is_regular(head):
+            return _IRREGULAR
+
+        if self._filter:
+            if head != self._filter and not head.startswith(self._filter + "/"):
+                return None
+        if head == norm_share:
+            return share, "."
+        if head.startswith(norm_share + "/"):
+            return share, head[len(norm_share) + 1 :].replace("\\", "/")
+        return _NOT_IN_SHARE
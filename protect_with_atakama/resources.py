@@ -1,18 +1,52 @@
-import html
 import logging
 import os
+from datetime import datetime
+from typing import Union
 
 import falcon
 
 from protect_with_atakama.executor import Executor
+from protect_with_atakama.jobs import job_runner
+from protect_with_atakama.log_index import TimeRange
+from protect_with_atakama.log_reader import TIMESTAMP_FORMAT, LogReader, log_files
+from protect_with_atakama import metrics
+from protect_with_atakama.static import StaticAsset
+from protect_with_atakama.tracing import tracer
 from protect_with_atakama.utils import (
     LOG_DIR,
     ExecutionError,
+    log_index,
+    log_levels,
+    set_log_levels,
 )
 
 log = logging.getLogger(__name__)
 
 
+def load_asset(path: str, content_type: str) -> Union[StaticAsset, Exception]:
+    """
+    Load a static asset - returns the error if it fails, for requests to report
+    """
+    try:
+        return StaticAsset(path, content_type)
+    except Exception as e:
+        log.exception("failed to load asset: %s - %s", path, repr(e))
+        return e
+
+
+def serve_asset(
+    asset: Union[StaticAsset, Exception], req: falcon.Request, resp: falcon.Response
+) -> None:
+    if isinstance(asset, Exception):
+        resp.status = falcon.HTTP_500
+        resp.text = repr(asset)
+        return
+    asset.serve(req, resp)
+    log.debug(
+        "return %s: status=%s len=%s", asset.path, resp.status, len(resp.data or b"")
+    )
+
+
 class ManifestResource:
     """
     Returns the app manifest
@@ -21,55 +55,136 @@ class ManifestResource:
     manifest_path: str = "protect_with_atakama/assets/manifest.json"
 
     def __init__(self):
-        self._manifest: str = ""
-
-    @property
-    def manifest(self):
-        if not self._manifest:
-            with open(self.manifest_path, "r", encoding="utf-8") as f:
-                self._manifest = f.read()
-        return self._manifest
+        self._manifest = load_asset(self.manifest_path, falcon.MEDIA_JSON)
 
-    def on_get(self, _req: falcon.Request, resp: falcon.Response):
+    def on_get(self, req: falcon.Request, resp: falcon.Response):
         """
         Handle GET request
         """
         log.debug("on_get: manifest")
-        try:
-            resp.text = self.manifest
-            log.debug("return manifest: len=%s", len(resp.text))
-        except Exception as e:
-            resp.status = falcon.HTTP_500
-            resp.text = repr(e)
-            log.exception("failed to get manifest - %s", repr(e))
+        serve_asset(self._manifest, req, resp)
 
 
 class LogsResource:
     """
-    Returns the app's logs
+    Returns the app's logs, oldest first
+
+    Query params:
+    - tail=N: the last N lines
+    - since=%Y%m%d.%H%M%S: records logged at or after this time
+    - level=WARNING: records of this level and above
+    - execution=ID: records of a BigID execution - JSON lines only
+    - offset=N, length=N: a byte range of the log files, with no other filters
     """
 
     def on_get(
-        self, _req: falcon.Request, resp: falcon.Response
+        self, req: falcon.Request, resp: falcon.Response
     ):  # pylint: disable=no-self-use
         """
         Handle GET request
         """
         log.debug("on_get: logs")
+        tail = req.get_param_as_int("tail", min_value=0)
+        offset = req.get_param_as_int("offset", min_value=0)
+        length = req.get_param_as_int("length", min_value=0)
+        since = req.get_param("since")
+        if since is not None:
+            try:
+                datetime.strptime(since, TIMESTAMP_FORMAT)
+            except ValueError:
+                raise falcon.HTTPInvalidParam(
+                    f"expected {TIMESTAMP_FORMAT}", "since"
+                ) from None
+        level = req.get_param("level")
+        if level is not None:
+            level = logging.getLevelName(level.upper())
+            if not isinstance(level, int):
+                raise falcon.HTTPInvalidParam("unknown log level", "level")
+        execution = req.get_param("execution")
+        filtered = any(p is not None for p in (tail, since, level, execution))
+        if (offset is not None or length is not None) and filtered:
+            raise falcon.HTTPBadRequest(
+                description="offset and length can't be combined with other params"
+            )
+
+        until = None
+        if execution is not None:
+            first, until = self._execution_range(execution)
+            since = max(since or first, first)
+
         try:
-            all_logs = ""
-            log_files = os.listdir(LOG_DIR)
-            log_files.sort(reverse=True)
-            for f in log_files:
-                with open(os.path.join(LOG_DIR, f), "r", encoding="utf-8") as log_file:
-                    all_logs += html.escape(log_file.read())
-            resp.text = all_logs
-            log.debug("return logs: len=%s", len(resp.text))
+            reader = LogReader(
+                log_files(LOG_DIR),
+                since=since,
+                level=level,
+                until=until,
+                execution=execution,
+            )
+            if offset is not None or length is not None:
+                resp.stream = reader.range(offset or 0, length)
+            elif tail is not None:
+                resp.stream = reader.tail(tail)
+            else:
+                resp.stream = reader.read()
+            log.debug("stream logs: %s", req.query_string)
         except Exception as e:
             resp.status = falcon.HTTP_500
             resp.text = repr(e)
             log.exception("failed to get logs - %s", repr(e))
 
+    @staticmethod
+    def _execution_range(execution: str) -> TimeRange:
+        """
+        Time range of the log records of an execution, from the log index
+        """
+        index = log_index()
+        if index is None:
+            raise falcon.HTTPBadRequest(
+                description="execution requires the JSON log format"
+            )
+        time_range = index.get(execution)
+        if time_range is None:
+            raise falcon.HTTPNotFound(description=f"no logs of: {execution}")
+        return time_range
+
+
+class LogLevelsResource:
+    """
+    Gets and sets logger levels at runtime, as {"logger.name": "LEVEL"}
+
+    "root" is the root logger, and a null level resets a logger to the level of its
+    parent. Setting levels is refused unless the LOG_LEVELS_WRITABLE environment
+    variable is "1", and only existing loggers can be set.
+    """
+
+    def on_get(
+        self, _req: falcon.Request, resp: falcon.Response
+    ):  # pylint: disable=no-self-use
+        """
+        Handle GET request
+        """
+        resp.media = log_levels()
+
+    def on_put(
+        self, req: falcon.Request, resp: falcon.Response
+    ):  # pylint: disable=no-self-use
+        """
+        Handle PUT request
+        """
+        if os.environ.get("LOG_LEVELS_WRITABLE", "") != "1":
+            raise falcon.HTTPForbidden(
+                description="setting log levels is disabled - see LOG_LEVELS_WRITABLE"
+            )
+        levels = req.get_media()
+        if not isinstance(levels, dict):
+            raise falcon.HTTPBadRequest(description="expected an object of levels")
+        try:
+            set_log_levels(levels)
+        except ValueError as e:
+            raise falcon.HTTPBadRequest(description=str(e)) from None
+        log.info("set log levels: %s", levels)
+        resp.media = log_levels()
+
 
 class IconResource:
     """
@@ -78,20 +193,62 @@ class IconResource:
 
     icon_path = "protect_with_atakama/assets/icon.svg"
 
-    def on_get(self, _req: falcon.Request, resp: falcon.Response):
+    def __init__(self):
+        self._icon = load_asset(self.icon_path, "image/svg+xml")
+
+    def on_get(self, req: falcon.Request, resp: falcon.Response):
         """
         Handle GET request
         """
         log.debug("on_get: icon")
-        try:
-            with open(self.icon_path, "rb") as f:
-                resp.data = f.read()
-                resp.content_type = "image/svg+xml"
-            log.debug("return icon: len=%s", len(resp.data))
-        except Exception as e:
-            resp.status = falcon.HTTP_500
-            resp.text = repr(e)
-            log.exception("failed to get icon - %s", repr(e))
+        serve_asset(self._icon, req, resp)
+
+
+class MetricsResource:
+    """
+    Returns the app's metrics, in the Prometheus text format
+    """
+
+    def on_get(
+        self, _req: falcon.Request, resp: falcon.Response
+    ):  # pylint: disable=no-self-use
+        """
+        Handle GET request
+        """
+        resp.content_type = metrics.CONTENT_TYPE
+        resp.text = metrics.registry.render()
+
+
+class TracesResource:
+    """
+    Returns the ids of the executions with a trace, oldest first
+    """
+
+    def on_get(
+        self, _req: falcon.Request, resp: falcon.Response
+    ):  # pylint: disable=no-self-use
+        """
+        Handle GET request
+        """
+        resp.media = {"executionIds": tracer.execution_ids()}
+
+
+class TraceResource:
+    """
+    Returns the trace of an execution, in the Chrome trace event format
+    """
+
+    def on_get(
+        self, _req: falcon.Request, resp: falcon.Response, execution_id: str
+    ):  # pylint: disable=no-self-use
+        """
+        Handle GET request
+        """
+        log.debug("on_get: trace %s", execution_id)
+        trace = tracer.get(execution_id)
+        if trace is None:
+            raise falcon.HTTPNotFound(description=f"no trace of: {execution_id}")
+        resp.media = trace.to_chrome()
 
 
 class ExecuteResource:
@@ -108,7 +265,10 @@ class ExecuteResource:
         try:
             log.debug("on_post: execute")
             executor = Executor(req.get_media())
-            resp.text = executor.execute()
+            if executor.is_async:
+                resp.text = job_runner.submit(executor)
+            else:
+                resp.text = executor.execute()
 
         except ExecutionError as e:
             resp.status = e.status
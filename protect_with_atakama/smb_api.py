@@ -1,47 +1,261 @@
+import hashlib
+import io
 import logging
 import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
 from socket import gethostname
 from tempfile import NamedTemporaryFile
+from typing import (
+    Callable,
+    ContextManager,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
 
 from smb.SMBConnection import SMBConnection
 from smb.smb_structs import OperationFailure
 
+from protect_with_atakama.metrics import SMB_OPERATION_SECONDS, SMB_OPERATIONS
+from protect_with_atakama.tracing import span
+
 log = logging.getLogger(__name__)
 
+PoolKey = Tuple[str, str, str, str]
+
+
+@contextmanager
+def metered(operation: str, data_source: str = "") -> Generator[None, None, None]:
+    """
+    Count, time and trace an SMB operation of a data source
+    """
+    result = "error"
+    start = time.perf_counter()
+    try:
+        with span(f"smb.{operation}", sampled=True):
+            yield
+        result = "ok"
+    finally:
+        SMB_OPERATION_SECONDS.observe(
+            time.perf_counter() - start, data_source, operation
+        )
+        SMB_OPERATIONS.inc(data_source, operation, result)
+
+
+class SmbPool:
+    """
+    Pool of authenticated `SMBConnection` objects
+
+    Connections are keyed by (server, domain, user, password digest). Idle connections
+    are health-checked with an SMB echo before reuse, and closed once idle for longer
+    than `idle_ttl`. At most `max_per_server` connections are open to a server at once.
+    """
+
+    max_per_server: int = 8
+    idle_ttl: float = 300.0
+    # idle connections older than this are echoed before reuse
+    check_after: float = 30.0
+    acquire_timeout: float = 60.0
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._idle: Dict[PoolKey, List[Tuple[SMBConnection, float]]] = defaultdict(list)
+        self._open: Dict[str, int] = defaultdict(int)
+
+    @staticmethod
+    def key(server: str, domain: str, user: str, password: str) -> PoolKey:
+        digest = hashlib.sha256(password.encode()).hexdigest()
+        return server, domain, user, digest
+
+    def acquire(
+        self, key: PoolKey, connect: Callable[[], SMBConnection]
+    ) -> SMBConnection:
+        """
+        Returns an idle connection for `key`, or a new one made by calling `connect`
+        """
+        server = key[0]
+        while True:
+            conn, idle_since = self._reserve(key)
+            if conn is None:
+                break
+            if time.monotonic() - idle_since < self.check_after or self._healthy(conn):
+                log.debug("reuse connection: %s", server)
+                return conn
+            self._discard(server, conn)
+
+        try:
+            log.debug("new connection: %s", server)
+            return connect()
+        except Exception:
+            with self._cond:
+                self._open[server] -= 1
+                self._cond.notify_all()
+            raise
+
+    def release(self, key: PoolKey, conn: SMBConnection, reusable: bool = True) -> None:
+        """
+        Returns a connection to the pool, or closes it if not `reusable`
+        """
+        if not reusable:
+            self._discard(key[0], conn)
+            return
+
+        with self._cond:
+            self._idle[key].append((conn, time.monotonic()))
+            self._cond.notify_all()
+
+    def clear(self) -> None:
+        """
+        Closes all idle connections
+        """
+        with self._cond:
+            idle = [
+                (key[0], conn) for key, conns in self._idle.items() for conn, _ in conns
+            ]
+            self._idle.clear()
+        for server, conn in idle:
+            self._discard(server, conn)
+
+    def _reserve(self, key: PoolKey) -> Tuple[Optional[SMBConnection], float]:
+        # pops an idle connection for key, or reserves a slot for a new one
+        server = key[0]
+        deadline = time.monotonic() + self.acquire_timeout
+        with self._cond:
+            while True:
+                self._evict_expired()
+                if self._idle[key]:
+                    return self._idle[key].pop()
+                if self._open[server] < self.max_per_server:
+                    self._open[server] += 1
+                    return None, 0.0
+                if self._evict_other(key):
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise RuntimeError(f"connection limit reached: {server}")
+                self._cond.wait(remaining)
+
+    def _evict_expired(self) -> None:
+        # caller holds the lock
+        expired = time.monotonic() - self.idle_ttl
+        for key, conns in self._idle.items():
+            while conns and conns[0][1] < expired:
+                conn, _ = conns.pop(0)
+                self._close(key[0], conn)
+
+    def _evict_other(self, key: PoolKey) -> bool:
+        # closes an idle connection to the same server held under different credentials
+        # caller holds the lock
+        for other, conns in self._idle.items():
+            if other != key and other[0] == key[0] and conns:
+                conn, _ = conns.pop(0)
+                self._close(other[0], conn)
+                return True
+        return False
+
+    def _discard(self, server: str, conn: SMBConnection) -> None:
+        with self._cond:
+            self._close(server, conn)
+            self._cond.notify_all()
+
+    def _close(self, server: str, conn: SMBConnection) -> None:
+        # caller holds the lock
+        self._open[server] -= 1
+        try:
+            conn.close()
+        except Exception as e:
+            log.debug("error closing connection: %s %r", server, e)
+
+    @staticmethod
+    def _healthy(conn: SMBConnection) -> bool:
+        try:
+            conn.echo(b"ping", timeout=5)
+            return True
+        except Exception as e:
+            log.debug("connection failed health check: %r", e)
+            return False
+
+
+smb_pool = SmbPool()
+
 
 class Smb:
     """
     Wrapper for PySMB `SMBConnection` class
+
+    If a `pool` is given, connections are taken from and returned to it instead of
+    being opened and closed by each `with` block. Operations are metered by
+    `data_source`.
     """
 
-    def __init__(self, user: str, password: str, address: str, domain: str = ""):
+    # max size of uploads sent from memory - larger ones go through a temp file
+    spill_threshold: int = 16 * 1024 * 1024
+
+    def __init__(
+        self,
+        user: str,
+        password: str,
+        address: str,
+        domain: str = "",
+        *,
+        pool: Optional[SmbPool] = None,
+        data_source: str = "",
+    ):
         self._user = user
         self._password = password
         self._address = address
         self._domain = domain
+        self._pool = pool
+        self._data_source = data_source
         self._conn = None
 
     def __enter__(self) -> "Smb":
         if self._conn is None:
-            self._conn = SMBConnection(
-                self._user,
-                self._password,
-                gethostname(),
-                self._address,
-                domain=self._domain,
-                is_direct_tcp=True,
-            )
-            if not self._conn.connect(self._address, port=445):
-                self._conn = None
-                raise RuntimeError("Failed to connect")
+            if self._pool:
+                self._conn = self._pool.acquire(self._pool_key, self._connect)
+            else:
+                self._conn = self._connect()
 
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         if self._conn:
-            self._conn.close()
+            if self._pool:
+                # protocol errors leave the connection usable, anything else may not
+                reusable = exc_type is None or issubclass(exc_type, OperationFailure)
+                self._pool.release(self._pool_key, self._conn, reusable)
+            else:
+                self._conn.close()
             self._conn = None
 
+    def _metered(self, operation: str) -> ContextManager[None]:
+        return metered(operation, self._data_source)
+
+    @property
+    def _pool_key(self) -> PoolKey:
+        return SmbPool.key(self._address, self._domain, self._user, self._password)
+
+    def _connect(self) -> SMBConnection:
+        conn = SMBConnection(
+            self._user,
+            self._password,
+            gethostname(),
+            self._address,
+            domain=self._domain,
+            is_direct_tcp=True,
+        )
+        with self._metered("connect"):
+            if not conn.connect(self._address, port=445):
+                raise RuntimeError("Failed to connect")
+        return conn
+
     @property
     def connection(self) -> SMBConnection:
         if not self._conn:
@@ -49,39 +263,174 @@ class Smb:
         return self._conn
 
     def write_file(self, share: str, path: str, data: bytes) -> int:
+        """
+        Upload `data` to `share/path`
+
+        Payloads up to `spill_threshold` bytes are streamed straight from memory - a
+        BytesIO over bytes shares the buffer rather than copying it. Larger payloads are
+        spilled to a temp file first.
+        """
+        if len(data) <= self.spill_threshold:
+            with self._metered("storeFile"):
+                return self.connection.storeFile(share, path, io.BytesIO(data))
+
         with NamedTemporaryFile() as temp_file:
             temp_file.write(data)
             temp_file.seek(0)
-            return self.connection.storeFile(share, path, temp_file)
+            with self._metered("storeFile"):
+                return self.connection.storeFile(share, path, temp_file)
+
+    def read_file(self, share: str, path: str) -> Optional[bytes]:
+        """
+        Returns the contents of a file, or None if it can't be read
+        """
+        buf = io.BytesIO()
+        try:
+            with self._metered("retrieveFile"):
+                self.connection.retrieveFile(share, path, buf)
+        except OperationFailure:
+            return None
+        return buf.getvalue()
 
     def delete_file(self, share: str, path: str) -> None:
-        self.connection.deleteFiles(share, path)
+        with self._metered("deleteFiles"):
+            self.connection.deleteFiles(share, path)
 
     def rename(self, share: str, old_path: str, new_path: str) -> None:
-        self.connection.rename(share, old_path, new_path)
+        with self._metered("rename"):
+            self.connection.rename(share, old_path, new_path)
+
+    def atomic_write(
+        self,
+        share: str,
+        parent: str,
+        file: str,
+        data: bytes,
+        exists: Optional[bool] = None,
+    ) -> int:
+        """
+        Replace `parent/file` with `data` by writing a temp file and renaming it
 
-    def atomic_write(self, share: str, parent: str, file: str, data: bytes):
+        SMB renames done by pysmb never replace the target, so an existing target is
+        deleted first. If the caller knows the target doesn't exist (`exists=False`)
+        that delete is skipped - should the rename then find a target, it is deleted
+        and the rename retried. The temp file is only cleaned up on failure.
+
+        Returns the number of SMB operations used.
+        """
         temp_path = f"{parent}/{os.urandom(16).hex()}"
         target_path = f"{parent}/{file}"
-        log.debug("atomic_write %s", target_path)
+        ops = 0
         try:
+            ops += 1
             self.write_file(share, temp_path, data)
-            self.delete_file(share, target_path)
-            self.rename(share, temp_path, target_path)
-        finally:
-            self.delete_file(share, temp_path)
+            if exists is not False:
+                ops += 1
+                self._delete_if_exists(share, target_path)
+            try:
+                ops += 1
+                self.rename(share, temp_path, target_path)
+            except OperationFailure:
+                if exists is not False:
+                    raise
+                log.debug("atomic_write target appeared: %s", target_path)
+                ops += 2
+                self._delete_if_exists(share, target_path)
+                self.rename(share, temp_path, target_path)
+        except Exception:
+            ops += 1
+            try:
+                self._delete_if_exists(share, temp_path)
+            except Exception as e:
+                log.debug("failed to clean up %s: %r", temp_path, e)
+            log.debug("atomic_write %s failed, ops=%s", target_path, ops)
+            raise
+
+        log.debug("atomic_write %s ops=%s", target_path, ops)
+        return ops
+
+    def _delete_if_exists(self, share: str, path: str) -> None:
+        try:
+            self.delete_file(share, path)
+        except OperationFailure:
+            pass
 
     def is_dir(self, share: str, path: str) -> bool:
         assert self.connection
         try:
             # raises if path not found
-            self.connection.listPath(share, path)
+            with self._metered("listPath"):
+                self.connection.listPath(share, path)
             return True
         except OperationFailure:
             return False
 
+    def list_dirs(
+        self, share: str, path: str, pattern: str = "*"
+    ) -> Optional[Set[str]]:
+        """
+        Returns the lower-cased names of subdirectories of `path` matching `pattern`, or
+        None if `path` is not found
+        """
+        try:
+            with self._metered("listPath"):
+                entries = self.connection.listPath(share, path or "/", pattern=pattern)
+        except OperationFailure:
+            return None
+        return {
+            e.filename.lower()
+            for e in entries
+            if e.isDirectory and e.filename not in (".", "..")
+        }
+
     def list_shares(self):
         assert self.connection
-        return [
-            share.name for share in self.connection.listShares() if not share.isSpecial
-        ]
+        with self._metered("listShares"):
+            shares = self.connection.listShares()
+        return [share.name for share in shares if not share.isSpecial]
+
+
+class DirCache:
+    """
+    Answers `is_dir` for a known set of directories with as few listings as possible
+
+    Each parent is listed once, and the listing answers `is_dir` for all its children.
+    A parent with only one child of interest is listed with that child's name as the
+    pattern, instead of listing all of its contents. Thread safe.
+    """
+
+    def __init__(self, dirs: Iterable[Tuple[str, str]]):
+        self._lock = threading.Lock()
+        self._siblings: Dict[Tuple[str, str], int] = defaultdict(int)
+        self._listings: Dict[Tuple[str, str, str], Optional[Set[str]]] = {}
+        self._listing_locks: Dict[Tuple[str, str, str], threading.Lock] = {}
+        for share, path in dirs:
+            parent, _ = self._split(path)
+            self._siblings[(share, parent.lower())] += 1
+
+    @staticmethod
+    def _split(path: str) -> Tuple[str, str]:
+        parent, _, name = path.strip("/").rpartition("/")
+        return parent, name
+
+    def is_dir(self, smb: Smb, share: str, path: str) -> bool:
+        parent, name = self._split(path)
+        if name in ("", "."):
+            # share root
+            return smb.is_dir(share, path)
+
+        key = (share, parent.lower())
+        pattern = name if self._siblings.get(key, 0) <= 1 else "*"
+        dirs = self._list(smb, share, parent, pattern)
+        return dirs is not None and name.lower() in dirs
+
+    def _list(
+        self, smb: Smb, share: str, parent: str, pattern: str
+    ) -> Optional[Set[str]]:
+        key = (share, parent.lower(), pattern.lower())
+        with self._lock:
+            lock = self._listing_locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in self._listings:
+                self._listings[key] = smb.list_dirs(share, parent, pattern)
+            return self._listings[key]
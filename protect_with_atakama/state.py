@@ -0,0 +1,242 @@
+import logging
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from protect_with_atakama.db import ThreadConnections
+
+log = logging.getLogger(__name__)
+
+# (share, path, hash, row count)
+LabelRecord = Tuple[str, str, str, int]
+
+
+class LabelStore:
+    """
+    SQLite store of the .ip-labels manifests written to each directory
+
+    One row per (data source, share, directory) with the payload hash, the time it was
+    written, the time it was last found on the share, the time it was last seen in a
+    catalog and the number of catalog rows it holds. Connections are per thread, and the
+    database is in WAL mode so that concurrent executions don't block readers.
+
+    Runs of a data source may overlap, so a run prunes the directories not seen since
+    it started - not those last seen by another run.
+
+    Also holds checkpoints of Encrypt runs: the directories and data sources done so
+    far by each BigID execution id, so that a re-issued execution can resume.
+    """
+
+    busy_timeout: float = 30.0
+    # checkpoints of executions older than this are deleted
+    checkpoint_ttl: float = 7 * 24 * 3600
+
+    def __init__(self, path: str):
+        self._db = ThreadConnections(path, self.busy_timeout)
+        with self._db.get() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS labels (
+                    data_source TEXT NOT NULL,
+                    share TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    hash TEXT NOT NULL,
+                    written_at REAL NOT NULL,
+                    row_count INTEGER NOT NULL,
+                    run_id TEXT NOT NULL,
+                    verified_at REAL NOT NULL DEFAULT 0,
+                    seen_at REAL NOT NULL DEFAULT 0,
+                    PRIMARY KEY (data_source, share, path)
+                )
+                """)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(labels)")}
+            # stores from before these columns - each directory is verified once, and
+            # counts as not seen
+            for column in ("verified_at", "seen_at"):
+                if column not in columns:
+                    conn.execute(
+                        f"ALTER TABLE labels ADD COLUMN {column} REAL NOT NULL DEFAULT 0"
+                    )
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS checkpoints (
+                    execution_id TEXT NOT NULL,
+                    data_source TEXT NOT NULL,
+                    share TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    hash TEXT NOT NULL DEFAULT '',
+                    PRIMARY KEY (execution_id, data_source, share, path)
+                )
+                """)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(checkpoints)")}
+            # checkpoints from before the hash column never match, so are rewritten
+            if "hash" not in columns:
+                conn.execute(
+                    "ALTER TABLE checkpoints ADD COLUMN hash TEXT NOT NULL DEFAULT ''"
+                )
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS completed_data_sources (
+                    execution_id TEXT NOT NULL,
+                    data_source TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    PRIMARY KEY (execution_id, data_source)
+                )
+                """)
+
+    def close(self) -> None:
+        self._db.close()
+
+    def hashes(
+        self, data_source: str, max_age: Optional[float] = None
+    ) -> Dict[Tuple[str, str], str]:
+        """
+        Returns {(share, path): hash} of the directories recorded for a data source -
+        only those verified on the share in the last `max_age` seconds, if given
+        """
+        verified = 0.0 if max_age is None else time.time() - max_age
+        rows = self._db.get().execute(
+            "SELECT share, path, hash FROM labels "
+            "WHERE data_source = ? AND verified_at >= ?",
+            (data_source, verified),
+        )
+        return {(share, path): digest for share, path, digest in rows}
+
+    def record(
+        self, data_source: str, run_id: str, records: Iterable[LabelRecord]
+    ) -> None:
+        """
+        Record the payloads now on the share, as verified and seen now by `run_id`
+
+        The write time of a directory only changes if its hash does.
+        """
+        now = time.time()
+        with self._db.get() as conn:
+            conn.executemany(
+                """
+                INSERT INTO labels VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (data_source, share, path) DO UPDATE SET
+                    written_at = CASE WHEN hash = excluded.hash
+                        THEN written_at ELSE excluded.written_at END,
+                    hash = excluded.hash,
+                    row_count = excluded.row_count,
+                    run_id = excluded.run_id,
+                    verified_at = excluded.verified_at,
+                    seen_at = excluded.seen_at
+                """,
+                (
+                    (data_source, share, path, digest, now, row_count, run_id, now, now)
+                    for share, path, digest, row_count in records
+                ),
+            )
+
+    def mark_seen(
+        self, data_source: str, run_id: str, dirs: Iterable[Tuple[str, str]]
+    ) -> None:
+        """
+        Mark directories as seen now in the catalog of `run_id`, without changing them
+        """
+        now = time.time()
+        with self._db.get() as conn:
+            conn.executemany(
+                "UPDATE labels SET run_id = ?, seen_at = ? "
+                "WHERE data_source = ? AND share = ? AND path = ?",
+                ((run_id, now, data_source, share, path) for share, path in dirs),
+            )
+
+    def prune(self, data_source: str, since: float) -> int:
+        """
+        Delete directories of a data source that no run has seen since `since` - the
+        start of the pruning run, which has marked all the directories it saw
+        """
+        with self._db.get() as conn:
+            cur = conn.execute(
+                "DELETE FROM labels WHERE data_source = ? AND seen_at < ?",
+                (data_source, since),
+            )
+        log.info("pruned %s directories of data source %s", cur.rowcount, data_source)
+        return cur.rowcount
+
+    def changed_since(
+        self, data_source: str, timestamp: float
+    ) -> List[Tuple[str, str, float]]:
+        """
+        Returns (share, path, written_at) of directories written after `timestamp`
+        """
+        rows = self._db.get().execute(
+            "SELECT share, path, written_at FROM labels "
+            "WHERE data_source = ? AND written_at > ? ORDER BY share, path",
+            (data_source, timestamp),
+        )
+        return list(rows)
+
+    def checkpoint(
+        self,
+        execution_id: str,
+        data_source: str,
+        dirs: Iterable[Tuple[str, str, str]],
+    ) -> None:
+        """
+        Record directories done by an execution, as (share, path, payload hash)
+        """
+        now = time.time()
+        with self._db.get() as conn:
+            conn.executemany(
+                """
+                INSERT INTO checkpoints
+                    (execution_id, data_source, share, path, created_at, hash)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (execution_id, data_source, share, path) DO UPDATE SET
+                    hash = excluded.hash
+                """,
+                (
+                    (execution_id, data_source, share, path, now, digest)
+                    for share, path, digest in dirs
+                ),
+            )
+
+    def checkpoints(
+        self, execution_id: str, data_source: str
+    ) -> Dict[Tuple[str, str], str]:
+        """
+        Returns {(share, path): hash} of the directories already done by an execution
+        """
+        rows = self._db.get().execute(
+            "SELECT share, path, hash FROM checkpoints "
+            "WHERE execution_id = ? AND data_source = ?",
+            (execution_id, data_source),
+        )
+        return {(share, path): digest for share, path, digest in rows}
+
+    def complete_data_source(self, execution_id: str, data_source: str) -> None:
+        with self._db.get() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO completed_data_sources VALUES (?, ?, ?)",
+                (execution_id, data_source, time.time()),
+            )
+
+    def is_data_source_complete(self, execution_id: str, data_source: str) -> bool:
+        row = self._db.get().execute(
+            "SELECT 1 FROM completed_data_sources "
+            "WHERE execution_id = ? AND data_source = ?",
+            (execution_id, data_source),
+        )
+        return row.fetchone() is not None
+
+    def clear_checkpoints(self, execution_id: str) -> None:
+        with self._db.get() as conn:
+            conn.execute(
+                "DELETE FROM checkpoints WHERE execution_id = ?", (execution_id,)
+            )
+            conn.execute(
+                "DELETE FROM completed_data_sources WHERE execution_id = ?",
+                (execution_id,),
+            )
+
+    def prune_checkpoints(self) -> None:
+        """
+        Delete checkpoints older than checkpoint_ttl
+        """
+        expired = time.time() - self.checkpoint_ttl
+        with self._db.get() as conn:
+            conn.execute("DELETE FROM checkpoints WHERE created_at < ?", (expired,))
+            conn.execute(
+                "DELETE FROM completed_data_sources WHERE created_at < ?", (expired,)
+            )
@@ -0,0 +1,94 @@
+import gzip
+import hashlib
+import logging
+from typing import Dict, Optional
+
+import falcon
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+log = logging.getLogger(__name__)
+
+
+class StaticAsset:
+    """
+    A file served as is, loaded once
+
+    Responses carry an ETag and Cache-Control, requests with a matching If-None-Match
+    get a 304, and the body is sent brotli or gzip compressed if the client accepts it
+    (brotli only if the brotli package is installed). Compressed variants are made when
+    the asset is loaded, and only kept if smaller.
+    """
+
+    # Cache-Control max-age, in seconds
+    max_age: int = 300
+
+    def __init__(self, path: str, content_type: str):
+        self.path = path
+        self.content_type = content_type
+        with open(path, "rb") as f:
+            self.data = f.read()
+        self.etag = hashlib.sha256(self.data).hexdigest()[:32]
+        self._variants: Dict[str, bytes] = {}
+        compressed = {"gzip": gzip.compress(self.data, mtime=0)}
+        if brotli is not None:
+            compressed["br"] = brotli.compress(self.data)
+        for encoding, data in compressed.items():
+            if len(data) < len(self.data):
+                self._variants[encoding] = data
+        log.debug(
+            "loaded %s: len=%s etag=%s variants=%s",
+            path,
+            len(self.data),
+            self.etag,
+            {k: len(v) for k, v in self._variants.items()},
+        )
+
+    def encoding(self, accept_encoding: Optional[str]) -> Optional[str]:
+        """
+        Preferred encoding the client accepts, out of those available - None for identity
+        """
+        accepted = {}
+        for item in (accept_encoding or "").split(","):
+            coding, _, params = item.strip().partition(";")
+            quality = 1.0
+            params = params.strip()
+            if params.startswith("q="):
+                try:
+                    quality = float(params[2:])
+                except ValueError:
+                    quality = 0.0
+            accepted[coding.strip().lower()] = quality
+
+        best, best_quality = None, 0.0
+        for coding in ("br", "gzip"):
+            quality = accepted.get(coding, accepted.get("*", 0.0))
+            if coding in self._variants and quality > best_quality:
+                best, best_quality = coding, quality
+        return best
+
+    def serve(self, req: falcon.Request, resp: falcon.Response) -> None:
+        """
+        Respond with the asset in the best encoding the client accepts, or with 304 if
+        the client's copy matches its entity tag
+        """
+        encoding = self.encoding(req.get_header("Accept-Encoding"))
+        # each encoding of the asset is a representation with its own entity tag
+        etag = self.etag if encoding is None else f"{self.etag}-{encoding}"
+        resp.etag = etag
+        resp.cache_control = [f"public, max-age={self.max_age}"]
+        resp.vary = ["Accept-Encoding"]
+        if_none_match = req.if_none_match or []
+        if "*" in if_none_match or etag in if_none_match:
+            resp.status = falcon.HTTP_304
+            return
+
+        resp.content_type = self.content_type
+        if encoding is None:
+            resp.data = self.data
+        else:
+            resp.data = self._variants[encoding]
+            resp.set_header("Content-Encoding", encoding)
@@ -0,0 +1,297 @@
+import contextvars
+import itertools
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Executor, Future
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Generator, List, Optional
+
+
+class Trace:
+    """
+    Spans recorded for one execution, as Chrome trace events
+
+    Timestamps are microseconds since the epoch, so traces of several executions line
+    up. Spans are recorded when they start, so enclosing spans are always kept, and
+    show as running until they end. Spans marked `sampled` - per directory, per SMB
+    operation - are kept for the first `sample_first` of each name, then every
+    `sample_every`th, and while the tracer's span budget allows. All spans are counted
+    in per-name stats, kept or not.
+    """
+
+    sample_first: int = 100
+    sample_every: int = 100
+
+    def __init__(self, execution_id: str, action: str):
+        self.execution_id = execution_id
+        self.action = action
+        self._events: List[Dict[str, Any]] = []
+        self._threads: Dict[int, str] = {}
+        # name -> [started, ended, total seconds, max seconds]
+        self._stats: Dict[str, List[float]] = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        # the tracer keeping this trace, whose span budget it uses
+        self.tracer: Optional["Tracer"] = None
+        # perf_counter is monotonic and precise - anchor it to the wall clock once
+        self._epoch_us = time.time() * 1e6 - time.perf_counter() * 1e6
+
+    def next_id(self) -> int:
+        return next(self._ids)
+
+    def __len__(self) -> int:
+        return len(self._events)
+
+    def begin(
+        self, name: str, start: float, args: Dict[str, Any], sampled: bool = False
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Record the start of a span - returns its event, or None if it isn't kept
+        """
+        thread = threading.current_thread()
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = [0, 0, 0.0, 0.0]
+            started = stats[0]
+            stats[0] += 1
+            if sampled and not self._sample(started):
+                return None
+            if self.tracer is not None and not self.tracer.reserve(
+                self, required=not sampled
+            ):
+                return None
+            event = {
+                "name": name,
+                "cat": name.partition(".")[0],
+                "ph": "X",
+                "ts": round(self._epoch_us + start * 1e6, 1),
+                "dur": None,
+                "pid": os.getpid(),
+                "tid": thread.ident,
+                "args": args,
+            }
+            self._events.append(event)
+            self._threads.setdefault(thread.ident, thread.name)
+        return event
+
+    def end(
+        self, name: str, event: Optional[Dict[str, Any]], start: float, end: float
+    ) -> None:
+        """
+        Record the end of a span started by `begin`
+        """
+        duration = end - start
+        with self._lock:
+            if event is not None:
+                event["dur"] = round(duration * 1e6, 1)
+            stats = self._stats[name]
+            stats[1] += 1
+            stats[2] += duration
+            stats[3] = max(stats[3], duration)
+
+    def _sample(self, started: int) -> bool:
+        return (
+            started < self.sample_first
+            or (started - self.sample_first + 1) % self.sample_every == 0
+        )
+
+    def to_chrome(self) -> Dict[str, Any]:
+        """
+        The trace in the Chrome trace event format - see chrome://tracing or Perfetto
+        """
+        now = round(self._epoch_us + time.perf_counter() * 1e6, 1)
+        with self._lock:
+            events = [
+                (
+                    event
+                    if event["dur"] is not None
+                    else dict(
+                        event,
+                        dur=round(now - event["ts"], 1),
+                        args=dict(event["args"], running=True),
+                    )
+                )
+                for event in self._events
+            ]
+            threads = dict(self._threads)
+            stats = {
+                name: {
+                    "count": count,
+                    "totalMs": round(total * 1e3, 3),
+                    "maxMs": round(longest * 1e3, 3),
+                }
+                for name, (_, count, total, longest) in sorted(self._stats.items())
+            }
+            dropped = sum(counts[0] for counts in self._stats.values()) - len(events)
+        metadata = [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": os.getpid(),
+                "tid": tid,
+                "args": {"name": name},
+            }
+            for tid, name in threads.items()
+        ]
+        return {
+            "traceEvents": metadata + sorted(events, key=lambda e: e["ts"]),
+            "displayTimeUnit": "ms",
+            "otherData": {
+                "executionId": self.execution_id,
+                "action": self.action,
+                "droppedSpans": dropped,
+                "spanStats": stats,
+            },
+        }
+
+
+_trace: "contextvars.ContextVar[Optional[Trace]]" = contextvars.ContextVar(
+    "trace", default=None
+)
+_parent: "contextvars.ContextVar[Optional[int]]" = contextvars.ContextVar(
+    "parent_span", default=None
+)
+# args of the enclosing spans, and the name of the innermost as "operation"
+_fields: "contextvars.ContextVar[Dict[str, Any]]" = contextvars.ContextVar(
+    "span_fields", default={}
+)
+
+
+def log_fields() -> Dict[str, Any]:
+    """
+    Execution id, operation and span args of the current span, for log records - empty
+    outside of a trace
+    """
+    trace = _trace.get()
+    if trace is None:
+        return {}
+    return dict(_fields.get(), execution_id=trace.execution_id)
+
+
+@contextmanager
+def span(name: str, sampled: bool = False, **args: Any) -> Generator[None, None, None]:
+    """
+    Record the block as a span of the current trace - a no-op outside of a trace
+
+    Spans repeated for every item of a data source should be `sampled` - see `Trace`.
+    """
+    trace = _trace.get()
+    if trace is None:
+        yield
+        return
+
+    span_id = trace.next_id()
+    parent = _parent.get()
+    start = time.perf_counter()
+    event = trace.begin(name, start, dict(args, id=span_id, parent=parent), sampled)
+    token = _parent.set(span_id)
+    fields_token = _fields.set(dict(_fields.get(), **args, operation=name))
+    try:
+        yield
+    finally:
+        _fields.reset(fields_token)
+        _parent.reset(token)
+        trace.end(name, event, start, time.perf_counter())
+
+
+def submit(workers: Executor, fn: Callable, *args: Any, **kwargs: Any) -> Future:
+    """
+    Submit `fn` to a thread pool, running in a copy of the caller's context so that
+    its spans belong to the caller's trace and span
+    """
+    context = contextvars.copy_context()
+    return workers.submit(context.run, fn, *args, **kwargs)
+
+
+@contextmanager
+def activate(trace: Trace, name: str) -> Generator[None, None, None]:
+    """
+    Make `trace` the current trace, recording the block as a top level span
+    """
+    token = _trace.set(trace)
+    try:
+        with span(name, action=trace.action):
+            yield
+    finally:
+        _trace.reset(token)
+
+
+class Tracer:
+    """
+    Keeps the traces of the last `max_traces` executions, by execution id
+
+    The kept traces share a budget of `max_spans` spans, about 600 bytes each. Once it
+    is used up the oldest traces are evicted - a trace over the budget on its own keeps
+    its spans that aren't sampled, and drops its sampled ones.
+    """
+
+    max_traces: int = 32
+    max_spans: int = 200_000
+
+    def __init__(self):
+        self._traces: "OrderedDict[str, Trace]" = OrderedDict()
+        self._spans: Dict[str, int] = {}
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def add(self, trace: Trace) -> None:
+        """
+        Keep `trace` - a re-run of an execution replaces its earlier trace
+        """
+        spans = len(trace)
+        with self._lock:
+            self._evict(trace.execution_id)
+            self._traces[trace.execution_id] = trace
+            self._spans[trace.execution_id] = spans
+            self._total += spans
+            while len(self._traces) > self.max_traces:
+                self._evict(next(iter(self._traces)))
+        trace.tracer = self
+
+    def reserve(self, trace: Trace, required: bool) -> bool:
+        """
+        Count a span of `trace` against the budget, evicting the oldest other traces if
+        it's used up - returns False if there's no room for a span that isn't
+        `required`
+        """
+        with self._lock:
+            if self._traces.get(trace.execution_id) is not trace:
+                # evicted - only its spans that aren't sampled are still recorded
+                return required
+            for execution_id in list(self._traces):
+                if self._total < self.max_spans:
+                    break
+                if execution_id != trace.execution_id:
+                    self._evict(execution_id)
+            if self._total >= self.max_spans and not required:
+                return False
+            self._spans[trace.execution_id] += 1
+            self._total += 1
+            return True
+
+    def _evict(self, execution_id: str) -> None:
+        if self._traces.pop(execution_id, None) is not None:
+            self._total -= self._spans.pop(execution_id)
+
+    def get(self, execution_id: str) -> Optional[Trace]:
+        with self._lock:
+            return self._traces.get(execution_id)
+
+    def execution_ids(self) -> List[str]:
+        """
+        Ids of the kept traces, oldest first
+        """
+        with self._lock:
+            return list(self._traces)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._traces.clear()
+            self._spans.clear()
+            self._total = 0
+
+
+tracer = Tracer()
@@ -1,18 +1,115 @@
+import atexit
+import json
 import logging
-from logging.handlers import RotatingFileHandler
+import queue
+import threading
+import time
+from collections import OrderedDict
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Any, Dict, Hashable, Optional
+
+from protect_with_atakama.log_index import LogIndex, LogIndexHandler
+from protect_with_atakama.tracing import log_fields
 
 LOG_DIR = "protect_with_atakama/logs"
 LOG_FILE = f"{LOG_DIR}/log.txt"
+STATE_DIR = "protect_with_atakama/state"
+STATE_FILE = f"{STATE_DIR}/state.sqlite"
+LOG_INDEX_FILE = f"{STATE_DIR}/log-index.sqlite"
+
+# records queued for the writer thread - callers block once it is full
+LOG_QUEUE_SIZE = 100_000
+
+_log_listener: Optional[QueueListener] = None
+_log_handler: Optional[QueueHandler] = None
+_log_index: Optional[LogIndex] = None
+
+# fields of a JSON log record, besides the standard ones - see JsonFormatter
+LOG_FIELDS = ("execution_id", "data_source", "share", "operation", "duration")
+
+
+class BlockingQueueHandler(QueueHandler):
+    """
+    Queue handler that waits for room in a bounded queue, rather than dropping the record
+    """
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        self.queue.put(record)
 
 
-def init_logging():
+class BlockingQueueListener(QueueListener):
+    """
+    Queue listener that waits for room in a bounded queue to stop
+    """
+
+    def enqueue_sentinel(self) -> None:
+        self.queue.put(self._sentinel)
+
+
+class ContextFilter(logging.Filter):
+    """
+    Adds the execution id, operation, data source and share of the current trace span to
+    records - runs on the calling thread
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        fields = log_fields()
+        for name in LOG_FIELDS:
+            if name in fields and not hasattr(record, name):
+                setattr(record, name, fields[name])
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a record as one line of JSON, starting with its time and level
+
+    A traceback is part of the message, so that each record is one line.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            "time": f"{self.formatTime(record, '%Y%m%d.%H%M%S')}.{int(record.msecs):03d}",
+            "level": record.levelname,
+            "process": record.process,
+            "thread": record.thread,
+            "file": record.filename,
+            "line": record.lineno,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["message"] += "\n" + record.exc_text
+        for name in LOG_FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                data[name] = value
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def init_logging(json_lines: bool = False):
     """
     Init File and Stream log handlers
+
+    Records are put on a queue by the calling thread, and formatted and written by a
+    dedicated writer thread. Calling it again has no effect.
+
+    With `json_lines`, records are written as JSON with the LOG_FIELDS of their trace
+    span, and the time range of the records of each execution is kept in a `LogIndex`.
     """
-    log_formatter = logging.Formatter(
+    # pylint: disable=global-statement
+    global _log_listener, _log_handler, _log_index
+    if _log_listener is not None:
+        return
+
+    log_formatter: logging.Formatter = logging.Formatter(
         fmt="%(asctime)s.%(msecs)03d %(levelname)-8s %(process)d:%(thread)d [%(filename)s:%(lineno)d] %(message)s",
         datefmt="%Y%m%d.%H%M%S",
     )
+    if json_lines:
+        log_formatter = JsonFormatter()
 
     log_file = RotatingFileHandler(
         LOG_FILE, maxBytes=5000000, backupCount=5, encoding="utf-8"
@@ -22,11 +119,126 @@ def init_logging():
     log_stream = logging.StreamHandler()
     log_stream.setFormatter(log_formatter)
 
-    logging.root.addHandler(log_file)
-    logging.root.addHandler(log_stream)
+    handlers = [log_file, log_stream]
+    records: "queue.Queue[logging.LogRecord]" = queue.Queue(LOG_QUEUE_SIZE)
+    _log_handler = BlockingQueueHandler(records)
+    if json_lines:
+        _log_handler.addFilter(ContextFilter())
+        _log_index = LogIndex(LOG_INDEX_FILE)
+        handlers.append(LogIndexHandler(_log_index))
+    _log_listener = BlockingQueueListener(
+        records, *handlers, respect_handler_level=True
+    )
+    _log_listener.start()
+    atexit.register(stop_logging)
+
+    logging.root.addHandler(_log_handler)
     logging.root.setLevel(logging.DEBUG)
 
 
+def stop_logging():
+    """
+    Write the queued records, and stop the writer thread
+    """
+    # pylint: disable=global-statement
+    global _log_listener, _log_handler, _log_index
+    if _log_listener is None:
+        return
+    logging.root.removeHandler(_log_handler)
+    _log_listener.stop()
+    for handler in _log_listener.handlers:
+        handler.close()
+    _log_listener = None
+    _log_handler = None
+    _log_index = None
+
+
+def flush_logging():
+    """
+    Wait until the writer thread has handled the records queued so far
+    """
+    if _log_listener is not None:
+        _log_listener.queue.join()
+
+
+def log_index() -> Optional[LogIndex]:
+    """
+    Index of the log records of each execution - None unless logging JSON lines
+    """
+    return _log_index
+
+
+def log_levels() -> Dict[str, str]:
+    """
+    Levels of the root logger and of the loggers with a level of their own
+    """
+    levels = {"root": logging.getLevelName(logging.root.level)}
+    for name, logger in sorted(logging.root.manager.loggerDict.items()):
+        if isinstance(logger, logging.Logger) and logger.level != logging.NOTSET:
+            levels[name] = logging.getLevelName(logger.level)
+    return levels
+
+
+def set_log_levels(levels: Dict[str, Optional[str]]) -> None:
+    """
+    Set logger levels by logger name - "root" is the root logger, and None resets a
+    logger to the level of its parent
+
+    Raises ValueError for an unknown level or logger, before setting any - loggers are
+    not created, so that the logger registry doesn't grow with arbitrary names.
+    """
+    resolved = {}
+    for name, level in levels.items():
+        if name != "root" and name not in logging.root.manager.loggerDict:
+            raise ValueError(f"unknown logger: {name}")
+        if level is None:
+            resolved[name] = logging.NOTSET
+            continue
+        value = logging.getLevelName(str(level).upper())
+        if not isinstance(value, int):
+            raise ValueError(f"unknown log level: {level}")
+        resolved[name] = value
+
+    for name, value in resolved.items():
+        if name == "root":
+            logging.root.setLevel(value or logging.DEBUG)
+        else:
+            logging.getLogger(name).setLevel(value)
+
+
+class LogSampler:
+    """
+    Logs the first `first` records, then one in every `every` - for per-row logging
+
+    Whether the logger is enabled for `level` is checked once, so that a disabled
+    sampler costs a single attribute check per call.
+    """
+
+    def __init__(
+        self, logger: logging.Logger, level: int, first: int = 100, every: int = 1000
+    ):
+        self._logger = logger
+        self._level = level
+        self._first = first
+        self._every = max(1, every)
+        self.enabled = logger.isEnabledFor(level)
+        self.calls = 0
+        self.logged = 0
+
+    def log(self, msg: str, *args: Any) -> None:
+        if not self.enabled:
+            return
+        self.calls += 1
+        if self.calls <= self._first or (self.calls - self._first) % self._every == 0:
+            self.logged += 1
+            # attribute the record to the caller, not to the sampler
+            self._logger.log(self._level, msg, *args, stacklevel=2)
+
+    @property
+    def skipped(self) -> int:
+        return self.calls - self.logged
+
+
 class ExecutionError(Exception):
     def __init__(self, status: str, message: str):
         super().__init__()
@@ -43,3 +255,48 @@ class DataSourceError(ExecutionError):
 
 class ScanResultsError(ExecutionError):
     pass
+
+
+class TtlCache:
+    """
+    Thread safe LRU cache whose entries expire `ttl` seconds after they are set
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """
+        Returns the value set for `key`, or None if it was never set or has expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -1,6 +1,14 @@
+import fnmatch
+import gzip
+import html
 import json
+import logging
+import tempfile
 import os
+import threading
+from functools import partial
 from tempfile import TemporaryDirectory
+from types import SimpleNamespace
 from unittest.mock import patch, MagicMock
 
 import falcon
@@ -8,8 +16,17 @@ import pytest
 from falcon import testing
 from smb.smb_structs import OperationFailure
 
+from protect_with_atakama import metrics
 from protect_with_atakama.app import get_app
-from protect_with_atakama.bigid_api import BigID
+from protect_with_atakama.bigid_api import BigID, Status
+from protect_with_atakama.config import Config, DataSourceSmb
+from protect_with_atakama.executor import Executor
+from protect_with_atakama.jobs import job_runner
+from protect_with_atakama.smb_api import smb_pool
+from protect_with_atakama.state import LabelStore
+from protect_with_atakama.tracing import tracer
+from protect_with_atakama import utils
+from protect_with_atakama.utils import LogSampler, flush_logging, init_logging, stop_logging
 
 
 @pytest.fixture(name="client")
@@ -17,6 +34,38 @@ def client():
     return testing.TestClient(get_app())
 
 
+@pytest.fixture(name="sync_actions", autouse=True)
+def fixture_sync_actions():
+    # run all actions synchronously, unless a test opts in to async execution
+    with patch.object(Executor, "async_actions", ()):
+        yield
+
+
+@pytest.fixture(name="caches", autouse=True)
+def fixture_caches():
+    BigID.clear_caches()
+    Config.clear_cache()
+    yield
+    BigID.clear_caches()
+    Config.clear_cache()
+
+
+@pytest.fixture(name="state_file", autouse=True)
+def fixture_state_file():
+    with TemporaryDirectory() as state_dir:
+        state_file = os.path.join(state_dir, "state.sqlite")
+        with patch("protect_with_atakama.executor.STATE_FILE", state_file):
+            yield state_file
+
+
+@pytest.fixture(name="async_actions")
+def fixture_async_actions():
+    MockBigID.progress.clear()
+    with patch.object(Executor, "async_actions", ("Encrypt",)):
+        with patch.object(Executor, "progress_interval", 0):
+            yield MockBigID.progress
+
+
 @pytest.fixture(name="smb_mock")
 def fixture_smb_mock():
     with patch("protect_with_atakama.smb_api.SMBConnection") as mock_conn_cls:
@@ -25,20 +74,42 @@ def fixture_smb_mock():
         mock_conn.files_written = []
         mock_conn.files_renamed = []
         mock_conn.files_deleted = []
+        mock_conn.contents = {}
 
         def store_file(*args):
             mock_conn.files_written.append(args)
+            share, path, file_obj = args
+            mock_conn.contents[(share, path)] = file_obj.read()
+
+        def retrieve_file(share, path, file_obj):
+            if (share, path) not in mock_conn.contents:
+                raise OperationFailure("msg", "sub-msg")
+            file_obj.write(mock_conn.contents[(share, path)])
 
         def rename(*args):
             mock_conn.files_renamed.append(args)
+            share, old_path, new_path = args
+            mock_conn.contents[(share, new_path)] = mock_conn.contents.pop((share, old_path))
 
         def delete_files(*args):
             mock_conn.files_deleted.append(args)
+            share, path = args
+            mock_conn.contents.pop((share, path), None)
+
+        mock_conn.dirs = {"path", "path/to", "path/to/sibling"} | {f"dir-{i}" for i in range(5)}
+        mock_conn.listings = []
 
-        def list_path(_share, path, *_args, **_kwargs):
-            if "another" in path:
+        def list_path(_share, path, *_args, pattern="*", **_kwargs):
+            mock_conn.listings.append((path, pattern))
+            path = path.strip("/.")
+            if path and path not in mock_conn.dirs:
                 raise OperationFailure("msg", "sub-msg")
-            return ["something"]
+            children = [d.rpartition("/")[2] for d in mock_conn.dirs if d.rpartition("/")[0] == path]
+            return [
+                SimpleNamespace(filename=name, isDirectory=True)
+                for name in [".", ".."] + children
+                if fnmatch.fnmatch(name, pattern)
+            ]
 
         def list_shares():
             share = MagicMock()
@@ -47,23 +118,46 @@ def fixture_smb_mock():
             return [share]
 
         mock_conn.storeFile = store_file
+        mock_conn.retrieveFile = retrieve_file
         mock_conn.rename = rename
         mock_conn.deleteFiles = delete_files
         mock_conn.listPath = list_path
         mock_conn.listShares = list_shares
 
         mock_conn_cls.return_value = mock_conn
+        smb_pool.clear()
         yield mock_conn
+        smb_pool.clear()
 
 
 def test_manifest(client):
     with patch("protect_with_atakama.resources.ManifestResource.manifest_path", "fnf"):
-        response = client.simulate_get("/manifest")
+        # assets are loaded when the app is created
+        response = testing.TestClient(get_app()).simulate_get("/manifest")
         assert response.status == falcon.HTTP_500
 
     response = client.simulate_get("/manifest")
     with open("protect_with_atakama/assets/manifest.json", "r") as f:
         assert response.text == f.read()
+    assert response.headers["content-type"] == falcon.MEDIA_JSON
+    assert "max-age" in response.headers["cache-control"]
+
+    # not modified
+    etag = response.headers["etag"]
+    response = client.simulate_get("/manifest", headers={"If-None-Match": etag})
+    assert response.status == falcon.HTTP_304
+    assert response.content == b""
+
+    # compressed, with its own entity tag
+    response = client.simulate_get("/manifest", headers={"Accept-Encoding": "gzip, deflate"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["etag"] != etag
+    with open("protect_with_atakama/assets/manifest.json", "rb") as f:
+        assert gzip.decompress(response.content) == f.read()
+    response = client.simulate_get(
+        "/manifest", headers={"Accept-Encoding": "gzip", "If-None-Match": etag}
+    )
+    assert response.status == falcon.HTTP_200
 
 
 def test_logs(client):
@@ -85,6 +179,49 @@ def test_logs(client):
             response = client.simulate_get("/logs")
             assert response.text == "log.txt.2\nlog.txt.1\nlog.txt\n"
 
+            response = client.simulate_get("/logs", params={"tail": 2})
+            assert response.text == "log.txt.1\nlog.txt\n"
+            response = client.simulate_get("/logs", params={"offset": 4, "length": 10})
+            assert response.text == "txt.2\nlog."
+            response = client.simulate_get("/logs", params={"level": "warning", "since": "20260101.000000"})
+            assert response.status == falcon.HTTP_200
+            assert response.text == ""
+
+            for params in [
+                {"tail": -1},
+                {"since": "yesterday"},
+                {"level": "loud"},
+                {"tail": 1, "offset": 0},
+            ]:
+                response = client.simulate_get("/logs", params=params)
+                assert response.status == falcon.HTTP_400
+
+
+def test_log_levels(client):
+    response = client.simulate_put("/logs/levels", json={"root": "critical"})
+    assert response.status == falcon.HTTP_403
+    assert logging.root.level != logging.CRITICAL
+
+    with patch.dict(os.environ, {"LOG_LEVELS_WRITABLE": "1"}):
+        _check_log_levels(client)
+
+
+def _check_log_levels(client):
+    try:
+        response = client.simulate_put("/logs/levels", json={"protect_with_atakama.executor": "info"})
+        assert response.status == falcon.HTTP_200
+        assert response.json["protect_with_atakama.executor"] == "INFO"
+        response = client.simulate_get("/logs/levels")
+        assert response.json["protect_with_atakama.executor"] == "INFO"
+
+        for body in [{"protect_with_atakama.executor": "loud"}, ["INFO"], {"no.such.logger": "info"}]:
+            response = client.simulate_put("/logs/levels", json=body)
+            assert response.status == falcon.HTTP_400
+        assert "no.such.logger" not in logging.root.manager.loggerDict
+    finally:
+        response = client.simulate_put("/logs/levels", json={"protect_with_atakama.executor": None})
+        assert "protect_with_atakama.executor" not in response.json
+
 
 def test_icon(client):
     response = client.simulate_get("/assets/icon")
@@ -92,22 +229,47 @@ def test_icon(client):
     assert response.headers["content-type"] == "image/svg+xml"
 
     with patch("protect_with_atakama.resources.IconResource.icon_path", "fnf"):
-        response = client.simulate_get("/assets/icon")
+        response = testing.TestClient(get_app()).simulate_get("/assets/icon")
         assert response.status == falcon.HTTP_500
 
 
 class MockBigID(BigID):
-    def get(self, endpoint: str, params=None):
+    pages_requested = []
+    ds_lookups = []
+    progress = []
+    # directory index -> labels of ds-smb-paged rows, other than label-1
+    paged_labels = {}
+
+    def send_progress_update(self, progress, message, status=Status.IN_PROGRESS):
+        self.progress.append((status, progress, message))
+
+    def get(self, endpoint: str, params=None, data_source=""):
         if endpoint == "ds-connections-types":
             return self._mock_response("")
         elif endpoint.startswith("ds-connections"):
-            return self._get_data_source_info()
+            return self._get_data_source_info(params)
         elif endpoint.startswith("data-catalog"):
-            return self._get_scan_results()
+            return self._get_scan_results(params)
 
-    def _get_scan_results(self):
+    def _get_scan_results(self, params):
         test_case = self.global_params["test-case"]
-        if test_case == "ds-smb-no-pii":
+        if test_case == "ds-smb-paged":
+            rows = [
+                {
+                    "attribute": self.paged_labels.get(i, ["label-1"]),
+                    "objectName": "file.txt",
+                    "fullObjectName": f"share/dir-{i}/file.txt",
+                    "containerName": "share"
+                }
+                for i in range(5)
+            ]
+            skip, limit = params["skip"], params["limit"]
+            self.pages_requested.append((skip, limit))
+            return self._mock_response({
+                "totalRowsCounter": len(rows),
+                "results": rows[skip:skip + limit],
+            })
+        elif test_case == "ds-smb-no-pii":
             return self._mock_response({
                 "totalRowsCounter": 0
             })
@@ -133,49 +295,37 @@ class MockBigID(BigID):
                 ]
             })
 
-    def _get_data_source_info(self):
+    def _get_data_source_info(self, params):
         test_case = self.global_params["test-case"]
+        query = json.loads(params["filter"])
+        assert query[0]["operator"] == "in"
+        names = query[0]["value"]
+        self.ds_lookups.append(names)
         if test_case == "ds-not-found":
-            return self._mock_response({
-                "data": {
-                    "totalCount": 0
-                }
-            })
+            connections = []
         elif test_case == "ds-unsupported":
-            return self._mock_response({
-                "data": {
-                    "totalCount": 1,
-                    "ds_connections": [
-                        {
-                            "type": "unsupported"
-                        }
-                    ]
-                }
-            })
+            connections = [{"name": name, "type": "unsupported"} for name in names]
         elif test_case == "ds-smb-malformed":
             # missing smbServer
-            return self._mock_response({
-                "data": {
-                    "totalCount": 1,
-                    "ds_connections": [
-                        {
-                            "type": "smb",
-                        }
-                    ]
-                }
-            })
-        elif test_case in ("ds-smb-no-pii", "ds-smb-with-pii"):
-            return self._mock_response({
-                "data": {
-                    "totalCount": 1,
-                    "ds_connections": [
-                        {
-                            "type": "smb",
-                            "smbServer": "some-server",
-                        }
-                    ]
-                }
-            })
+            connections = [{"name": name, "type": "smb"} for name in names]
+        elif test_case == "ds-duplicate":
+            connections = [{"name": name, "type": "smb", "smbServer": "some-server"} for name in names * 2]
+        elif test_case == "ds-lookup-fails":
+            raise RuntimeError("lookup failed")
+        elif test_case == "ds-multi-server":
+            connections = [
+                {"name": name, "type": "smb", "smbServer": f"server-{name[0]}"} for name in names
+            ]
+        else:
+            connections = [{"name": name, "type": "smb", "smbServer": "some-server"} for name in names]
+
+        skip, limit = params["skip"], params["limit"]
+        return self._mock_response({
+            "data": {
+                "totalCount": len(connections),
+                "ds_connections": connections[skip:skip + limit],
+            }
+        })
 
     def _mock_response(self, resp):
         ret = MagicMock()
@@ -184,7 +334,15 @@ class MockBigID(BigID):
         return ret
 
 
-def encrypt_body(test_case: str, label_regex: str = ".*", ds_name: str = "", path: str = ""):
+def encrypt_body(
+    test_case: str,
+    label_regex: str = ".*",
+    ds_name: str = "",
+    path: str = "",
+    page_size: int = 1000,
+    write_concurrency: int = 4,
+    spill_rows: int = 2_000_000,
+):
     config = json.dumps({
         "version": 1,
         "data_sources": [
@@ -195,6 +353,9 @@ def encrypt_body(test_case: str, label_regex: str = ".*", ds_name: str = "", pat
                 "password": "pass",
                 "label_filter": ".*",
                 "path_filter": path,
+                "page_size": page_size,
+                "write_concurrency": write_concurrency,
+                "spill_rows": spill_rows,
             },
         ]
     })
@@ -281,6 +442,369 @@ def test_execute_encrypt_basic(client, smb_mock):
     assert smb_mock.files_renamed[0][2] == "path/to/.ip-labels"
 
 
+@patch("protect_with_atakama.executor.BigID", MockBigID)
+def test_metrics(client, smb_mock):
+    ds = "prod_file_share"
+    written = metrics.DIRECTORIES.value(ds, "written")
+    kept = metrics.CATALOG_ROWS.value(ds, "kept")
+    stored = metrics.SMB_OPERATIONS.value(ds, "storeFile", "ok")
+    executions = metrics.EXECUTION_SECONDS.count("Encrypt", "ok")
+
+    response = client.simulate_post("/execute", body=encrypt_body("ds-smb-paged"))
+    assert response.status == falcon.HTTP_200
+    assert metrics.DIRECTORIES.value(ds, "written") == written + 5
+    assert metrics.CATALOG_ROWS.value(ds, "kept") == kept + 5
+    assert metrics.SMB_OPERATIONS.value(ds, "storeFile", "ok") == stored + 5
+    assert metrics.EXECUTION_SECONDS.count("Encrypt", "ok") == executions + 1
+
+    response = client.simulate_get("/metrics")
+    assert response.status == falcon.HTTP_200
+    assert response.headers["content-type"] == metrics.CONTENT_TYPE
+    assert f'protect_with_atakama_directories_total{{data_source="{ds}",result="written"}}' in response.text
+    assert f'protect_with_atakama_smb_operation_seconds_bucket{{data_source="{ds}",operation="storeFile",le="+Inf"}}' in response.text
+
+
+@patch("protect_with_atakama.executor.BigID", MockBigID)
+def test_traces(client, smb_mock, async_actions):
+    tracer.clear()
+    response = client.simulate_get("/traces/execution-id-012")
+    assert response.status == falcon.HTTP_404
+
+    response = client.simulate_post("/execute", body=encrypt_body("ds-smb-paged"))
+    assert response.status == falcon.HTTP_200
+    job_runner.job("execution-id-012").result(timeout=10)
+
+    response = client.simulate_get("/traces")
+    assert response.json == {"executionIds": ["execution-id-012"]}
+
+    response = client.simulate_get("/traces/execution-id-012")
+    assert response.status == falcon.HTTP_200
+    trace = response.json
+    assert trace["otherData"]["executionId"] == "execution-id-012"
+    spans = [e for e in trace["traceEvents"] if e["ph"] == "X"]
+    names = {e["name"] for e in spans}
+    assert {
+        "start",
+        "execute_async",
+        "executor.validate_token",
+        "executor.fetch_data_source_info",
+        "executor.data_source",
+        "executor.get_ip_labels",
+        "executor.write_ds_ip_labels",
+        "executor.write_dir",
+        "smb.storeFile",
+        "smb.rename",
+    } <= names
+    by_id = {e["args"]["id"]: e for e in spans}
+    # directory writes run on pool threads, under their data source
+    write = next(e for e in spans if e["name"] == "executor.write_dir")
+    assert by_id[write["args"]["parent"]]["name"] == "executor.write_ds_ip_labels"
+    assert len([e for e in spans if e["name"] == "executor.write_dir"]) == 5
+
+
+@patch("protect_with_atakama.executor.BigID", MockBigID)
+def test_logs_execution(client, smb_mock):
+    response = client.simulate_get("/logs", params={"execution": "execution-id-012"})
+    assert response.status == falcon.HTTP_400
+
+    stop_logging()
+    try:
+        with TemporaryDirectory() as log_dir, TemporaryDirectory() as state_dir, patch.object(
+            utils, "LOG_FILE", os.path.join(log_dir, "log.txt")
+        ), patch.object(
+            utils, "LOG_INDEX_FILE", os.path.join(state_dir, "log-index.sqlite")
+        ), patch("protect_with_atakama.resources.LOG_DIR", log_dir):
+            init_logging(json_lines=True)
+            response = client.simulate_post("/execute", body=encrypt_body("ds-smb-paged"))
+            assert response.status == falcon.HTTP_200
+            response = client.simulate_post("/execute", body=verify_body("ds-smb-with-pii"))
+            assert response.status == falcon.HTTP_200
+            flush_logging()
+
+            response = client.simulate_get("/logs", params={"execution": "execution-id-012"})
+            assert response.status == falcon.HTTP_200
+            records = [json.loads(html.unescape(line)) for line in response.text.splitlines()]
+            assert records
+            assert {r["execution_id"] for r in records} == {"execution-id-012"}
+            scanned = next(r for r in records if r["message"].startswith("scanned data catalog"))
+            assert scanned["data_source"] == "prod_file_share"
+            assert "duration" in scanned
+
+            response = client.simulate_get("/logs", params={"execution": "01289", "tail": 1})
+            assert json.loads(html.unescape(response.text))["message"] == "finished Verify Config: ok"
+            response = client.simulate_get("/logs", params={"execution": "unknown"})
+            assert response.status == falcon.HTTP_404
+            response = client.simulate_get("/logs", params={"execution": "01289", "offset": 0})
+            assert response.status == falcon.HTTP_400
+            stop_logging()
+    finally:
+        init_logging()
+
+
+@patch("protect_with_atakama.executor.BigID", MockBigID)
+def test_execute_encrypt_paged(client, smb_mock, caplog):
+    MockBigID.pages_requested.clear()
+    # per-row debug logging is sampled
+    with patch("protect_with_atakama.executor.LogSampler", partial(LogSampler, first=2)):
+        response = client.simulate_post("/execute", body=encrypt_body("ds-smb-paged", page_size=2))
+    assert response.status == falcon.HTTP_200
+    assert len([r for r in caplog.records if r.getMessage().startswith("processing: ")]) == 2
+    assert "skipped 3 of 5 row log records" in caplog.messages
+    assert MockBigID.pages_requested == [(0, 2), (2, 2), (4, 2)]
+    assert len(smb_mock.files_written) == 5
+    assert sorted(r[2] for r in smb_mock.files_renamed) == [f"dir-{i}/.ip-labels" for i in range(5)]
+
+    # invalid page size
+    response = client.simulate_post("/execute", body=encrypt_body("ds-smb-paged", page_size=0))
+    assert response.status == falcon.HTTP_400
+
+
+@patch("protect_with_atakama.executor.BigID", MockBigID)
+def test_execute_encrypt_spilled(client, smb_mock, tmp_path):
+    # catalog grouped externally, in sorted runs of 2 rows
+    spill_dir = str(tmp_path)
+    body = encrypt_body("ds-smb-paged", page_size=2, write_concurrency=1, spill_rows=2)
+    with patch.object(Config, "default_spill_dir", spill_dir), patch(
+        "tempfile.TemporaryFile", wraps=tempfile.TemporaryFile
+    ) as temp_file:
+        response = client.simulate_post("/execute", body=body)
+    assert response.status == falcon.HTTP_200
+    assert [r[2] for r in smb_mock.files_renamed] == [f"dir-{i}/.ip-labels" for i in range(5)]
+    assert {c.kwargs["dir"] for c in temp_file.call_args_list} == {spill_dir}
+
+    # invalid spill rows
+    response = client.simulate_post("/execute", body=encrypt_body("ds-smb-paged", spill_rows=0))
+    assert response.status == falcon.HTTP_400
+
+
+@patch("protect_with_atakama.executor.BigID", MockBigID)
+def test_execute_encrypt_concurrency(client, smb_mock):
+    # more directories than the write queue holds
+    response = client.simulate_post("/execute", body=encrypt_body("ds-smb-paged", write_concurrency=1))
+    assert response.status == falcon.HTTP_200
+    assert len(smb_mock.files_written) == 5
+    assert [r[2] for r in smb_mock.files_renamed] == [f"dir-{i}/.ip-labels" for i in range(5)]
+
+    # invalid concurrency
+    response = client.simulate_post("/execute", body=encrypt_body("ds-smb-paged", write_concurrency=0))
+    assert response.status == falcon.HTTP_400
+
+
+def multi_ds_body(test_case: str, names: list, concurrency: int):
+    body = json.loads(encrypt_body(test_case))
+    config = json.loads(body["globalParams"][0]["paramValue"])
+    ds = config["data_sources"][0]
+    config["data_sources"] = [dict(ds, name=name) for name in names]
+    config["max_concurrent_data_sources"] = concurrency
+    config["max_data_sources_per_server"] = 2
+    body["globalParams"][0]["paramValue"] = json.dumps(config)
+    body["actionParams"] = []
+    return json.dumps(body)
+
+
+@patch("protect_with_atakama.executor.BigID", MockBigID)
+def test_execute_encrypt_concurrent_data_sources(client, smb_mock):
+    names = [f"ds-{i}" for i in range(6)]
+
+    # warnings are reported in config order
+    response = client.simulate_post("/execute", body=multi_ds_body("ds-not-found", names, 4))
+    assert response.status == falcon.HTTP_400
+    expected = [f"unexpected count (0) for data source: {name}" for name in names]
+    assert response.text.split("\n") == expected + ["no data sources enumerated"]
+
+    # all data sources processed - they share a directory, so some writes are skipped as unchanged
+    response = client.simulate_post("/execute", body=multi_ds_body("ds-smb-with-pii", names, 4))
+    assert response.status == falcon.HTTP_200
+    message = json.loads(response.text)["message"]
+    counts = dict(c.rsplit(": ", 1) for c in message[len("Done - directories "):].split(", "))
+    assert int(counts["written"]) + int(counts["unchanged"]) == len(names)
+    assert int(counts["written"]) == len(smb_mock.files_written)
+
+
+@patch("protect_with_atakama.executor.BigID", MockBigID)
+def test_execute_data_sources_by_server(client):
+    # a-0 waits for b-0 - a-1 must not take the second worker while a-0 holds server a
+    b_started = threading.Event()
+    started = []
+
+    def process(_self, ds):
+        started.append(ds.name)
+        if ds.name == "b-0":
+            b_started.set()
+        elif not b_started.wait(timeout=5):
+            _self._config.warn(f"b-0 not started while {ds.name} ran")
+
+    body = json.loads(multi_ds_body("ds-multi-server", ["a-0", "a-1", "b-0"], 2))
+    config = json.loads(body["globalParams"][0]["paramValue"])
+    config["max_data_sources_per_server"] = 1
+    body["globalParams"][0]["paramValue"] = json.dumps(config)
+    with patch.object(Executor, "_write_data_source_ip_labels", process):
+        response = client.simulate_post("/execute", body=json.dumps(body))
+    assert response.status == falcon.HTTP_200, response.text
+    assert started.index("b-0") < started.index("a-1")
+
+
+@patch("protect_with_atakama.executor.BigID", MockBigID)
+def test_execute_deferred_warnings_limit(client):
+    def process(_self, ds):
+        for i in range(1000):
+            _self._config.warn(f"{ds.name}: warning {i}")
+
+    with patch.object(Config, "max_warnings", 5), patch.object(
+        Config, "add_warnings", autospec=True, side_effect=Config.add_warnings
+    ) as add_warnings, patch.object(Executor, "_write_data_source_ip_labels", process):
+        response = client.simulate_post("/execute", body=multi_ds_body("ds-smb-with-pii", ["a", "b"], 2))
+    assert response.status == falcon.HTTP_400
+    # each data source's warnings are collected up to the limit
+    assert [len(call.args[1]) for call in add_warnings.call_args_list] == [6, 6]
+    assert response.text.split("\n") == [f"a: warning {i}" for i in range(5)] + ["error limit reached: 5"]
+
+
+@patch("protect_with_atakama.executor.BigID", MockBigID)
+def test_execute_encrypt_unchanged(client, smb_mock, state_file):
+    response = client.simulate_post("/execute", body=encrypt_body("ds-smb-with-pii"))
+    assert response.status == falcon.HTTP_200
+    assert json.loads(response.text)["message"] == "Done - directories written: 1, unchanged: 0, not found: 1"
+    assert len(smb_mock.files_written) == 1
+
+    # same labels - not rewritten, and the share is not read
+    with patch.object(smb_mock, "retrieveFile", side_effect=AssertionError):
+        response = client.simulate_post("/execute", body=encrypt_body("ds-smb-with-pii"))
+    assert response.status == falcon.HTTP_200
+    assert json.loads(response.text)["message"] == "Done - directories written: 0, unchanged: 1, not found: 1"
+    assert len(smb_mock.files_written) == 1
+
+    # state lost - file on the share is compared instead
+    os.remove(state_file)
+    response = client.simulate_post("/execute", body=encrypt_body("ds-smb-with-pii"))
+    assert response.status == falcon.HTTP_200
+    assert json.loads(response.text)["message"] == "Done - directories written: 0, unchanged: 1, not found: 1"
+    assert len(smb_mock.files_written) == 1
+
+    # labels changed - rewritten
+    response = client.simulate_post("/execute", body=encrypt_body("ds-smb-with-pii", label_regex="label-2"))
+    assert response.status == falcon.HTTP_200
+    assert len(smb_mock.files_written) == 2
+    payload = json.loads(smb_mock.contents[("share", "path/to/.ip-labels")])
+    assert payload == {"files": {"file.txt": {"labels": ["label-2"]}}}
+
+
+@patch("protect_with_atakama.executor.BigID", MockBigID)
+def test_execute_encrypt_verify_share(client, smb_mock):
+    body = encrypt_body("ds-smb-with-pii")
+    response = client.simulate_post("/execute", body=body)
+    assert response.status == falcon.HTTP_200
+    assert len(smb_mock.files_written) == 1
+
+    # deleted from the share - not noticed while the stored hash is recent
+    del smb_mock.contents[("share", "path/to/.ip-labels")]
+    response = client.simulate_post("/execute", body=body)
+    assert json.loads(response.text)["message"] == "Done - directories written: 0, unchanged: 1, not found: 1"
+
+    # a full run checks the share
+    full = json.loads(body)
+    full["actionParams"].append({"paramName": "Full Run", "paramValue": "true"})
+    response = client.simulate_post("/execute", body=json.dumps(full))
+    assert json.loads(response.text)["message"] == "Done - directories written: 1, unchanged: 0, not found: 1"
+    assert len(smb_mock.files_written) == 2
+
+    # skipping a directory by its stored hash doesn't count as verifying it
+    response = client.simulate_post("/execute", body=body)
+    del smb_mock.contents[("share", "path/to/.ip-labels")]
+    with patch.object(Config, "default_verify_max_age", 0):
+        Config.clear_cache()
+        response = client.simulate_post("/execute", body=body)
+    assert json.loads(response.text)["message"] == "Done - directories written: 1, unchanged: 0, not found: 1"
+    assert len(smb_mock.files_written) == 3
+
+    # invalid max age
+    invalid = json.loads(body)
+    config = json.loads(invalid["globalParams"][0]["paramValue"])
+    config["data_sources"][0]["verify_max_age"] = -1
+    invalid["globalParams"][0]["paramValue"] = json.dumps(config)
+    response = client.simulate_post("/execute", body=json.dumps(invalid))
+    assert response.status == falcon.HTTP_400
+
+
+@patch("protect_with_atakama.executor.BigID", MockBigID)
+def test_execute_data_source_lookup(client, smb_mock, caplog):
+    names = [f"ds-{i}" for i in range(5)]
+
+    # one paged lookup per batch of names
+    MockBigID.ds_lookups.clear()
+    with patch.object(Executor, "ds_connections_batch", 2):
+        response = client.simulate_post("/execute", body=multi_ds_body("ds-smb-no-pii", names, 1))
+    assert response.status == falcon.HTTP_200
+    assert MockBigID.ds_lookups == [names[0:2], names[2:4], names[4:]]
+    assert "connection info: 0 data sources cached, fetched 5 of 5" in caplog.messages
+
+    # cached
+    MockBigID.ds_lookups.clear()
+    response = client.simulate_post("/execute", body=multi_ds_body("ds-smb-no-pii", names, 1))
+    assert response.status == falcon.HTTP_200
+    assert MockBigID.ds_lookups == []
+    assert "connection info: 5 data sources cached, fetched 0 of 0" in caplog.messages
+
+    # name appears twice - 2 pages
+    BigID.clear_caches()
+    MockBigID.ds_lookups.clear()
+    with patch.object(Executor, "ds_connections_batch", 2):
+        response = client.simulate_post("/execute", body=multi_ds_body("ds-duplicate", names[:2], 1))
+    assert MockBigID.ds_lookups == [names[0:2], names[0:2]]
+    assert response.status == falcon.HTTP_400
+    assert response.text.split("\n") == [
+        "unexpected count (2) for data source: ds-0",
+        "unexpected count (2) for data source: ds-1",
+        "no data sources enumerated",
+    ]
+
+    # lookup fails - reported for each data source
+    response = client.simulate_post("/execute", body=multi_ds_body("ds-lookup-fails", names[:2], 1))
+    assert response.status == falcon.HTTP_400
+    lines = response.text.split("\n")
+    assert len(lines) == 3
+    assert all("RuntimeError('lookup failed')" in line for line in lines[:2])
+
+
+@patch("protect_with_atakama.executor.BigID", MockBigID)
+def test_execute_caches(client, smb_mock):
+    validations = []
+    get = MockBigID.get
+
+    def counting_get(self, endpoint, params=None, data_source=""):
+        if endpoint == "ds-connections-types":
+            validations.append(endpoint)
+        return get(self, endpoint, params, data_source)
+
+    with patch.object(MockBigID, "get", counting_get):
+        MockBigID.ds_lookups.clear()
+        response = client.simulate_post("/execute", body=encrypt_body("ds-smb-with-pii"))
+        assert response.status == falcon.HTTP_200
+        response = client.simulate_post("/execute", body=encrypt_body("ds-smb-with-pii"))
+        assert response.status == falcon.HTTP_200
+        # token validated and data source looked up once
+        assert len(validations) == 1
+        assert len(MockBigID.ds_lookups) == 1
+
+        # cached info doesn't match - invalidated, and looked up again next time
+        with patch.object(DataSourceSmb, "add_api_info", side_effect=KeyError):
+            response = client.simulate_post("/execute", body=encrypt_body("ds-smb-with-pii"))
+            assert response.status == falcon.HTTP_400
+        response = client.simulate_post("/execute", body=encrypt_body("ds-unsupported"))
+        assert response.status == falcon.HTTP_400
+        response = client.simulate_post("/execute", body=encrypt_body("ds-smb-with-pii"))
+        assert response.status == falcon.HTTP_200
+        assert len(MockBigID.ds_lookups) == 3
+
+        # failed validations are not cached
+        body = json.loads(encrypt_body("ds-smb-with-pii"))
+        body["bigidToken"] = "bad-token"
+        for _ in range(2):
+            response = client.simulate_post("/execute", body=json.dumps(body))
+            assert response.status == falcon.HTTP_400
+        assert len(validations) == 3
+
+
 @patch("protect_with_atakama.executor.BigID", MockBigID)
 def test_execute_encrypt_label_filter(client, smb_mock):
     # label filter excludes label-1, label-2
@@ -382,6 +906,214 @@ def test_execute_verify_basic(client, smb_mock):
         assert response.status == falcon.HTTP_400
 
     # connect fails
+    smb_pool.clear()
     with patch.object(smb_mock, "connect", side_effect=Exception):
         response = client.simulate_post("/execute", body=verify_body("ds-smb-with-pii"))
         assert response.status == falcon.HTTP_400
+
+
+@patch("protect_with_atakama.executor.BigID", MockBigID)
+def test_execute_encrypt_async(client, smb_mock, async_actions):
+    response = client.simulate_post("/execute", body=encrypt_body("ds-smb-paged"))
+    assert response.status == falcon.HTTP_200
+    assert json.loads(response.text)["statusEnum"] == Status.IN_PROGRESS.name
+    job_runner.job("execution-id-012").result(timeout=10)
+
+    assert len(smb_mock.files_written) == 5
+    assert async_actions[0] == (Status.IN_PROGRESS, 0.2, "prod_file_share: 1 of 5 directories")
+    assert async_actions[-1] == (
+        Status.COMPLETED, 1.0, "Done - directories written: 5, unchanged: 0, not found: 0"
+    )
+    assert all(status == Status.IN_PROGRESS for status, _, _ in async_actions[:-1])
+
+    # warnings are reported in the final status
+    BigID.clear_caches()
+    async_actions.clear()
+    response = client.simulate_post("/execute", body=encrypt_body("ds-not-found"))
+    assert response.status == falcon.HTTP_200
+    job_runner.job("execution-id-012").result(timeout=10)
+    status, _, message = async_actions[-1]
+    assert status == Status.ERROR
+    assert "unexpected count (0)" in message
+
+    # token is validated before the job starts
+    async_actions.clear()
+    body = json.loads(encrypt_body("ds-smb-paged"))
+    body["bigidToken"] = "bad-token"
+    response = client.simulate_post("/execute", body=json.dumps(body))
+    assert response.status == falcon.HTTP_400
+    assert not async_actions
+
+
+@patch("protect_with_atakama.executor.BigID", MockBigID)
+def test_execute_encrypt_async_errors(client, smb_mock, async_actions):
+    # unexpected error
+    with patch.object(Executor, "_run_action", side_effect=RuntimeError("oops")):
+        client.simulate_post("/execute", body=encrypt_body("ds-smb-paged"))
+        job_runner.job("execution-id-012").result(timeout=10)
+    assert async_actions == [(Status.ERROR, 1.0, "RuntimeError('oops')")]
+
+    # failing progress updates don't fail the job
+    with patch.object(MockBigID, "send_progress_update", side_effect=RuntimeError):
+        client.simulate_post("/execute", body=encrypt_body("ds-smb-paged"))
+        job_runner.job("execution-id-012").result(timeout=10)
+    assert len(smb_mock.files_written) == 5
+
+
+@patch("protect_with_atakama.executor.BigID", MockBigID)
+def test_execute_encrypt_async_running(client, smb_mock, async_actions):
+    release = threading.Event()
+
+    # repeated requests for a running execution don't start another job
+    with patch.object(Executor, "_run_action", side_effect=lambda: release.wait(10)) as run:
+        response = client.simulate_post("/execute", body=encrypt_body("ds-smb-paged"))
+        assert response.status == falcon.HTTP_200
+        job = job_runner.job("execution-id-012")
+        response = client.simulate_post("/execute", body=encrypt_body("ds-smb-paged"))
+        assert response.status == falcon.HTTP_200
+        assert job_runner.job("execution-id-012") is job
+        release.set()
+        job.result(timeout=10)
+        run.assert_called_once()
+
+
+@patch("protect_with_atakama.executor.BigID", MockBigID)
+def test_execute_encrypt_state(client, smb_mock, state_file):
+    store = LabelStore(state_file)
+    with patch("protect_with_atakama.executor._StoreBatch.size", 2):
+        response = client.simulate_post("/execute", body=encrypt_body("ds-smb-paged"))
+    assert response.status == falcon.HTTP_200
+    hashes = store.hashes("prod_file_share")
+    assert sorted(hashes) == [("share", f"dir-{i}") for i in range(5)]
+
+    # directories no longer in the catalog are pruned
+    response = client.simulate_post("/execute", body=encrypt_body("ds-smb-with-pii"))
+    assert response.status == falcon.HTTP_200
+    assert sorted(store.hashes("prod_file_share")) == [("share", "path/to")]
+
+    # failed writes keep their entry, so they are not pruned
+    with patch.object(smb_mock, "storeFile", side_effect=RuntimeError):
+        response = client.simulate_post("/execute", body=encrypt_body("ds-smb-with-pii", label_regex="label-1"))
+    assert response.status == falcon.HTTP_400
+    assert sorted(store.hashes("prod_file_share")) == [("share", "path/to")]
+
+    # empty catalog - all pruned
+    response = client.simulate_post("/execute", body=encrypt_body("ds-smb-no-pii"))
+    assert response.status == falcon.HTTP_200
+    assert not store.hashes("prod_file_share")
+
+
+@patch("protect_with_atakama.executor.BigID", MockBigID)
+def test_execute_encrypt_resume_directories(client, smb_mock, async_actions):
+    store_file = smb_mock.storeFile
+
+    def flaky_store_file(share, path, file_obj):
+        if path.startswith(("dir-1/", "dir-3/")):
+            raise RuntimeError("interrupted")
+        store_file(share, path, file_obj)
+
+    # first attempt - 2 directories fail
+    with patch.object(smb_mock, "storeFile", flaky_store_file):
+        client.simulate_post("/execute", body=encrypt_body("ds-smb-paged"))
+        job_runner.job("execution-id-012").result(timeout=10)
+    assert async_actions[-1][0] == Status.ERROR
+    assert len(smb_mock.files_written) == 3
+
+    # re-issued - only the failed directories are written
+    async_actions.clear()
+    client.simulate_post("/execute", body=encrypt_body("ds-smb-paged"))
+    job_runner.job("execution-id-012").result(timeout=10)
+    assert async_actions[0] == (
+        Status.IN_PROGRESS, 0.6, "prod_file_share: resumed - 3 of 5 directories already done"
+    )
+    assert async_actions[-1] == (
+        Status.COMPLETED, 1.0, "Done - directories written: 2, unchanged: 0, not found: 0"
+    )
+    assert sorted(r[2] for r in smb_mock.files_renamed[3:]) == ["dir-1/.ip-labels", "dir-3/.ip-labels"]
+
+    # completed - checkpoints are cleared
+    async_actions.clear()
+    client.simulate_post("/execute", body=encrypt_body("ds-smb-paged"))
+    job_runner.job("execution-id-012").result(timeout=10)
+    assert not any("resumed" in message for _, _, message in async_actions)
+    assert async_actions[-1] == (
+        Status.COMPLETED, 1.0, "Done - directories written: 0, unchanged: 5, not found: 0"
+    )
+
+
+@patch("protect_with_atakama.executor.BigID", MockBigID)
+def test_execute_encrypt_resume_changed_labels(client, smb_mock, async_actions):
+    store_file = smb_mock.storeFile
+
+    def flaky_store_file(share, path, file_obj):
+        if path.startswith("dir-1/"):
+            raise RuntimeError("interrupted")
+        store_file(share, path, file_obj)
+
+    with patch.object(smb_mock, "storeFile", flaky_store_file):
+        client.simulate_post("/execute", body=encrypt_body("ds-smb-paged"))
+        job_runner.job("execution-id-012").result(timeout=10)
+    assert async_actions[-1][0] == Status.ERROR
+
+    # labels of dir-0 changed since it was checkpointed - it is written again
+    renamed = len(smb_mock.files_renamed)
+    async_actions.clear()
+    with patch.object(MockBigID, "paged_labels", {0: ["label-1", "label-2"]}):
+        client.simulate_post("/execute", body=encrypt_body("ds-smb-paged"))
+        job_runner.job("execution-id-012").result(timeout=10)
+    assert async_actions[-1] == (
+        Status.COMPLETED, 1.0, "Done - directories written: 2, unchanged: 0, not found: 0"
+    )
+    assert sorted(r[2] for r in smb_mock.files_renamed[renamed:]) == ["dir-0/.ip-labels", "dir-1/.ip-labels"]
+
+
+@patch("protect_with_atakama.executor.BigID", MockBigID)
+def test_progress_forced(async_actions):
+    executor = Executor(json.loads(encrypt_body("ds-smb-paged")))
+    executor._progress.report = True
+    executor._progress.total = 2
+    with patch.object(Executor, "progress_interval", 3600):
+        executor._update_progress(SimpleNamespace(name="a"), 1.0, "done")
+        executor._update_progress(SimpleNamespace(name="b"), 0.2, "throttled")
+        executor._update_progress(SimpleNamespace(name="b"), 0.5, "resumed", force=True)
+    assert async_actions == [
+        (Status.IN_PROGRESS, 0.5, "a: done"),
+        (Status.IN_PROGRESS, 0.75, "b: resumed"),
+    ]
+
+
+@patch("protect_with_atakama.executor.BigID", MockBigID)
+def test_execute_encrypt_resume_data_sources(client, smb_mock):
+    get_ip_labels = Executor._get_ip_labels
+    failures = ["ds-1"]
+
+    def flaky_get_ip_labels(self, ds):
+        if ds.name in failures:
+            failures.remove(ds.name)
+            raise RuntimeError("interrupted")
+        return get_ip_labels(self, ds)
+
+    # first attempt - ds-1 fails
+    MockBigID.pages_requested.clear()
+    with patch.object(Executor, "_get_ip_labels", flaky_get_ip_labels):
+        response = client.simulate_post("/execute", body=multi_ds_body("ds-smb-paged", ["ds-0", "ds-1"], 1))
+        assert response.status == falcon.HTTP_400
+        assert len(MockBigID.pages_requested) == 1
+
+        # re-issued - ds-0 is not fetched again
+        response = client.simulate_post("/execute", body=multi_ds_body("ds-smb-paged", ["ds-0", "ds-1"], 1))
+        assert response.status == falcon.HTTP_200
+        assert len(MockBigID.pages_requested) == 2
+
+
+@patch("protect_with_atakama.executor.BigID", MockBigID)
+def test_execute_encrypt_dir_listings(client, smb_mock):
+    # each parent is listed once - by name if only one of its children is labeled
+    response = client.simulate_post("/execute", body=encrypt_body("ds-smb-paged"))
+    assert response.status == falcon.HTTP_200
+    assert smb_mock.listings == [("/", "*")]
+
+    smb_mock.listings.clear()
+    response = client.simulate_post("/execute", body=encrypt_body("ds-smb-with-pii"))
+    assert response.status == falcon.HTTP_200
+    assert sorted(smb_mock.listings) == [("path", "to"), ("path/to", "another")]
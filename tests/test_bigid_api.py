@@ -5,6 +5,8 @@ import pytest
 
 from protect_with_atakama.bigid_api import BigID, Status
 from protect_with_atakama.config import Config, DataSourceSmb
+from protect_with_atakama.metrics import BIGID_REQUEST_SECONDS, BIGID_REQUESTS
+from protect_with_atakama.utils import TtlCache
 
 config = json.dumps({
     "version": 1,
@@ -15,7 +17,8 @@ config = json.dumps({
             "username": "user",
             "password": "pass",
             "label_filter": ".*",
-            "path_filter": ""
+            "path_filter": "",
+            "page_size": 500
         },
         {
             "name": "invalid: missing creds",
@@ -44,7 +47,9 @@ valid_api_params = {
 
 @pytest.fixture(name="bigid_api")
 def fixture_bigid_api():
+    BigID.close_sessions()
     yield BigID(valid_api_params)
+    BigID.close_sessions()
 
 
 def test_bigid_api_init_fails():
@@ -69,6 +74,7 @@ def test_bigid_api_params(bigid_api):
     assert "a-n1" not in bigid_api.global_params.keys()
     assert "Config" not in bigid_api.action_params.keys()
     assert bigid_api.action_name == valid_api_params["actionName"]
+    assert bigid_api.execution_id == valid_api_params["executionId"]
 
 
 def test_bigid_api_progress(bigid_api):
@@ -88,7 +94,7 @@ def test_bigid_api_progress(bigid_api):
         "message": "Done"
     })
 
-    with patch("protect_with_atakama.bigid_api.requests") as mock_requests:
+    with patch.object(bigid_api, "_session") as mock_session:
         url = valid_api_params["updateResultCallback"]
         data = {
             "executionId": valid_api_params["executionId"],
@@ -97,7 +103,20 @@ def test_bigid_api_progress(bigid_api):
             "message": "three-quarters-done"
         }
         bigid_api.send_progress_update(data["progress"], data["message"])
-        mock_requests.put.assert_called_once_with(url, headers=bigid_api._headers, data=data)
+        mock_session.put.assert_called_once_with(url, headers=bigid_api._headers, data=json.dumps(data))
+        mock_session.reset_mock()
+
+        data["statusEnum"] = Status.ERROR.name
+        bigid_api.send_progress_update(data["progress"], data["message"], Status.ERROR)
+        mock_session.put.assert_called_once_with(url, headers=bigid_api._headers, data=json.dumps(data))
+
+    response = bigid_api.get_progress_started()
+    assert response == json.dumps({
+        "executionId": bigid_api._execution_id,
+        "statusEnum": "IN_PROGRESS",
+        "progress": 0.0,
+        "message": "Started"
+    })
 
 
 def test_bigid_api_requests(bigid_api):
@@ -105,15 +124,56 @@ def test_bigid_api_requests(bigid_api):
     base_url = valid_api_params["bigidBaseUrl"]
     data = {"fake": "data"}
 
-    with patch("protect_with_atakama.bigid_api.requests") as mock_requests:
+    with patch.object(bigid_api, "_session") as mock_session:
         bigid_api.get(resource)
-        mock_requests.get.assert_called_once_with(f"{base_url}{resource}", headers=bigid_api._headers, params=None)
+        mock_session.get.assert_called_once_with(f"{base_url}{resource}", headers=bigid_api._headers, params=None)
 
         bigid_api.post(resource, data)
-        mock_requests.post.assert_called_once_with(f"{base_url}{resource}", headers=bigid_api._headers, data=data)
+        mock_session.post.assert_called_once_with(f"{base_url}{resource}", headers=bigid_api._headers, data=data)
 
         bigid_api.put(resource, data)
-        mock_requests.put.assert_called_once_with(f"{base_url}{resource}", headers=bigid_api._headers, data=data)
+        mock_session.put.assert_called_once_with(f"{base_url}{resource}", headers=bigid_api._headers, data=data)
+
+        # requests are counted by endpoint and status
+        mock_session.get.return_value.status_code = 200
+        count = BIGID_REQUESTS.value("", "GET", resource, "200")
+        bigid_api.get(resource)
+        assert BIGID_REQUESTS.value("", "GET", resource, "200") == count + 1
+
+        mock_session.get.side_effect = ConnectionError()
+        count = BIGID_REQUESTS.value("", "GET", resource, "error")
+        with pytest.raises(ConnectionError):
+            bigid_api.get(resource)
+        assert BIGID_REQUESTS.value("", "GET", resource, "error") == count + 1
+
+        # and by data source, for requests made for one
+        mock_session.get.side_effect = None
+        count = BIGID_REQUESTS.value("ds-1", "GET", resource, "200")
+        bigid_api.get(resource, data_source="ds-1")
+        assert BIGID_REQUESTS.value("ds-1", "GET", resource, "200") == count + 1
+        assert BIGID_REQUEST_SECONDS.count("ds-1", "GET", resource) >= 1
+
+
+def test_bigid_api_sessions(bigid_api):
+    # same base url - session is shared
+    other = BigID(valid_api_params)
+    assert other._session is bigid_api._session
+
+    adapter = bigid_api._session.get_adapter(valid_api_params["bigidBaseUrl"])
+    assert adapter._pool_connections == BigID.pool_connections
+    assert adapter._pool_maxsize == BigID.pool_maxsize
+    assert adapter._pool_block == BigID.pool_block
+
+    # different base url - new session
+    params = dict(valid_api_params, bigidBaseUrl="https://other-bigid-base-url")
+    other = BigID(params)
+    assert other._session is not bigid_api._session
+
+    # closed sessions are not reused
+    with patch.object(bigid_api._session, "close") as mock_close:
+        BigID.close_sessions()
+        mock_close.assert_called_once()
+    assert BigID(valid_api_params)._session is not bigid_api._session
 
 
 def test_config():
@@ -124,6 +184,7 @@ def test_config():
     ds = cfg.data_sources[0]
     assert ds.name == cfg_dict["data_sources"][0]["name"]
     assert isinstance(ds, DataSourceSmb)
+    assert ds.page_size == 500
     api_info = {"smbServer": "the-server", "domain": "the-domain"}
     ds.add_api_info(api_info)
     assert ds.server == api_info["smbServer"]
@@ -133,3 +194,81 @@ def test_config():
         cfg.warn(f"warning {i}")
 
     assert len(cfg.warnings) == cfg.max_warnings + 1
+
+    assert cfg.max_concurrent_data_sources == 1
+    assert cfg.max_data_sources_per_server == 1
+    cfg_dict["max_concurrent_data_sources"] = 8
+    cfg_dict["max_data_sources_per_server"] = 0
+    cfg = Config(json.dumps(cfg_dict))
+    assert cfg.max_concurrent_data_sources == 8
+    assert cfg.max_data_sources_per_server == 1
+
+
+def test_config_load_cached():
+    Config.clear_cache()
+    with patch.object(Config, "_load_data_sources", autospec=True, side_effect=Config._load_data_sources) as load:
+        cfg1 = Config.load(config)
+        cfg2 = Config.load(config)
+    assert load.call_count == 1
+
+    # copies of the cached config can be changed independently
+    assert cfg1 is not cfg2
+    assert cfg1.data_sources[0] is not cfg2.data_sources[0]
+    assert cfg1.data_sources[0].label_regex is cfg2.data_sources[0].label_regex
+    parse_warnings = list(cfg2.warnings)
+    assert len(parse_warnings) == 2
+    cfg1.warn("cfg1 only")
+    cfg1.data_sources[0].server = "cfg1-server"
+    assert cfg2.warnings == parse_warnings
+    assert cfg2.data_sources[0].server == ""
+    assert Config.load(config).warnings == parse_warnings
+
+    # invalid label filters are reported when parsed
+    cfg_dict = json.loads(config)
+    cfg_dict["data_sources"][0]["label_filter"] = "["
+    cfg = Config.load(json.dumps(cfg_dict))
+    assert len(cfg.data_sources) == 0
+    assert "failed to parse data source" in cfg.warnings[0]
+    Config.clear_cache()
+
+
+def test_config_deferred_warnings():
+    cfg = Config(config)
+    warnings_count = len(cfg.warnings)
+    with cfg.deferred_warnings() as deferred:
+        cfg.warn("deferred")
+    assert deferred == ["deferred"]
+    assert len(cfg.warnings) == warnings_count
+
+    cfg.warn("not deferred")
+    assert cfg.warnings[-1] == "not deferred"
+    cfg.add_warnings(deferred)
+    assert cfg.warnings[-1] == "deferred"
+
+
+def test_ttl_cache():
+    cache = TtlCache(maxsize=2, ttl=60)
+    assert cache.get("a") is None
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+
+    # least recently used is evicted
+    cache.set("c", 3)
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+    cache.invalidate("a")
+    cache.invalidate("not-cached")
+    assert cache.get("a") is None
+
+    cache.clear()
+    assert len(cache) == 0
+
+    # expired
+    cache.ttl = -1
+    cache.set("a", 1)
+    assert cache.get("a") is None
+    assert len(cache) == 0
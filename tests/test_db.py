@@ -0,0 +1,25 @@
+import os
+import threading
+from tempfile import TemporaryDirectory
+
+from protect_with_atakama.db import ThreadConnections
+
+
+def test_thread_connections():
+    with TemporaryDirectory() as temp_dir:
+        db = ThreadConnections(os.path.join(temp_dir, "state", "test.sqlite"), 1.0)
+        conn = db.get()
+        assert db.get() is conn
+        assert conn.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+
+        # one connection per thread
+        other = []
+        thread = threading.Thread(target=lambda: other.append(db.get()))
+        thread.start()
+        thread.join()
+        assert other[0] is not conn
+
+        db.close()
+        db.close()
+        assert db.get() is not conn
+        db.close()
@@ -0,0 +1,94 @@
+import re
+from unittest.mock import patch
+
+from protect_with_atakama.labels import IpLabels, LabelFilter
+
+
+def test_label_filter():
+    regex = re.compile("label-[12]", re.I)
+    label_filter = LabelFilter(regex)
+    assert label_filter.pattern == "label-[12]"
+
+    assert label_filter(["label-1", "other", "LABEL-2"]) == ("label-1", "LABEL-2")
+    assert label_filter([]) == ()
+    assert label_filter(["other"]) == ()
+
+    # rows with the same labels share one filtered tuple
+    filtered = label_filter(["label-1", "label-3"])
+    assert label_filter(("label-1", "label-3")) is filtered
+    assert filtered == ("label-1",)
+
+
+def test_label_filter_memoized():
+    regex = re.compile("label-1")
+    label_filter = LabelFilter(regex)
+    with patch.object(LabelFilter, "max_memo", 2), patch.object(
+        label_filter, "_regex", wraps=regex
+    ) as wrapped:
+        for _ in range(3):
+            label_filter(["label-1", "label-2"])
+            label_filter(["label-2", "label-1"])
+        # one regex match per distinct label
+        assert wrapped.match.call_count == 2
+
+        # memo is reset when full
+        label_filter(["label-3"])
+        assert label_filter(["label-2", "label-1"]) == ("label-1",)
+        assert wrapped.match.call_count == 5
+
+
+def test_ip_labels():
+    ip_labels = IpLabels()
+    assert len(ip_labels) == 0
+
+    labels = ("label-1",)
+    ip_labels.add(("share", "dir"), "a.txt", labels)
+    ip_labels.add(("share", "dir"), "b.txt", labels)
+    ip_labels.add(("share", "."), "c.txt", ())
+    assert len(ip_labels) == 2
+    assert list(ip_labels.keys()) == [("share", "dir"), ("share", ".")]
+
+    files = dict(ip_labels.items())[("share", "dir")]
+    assert files["a.txt"] is files["b.txt"]
+    assert IpLabels.payload(files) == {
+        "files": {"a.txt": {"labels": labels}, "b.txt": {"labels": labels}}
+    }
+    assert repr(ip_labels) == (
+        "IpLabels(dirs=2, rows=3, runs=0, sample=[('share', 'dir'), ('share', '.')])"
+    )
+
+
+def test_ip_labels_spilled():
+    rows = [
+        (("share", "b"), "1.txt", ("label-1",)),
+        (("share", "a"), "2.txt", ("label-2",)),
+        (("share", "b"), "3.txt", ("label-1",)),
+        (("other", "a"), "4.txt", ()),
+        (("share", "a"), "2.txt", ("label-1",)),
+        (("share", "b"), "5.txt", ("label-2",)),
+        (("share", "c"), "6.txt", ("label-2",)),
+    ]
+    in_memory = IpLabels()
+    for row in rows:
+        in_memory.add(*row)
+
+    with IpLabels(spill_rows=2) as spilled:
+        for row in rows:
+            spilled.add(*row)
+        assert len(spilled._runs) == 3
+        assert repr(spilled) == "IpLabels(dirs=4, rows=1, runs=3, sample=[('share', 'c')])"
+        assert len(spilled) == 4
+        assert set(spilled.keys()) == set(in_memory.keys())
+
+        # sorted by directory, and rows added later win
+        items = list(spilled.items())
+        assert [key for key, _ in items] == sorted(in_memory.keys())
+        assert dict(items) == dict(in_memory.items())
+        # label tuples are shared again after the merge
+        b_files = dict(items)[("share", "b")]
+        assert b_files["1.txt"] is b_files["3.txt"]
+
+        # runs can be merged again
+        assert list(spilled.items()) == items
+
+    assert not spilled._runs
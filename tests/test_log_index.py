@@ -0,0 +1,66 @@
+import logging
+import os
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+from protect_with_atakama.log_index import LogIndex, LogIndexHandler
+
+
+def test_log_index():
+    with TemporaryDirectory() as state_dir:
+        path = os.path.join(state_dir, "log-index.sqlite")
+        index = LogIndex(path)
+        assert index.get("a") is None
+
+        with patch.object(LogIndex, "flush_interval", 3600):
+            index.add("a", "20990101.100000")
+            index.add("a", "20990101.100005")
+            index.add("a", "20990101.095959")
+            assert index.get("a") == ("20990101.095959", "20990101.100005")
+
+            # new executions are saved at once, updates when due
+            assert LogIndex(path).get("a") == ("20990101.100000", "20990101.100000")
+            index.add("b", "20990101.100001")
+            assert LogIndex(path).get("a") == ("20990101.095959", "20990101.100005")
+
+        with patch.object(LogIndex, "flush_interval", 0):
+            index.add("a", "20990101.110000")
+            assert LogIndex(path).get("a") == ("20990101.095959", "20990101.110000")
+        index.close()
+        reopened = LogIndex(path)
+        assert reopened.get("a") == ("20990101.095959", "20990101.110000")
+        assert reopened.get("b") == ("20990101.100001", "20990101.100001")
+
+        # a re-issued execution extends its range
+        reopened.add("b", "20990102.000000")
+        assert reopened.get("b") == ("20990101.100001", "20990102.000000")
+        reopened.close()
+
+        # old executions are deleted
+        reopened.add("old", "20000101.000000")
+        reopened.close()
+        pruned = LogIndex(path)
+        assert pruned.get("old") is None
+        assert pruned.get("a") is not None
+        pruned.close()
+
+
+def test_log_index_handler():
+    with TemporaryDirectory() as state_dir:
+        index = LogIndex(os.path.join(state_dir, "log-index.sqlite"))
+        handler = LogIndexHandler(index)
+        record = logging.LogRecord("test", logging.INFO, "a.py", 1, "msg", None, None)
+        handler.handle(record)
+        record.execution_id = "a"
+        handler.handle(record)
+        record.created += 1
+        handler.handle(record)
+        first, last = index.get("a")
+        assert first < last
+
+        with patch.object(index, "add", side_effect=ValueError), patch.object(
+            handler, "handleError"
+        ) as handle_error:
+            handler.handle(record)
+        handle_error.assert_called_once_with(record)
+        handler.close()
@@ -0,0 +1,190 @@
+import html
+import json
+import logging
+import os
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+import pytest
+
+from protect_with_atakama.log_reader import LogReader, log_files
+
+# oldest first
+LOGS = {
+    "log.txt.2": [
+        "20260101.100000.000 INFO     1:1 [a.py:1] started\n",
+        "20260101.100001.000 DEBUG    1:1 [a.py:2] debug <1>\n",
+    ],
+    "log.txt.1": [
+        "20260101.110000.000 ERROR    1:1 [a.py:3] failed\n",
+        "Traceback (most recent call last):\n",
+        "ValueError: é\n",
+        "20260101.110001.000 INFO     1:1 [a.py:4] info\n",
+    ],
+    "log.txt": [
+        "20260101.120000.000 WARNING  1:1 [a.py:5] warning\n",
+        "20260101.120001.000 CUSTOM   1:1 [a.py:6] custom level\n",
+        "20260101.120002.000 DEBUG    1:1 [a.py:7] last",
+    ],
+}
+ALL = [line for lines in LOGS.values() for line in lines]
+
+
+@pytest.fixture(name="log_dir", params=[8, 64 * 1024])
+def fixture_log_dir(request):
+    # tiny chunks split lines and utf-8 characters
+    with TemporaryDirectory() as log_dir, patch.object(LogReader, "chunk_size", request.param):
+        for name, lines in LOGS.items():
+            with open(os.path.join(log_dir, name), "w", encoding="utf-8") as f:
+                f.writelines(lines)
+        yield log_dir
+
+
+def read(chunks) -> str:
+    return b"".join(chunks).decode()
+
+
+def test_log_files(log_dir):
+    open(os.path.join(log_dir, "log.txt.10"), "w").close()
+    names = [os.path.basename(path) for path in log_files(log_dir)]
+    assert names == ["log.txt.10", "log.txt.2", "log.txt.1", "log.txt"]
+
+
+def test_log_reader_read(log_dir):
+    files = log_files(log_dir)
+    text = read(LogReader(files).read())
+    assert text == "".join(ALL).replace("<1>", "&lt;1&gt;")
+
+    text = read(LogReader(files, level=logging.WARNING).read())
+    assert text == "".join(ALL[2:5] + ALL[6:7])
+
+    # records logged since a time, skipping older files
+    with patch.object(LogReader, "_first_timestamp", wraps=LogReader._first_timestamp) as first:
+        text = read(LogReader(files, since="20260101.110001").read())
+        assert text == "".join(ALL[5:])
+        assert first.call_count == 2
+
+    text = read(LogReader(files, since="20250101.000000").read())
+    assert text == read(LogReader(files).read())
+    assert read(LogReader(files, since="20270101.000000").read()) == ""
+
+
+def test_log_reader_tail(log_dir):
+    files = log_files(log_dir)
+    assert read(LogReader(files).tail(0)) == ""
+    assert read(LogReader(files).tail(1)) == ALL[-1] + "\n"
+    assert read(LogReader(files).tail(5)) == "".join(ALL[-5:]) + "\n"
+    assert read(LogReader(files).tail(100)) == read(LogReader(files).read()) + "\n"
+
+    # filtered records are whole, with their continuation lines
+    text = read(LogReader(files, level=logging.ERROR).tail(2))
+    assert text == "".join(ALL[3:5])
+    text = read(LogReader(files, level=logging.ERROR).tail(10))
+    assert text == "".join(ALL[2:5])
+    text = read(LogReader(files, since="20260101.110001").tail(10))
+    assert text == "".join(ALL[5:]) + "\n"
+
+    # continuation lines at the start of the logs, empty files and lines
+    with open(os.path.join(log_dir, "log.txt.3"), "w") as f:
+        f.write("orphan\n\n")
+    open(os.path.join(log_dir, "log.txt.4"), "w").close()
+    files = log_files(log_dir)
+    assert read(LogReader(files).tail(100)).startswith("orphan\n\n" + ALL[0])
+    assert read(LogReader(files, level=logging.DEBUG).tail(100)).startswith(ALL[0])
+
+
+def test_log_reader_range(log_dir):
+    files = log_files(log_dir)
+    raw = "".join(ALL).encode()
+    for offset, length in [(0, None), (0, 10), (5, 200), (len(raw) - 3, None), (len(raw), 5), (0, 0)]:
+        text = read(LogReader(files).range(offset, length))
+        expected = raw[offset:] if length is None else raw[offset : offset + length]
+        assert text == expected.decode(errors="replace").replace("<", "&lt;").replace(">", "&gt;")
+
+
+def rotate(log_dir: str) -> None:
+    for name in sorted(os.listdir(log_dir), reverse=True):
+        if name != "log.txt":
+            os.rename(os.path.join(log_dir, name), os.path.join(log_dir, f"log.txt.{int(name[8:]) + 1}"))
+    os.rename(os.path.join(log_dir, "log.txt"), os.path.join(log_dir, "log.txt.1"))
+    with open(os.path.join(log_dir, "log.txt"), "w") as f:
+        f.write("20260101.130000.000 INFO     1:1 [a.py:8] rotated\n")
+
+
+@pytest.mark.parametrize("stream", ["read", "tail", "range"])
+def test_log_reader_rotated(log_dir, stream):
+    # the logs as they were when the reader was made, though rotated while streaming
+    files = log_files(log_dir)
+    args = {"read": (), "tail": (100,), "range": (0,)}[stream]
+    expected = read(getattr(LogReader(files), stream)(*args))
+    reader = LogReader(files)
+    chunks = getattr(reader, stream)(*args)
+    first = next(chunks)
+    rotate(log_dir)
+    with open(os.path.join(log_dir, "log.txt.1"), "a") as f:
+        f.write("20260101.120003.000 INFO     1:1 [a.py:9] late\n")
+    assert read([first, *chunks]) == expected
+    assert all(log_file.file.closed for log_file in reader._files)
+
+
+def test_log_reader_missing(log_dir):
+    # rotated away since listed, or listed again under a new name
+    files = log_files(log_dir)
+    os.remove(files[0])
+    os.link(files[2], os.path.join(log_dir, "log.txt.3"))
+    reader = LogReader([os.path.join(log_dir, "log.txt.3"), *files])
+    assert [os.path.basename(log_file.path) for log_file in reader._files] == ["log.txt.1", "log.txt"]
+    assert read(reader.read()) == "".join(ALL[2:])
+
+
+def test_log_reader_truncated(log_dir):
+    # emptied after the reader was made
+    files = log_files(log_dir)
+    readers = [LogReader(files), LogReader(files)]
+    open(files[2], "w").close()
+    assert read(readers[0].read()) == html.escape("".join(ALL[:6]))
+    assert read(readers[1].range(0)) == html.escape("".join(ALL[:6]))
+
+
+def json_line(time: str, level: str, message: str, **fields) -> str:
+    return json.dumps({"time": f"{time}.000", "level": level, "message": message, **fields}) + "\n"
+
+
+def test_log_reader_json():
+    logs = {
+        "log.txt.2": [
+            json_line("20260101.100000", "INFO", "a started", execution_id="a"),
+            json_line("20260101.100001", "DEBUG", 'quoted "execution_id": "b"'),
+        ],
+        "log.txt.1": [
+            json_line("20260101.110000", "ERROR", "b failed\nTraceback", execution_id="b"),
+            json_line("20260101.110001", "INFO", "a done", execution_id="a"),
+            "not json \"execution_id\": \"b\"\n",
+        ],
+        "log.txt": [
+            # a text record, from before a switch to JSON lines
+            '20260101.115959.000 INFO     1:1 [a.py:1] "execution_id": "b"\n',
+            json_line("20260101.120000", "WARNING", "b done", execution_id="b"),
+        ],
+    }
+    lines = [line for file_lines in logs.values() for line in file_lines]
+    with TemporaryDirectory() as log_dir:
+        for name, file_lines in logs.items():
+            with open(os.path.join(log_dir, name), "w", encoding="utf-8") as f:
+                f.writelines(file_lines)
+        files = log_files(log_dir)
+
+        assert read(LogReader(files, level=logging.WARNING).read()) == html.escape(lines[2] + lines[6])
+        assert read(LogReader(files, level=logging.WARNING).tail(1)) == html.escape(lines[6])
+
+        with patch.object(LogReader, "_first_timestamp", wraps=LogReader._first_timestamp) as first:
+            reader = LogReader(files, since="20260101.100000", until="20260101.110001", execution="a")
+            # a line that is not a record belongs to the record before it
+            assert read(reader.read()) == html.escape(lines[0] + lines[3] + lines[4])
+            # log.txt is not read
+            assert first.call_args_list[-1].args[0].path == files[2]
+        assert read(LogReader(files, execution="b").read()) == html.escape(lines[2] + lines[6])
+        assert read(LogReader(files, execution="b").tail(1)) == html.escape(lines[6])
+        assert read(LogReader(files, until="20260101.100001").read()) == html.escape(lines[0] + lines[1])
+        assert read(LogReader(files, until="20260101.110000").read()) == html.escape("".join(lines[:3]))
+        assert read(LogReader(files, execution="c").read()) == ""
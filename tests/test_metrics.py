@@ -0,0 +1,51 @@
+import pytest
+
+from protect_with_atakama.metrics import Registry
+
+
+def test_counter():
+    registry = Registry()
+    counter = registry.counter("requests_total", "Requests", ("endpoint", "status"))
+    counter.inc("a", "200")
+    counter.inc("a", "200", amount=2)
+    counter.inc('b"\\\n', "500")
+    assert counter.value("a", "200") == 3
+    assert counter.value("c", "200") == 0
+
+    with pytest.raises(ValueError):
+        counter.inc("a")
+    with pytest.raises(ValueError):
+        registry.counter("requests_total", "Requests again")
+
+    assert registry.render().splitlines() == [
+        "# HELP protect_with_atakama_requests_total Requests",
+        "# TYPE protect_with_atakama_requests_total counter",
+        'protect_with_atakama_requests_total{endpoint="a",status="200"} 3.0',
+        'protect_with_atakama_requests_total{endpoint="b\\"\\\\\\n",status="500"} 1.0',
+    ]
+
+
+def test_histogram():
+    registry = Registry()
+    histogram = registry.histogram("latency_seconds", "Latency", buckets=(1, 0.1))
+    histogram.observe(0.05)
+    histogram.observe(0.1)
+    histogram.observe(5)
+    with histogram.time():
+        pass
+    assert histogram.count() == 4
+
+    assert registry.render().splitlines() == [
+        "# HELP protect_with_atakama_latency_seconds Latency",
+        "# TYPE protect_with_atakama_latency_seconds histogram",
+        'protect_with_atakama_latency_seconds_bucket{le="0.1"} 3',
+        'protect_with_atakama_latency_seconds_bucket{le="1.0"} 3',
+        'protect_with_atakama_latency_seconds_bucket{le="+Inf"} 4',
+        f"protect_with_atakama_latency_seconds_sum {histogram._values[()][1]!r}",
+        "protect_with_atakama_latency_seconds_count 4",
+    ]
+
+    labelled = registry.histogram("op_seconds", "Op latency", ("op",))
+    assert labelled.count("read") == 0
+    labelled.observe(0.2, "read")
+    assert 'protect_with_atakama_op_seconds_bucket{op="read",le="0.25"} 1' in registry.render()
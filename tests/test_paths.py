@@ -0,0 +1,66 @@
+import random
+from unittest.mock import patch
+
+import pytest
+
+from protect_with_atakama.paths import PathGrouper, parent_key
+
+COMPONENTS = ["share", "a", "b", "dir\\sub", "x.txt", ".", "..", ""]
+SHARES = ["share", "share/", "share/a", "a", "", ".", "/share"]
+FILTERS = ["", "share", "share/a", "share/a/", "share//a", "share/./a", ".", "a", "share/a/x.txt", "/share"]
+
+
+def random_path(rnd: random.Random) -> str:
+    path = "/".join(rnd.choice(COMPONENTS) for _ in range(rnd.randint(1, 5)))
+    if rnd.random() < 0.1:
+        path = "/" + path
+    return path
+
+
+def reference(share, full, path_filter):
+    try:
+        return parent_key(share, full, path_filter)
+    except ValueError:
+        return ValueError
+
+
+def grouped(paths, share, full):
+    try:
+        return paths.key(share, full)
+    except ValueError:
+        return ValueError
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_path_grouper_matches_pathlib(seed):
+    rnd = random.Random(seed)
+    for path_filter in FILTERS:
+        paths = PathGrouper(path_filter)
+        for _ in range(1000):
+            share = rnd.choice(SHARES)
+            full = random_path(rnd)
+            if rnd.random() < 0.5:
+                full = f"{share}/{full}"
+            expected = reference(share, full, path_filter)
+            # twice: the second lookup is from the directory cache
+            assert grouped(paths, share, full) == expected, (share, full, path_filter)
+            assert grouped(paths, share, full) == expected, (share, full, path_filter)
+
+
+def test_path_grouper():
+    paths = PathGrouper("share/dir")
+    assert paths.key("share", "share/dir/file.txt") == ("share", "dir")
+    assert paths.key("share", "share/dir/a\\b/file.txt") == ("share", "dir/a/b")
+    assert paths.key("share", "share/other/file.txt") is None
+    assert paths.key("share", "share/dir") == ("share", ".")
+    with pytest.raises(ValueError):
+        paths.key("other", "share/dir/file.txt")
+
+    # files in a directory share one key
+    assert paths.key("share", "share/dir/1") is paths.key("share", "share/dir/2")
+
+    paths = PathGrouper()
+    assert paths.key("share", "share/file.txt") == ("share", ".")
+    with patch.object(PathGrouper, "max_cache", 1):
+        assert paths.key("share", "share/a/file.txt") == ("share", "a")
+        assert len(paths._dirs) == 1
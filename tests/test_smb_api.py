@@ -1,10 +1,12 @@
+import io
+import os
 from dataclasses import dataclass
 from unittest.mock import patch, MagicMock
 
 import pytest
 from smb.smb_structs import OperationFailure
 
-from protect_with_atakama.smb_api import Smb
+from protect_with_atakama.smb_api import DirCache, Smb, SmbPool
 
 
 @pytest.fixture(name="smb_api")
@@ -68,6 +70,49 @@ def test_smb_api_connect(smb_api):
     assert smb_api._conn is None
 
 
+def test_smb_api_atomic_write(smb_api):
+    with smb_api:
+        conn = smb_api.connection
+
+        # target known to be missing - no delete
+        assert smb_api.atomic_write("share", "dir", "file", b"data", exists=False) == 2
+        conn.deleteFiles.assert_not_called()
+        conn.rename.assert_called_once()
+        conn.reset_mock()
+
+        # missing target that was expected - delete failure ignored
+        conn.deleteFiles.side_effect = OperationFailure("msg", "sub-msg")
+        assert smb_api.atomic_write("share", "dir", "file", b"data") == 3
+        conn.reset_mock()
+        conn.deleteFiles.side_effect = None
+
+        # target appeared - deleted and renamed again
+        conn.rename.side_effect = [OperationFailure("msg", "sub-msg"), None]
+        assert smb_api.atomic_write("share", "dir", "file", b"data", exists=False) == 4
+        conn.deleteFiles.assert_called_once_with("share", "dir/file")
+        assert conn.rename.call_count == 2
+        conn.reset_mock()
+
+
+def test_smb_api_atomic_write_fails(smb_api):
+    with smb_api:
+        conn = smb_api.connection
+
+        # rename fails - temp file cleaned up
+        conn.rename.side_effect = OperationFailure("msg", "sub-msg")
+        with pytest.raises(OperationFailure):
+            smb_api.atomic_write("share", "dir", "file", b"data")
+        temp_path = conn.storeFile.mock_calls[0][1][1]
+        assert conn.deleteFiles.mock_calls[-1][1] == ("share", temp_path)
+        conn.reset_mock()
+
+        # write fails - cleanup errors don't hide the original error
+        conn.storeFile.side_effect = RuntimeError("can't store")
+        conn.deleteFiles.side_effect = ConnectionError
+        with pytest.raises(RuntimeError):
+            smb_api.atomic_write("share", "dir", "file", b"data", exists=False)
+
+
 def test_smb_api_cannot_connect(smb_api_connect_fails):
     # not connected yet
     assert smb_api_connect_fails._conn is None
@@ -93,23 +138,40 @@ def test_smb_api_file_ops(smb_api):
         smb_api.connection.storeFile.assert_called_once()
         assert smb_api.connection.storeFile.mock_calls[0][1][0] == "share"
         assert smb_api.connection.storeFile.mock_calls[0][1][1] == "/path/to/file"
+        assert isinstance(smb_api.connection.storeFile.mock_calls[0][1][2], io.BytesIO)
         smb_api.connection.reset_mock()
 
+        # large payloads spill to disk
+        uploaded = []
+        smb_api.connection.storeFile.side_effect = lambda _s, _p, f: uploaded.append((f.name, f.read()))
+        with patch.object(Smb, "spill_threshold", 4):
+            smb_api.write_file("share", "/path/to/file", b"bytes")
+        assert uploaded[0][1] == b"bytes"
+        assert os.path.basename(uploaded[0][0])
+        smb_api.connection.reset_mock()
+        smb_api.connection.storeFile.side_effect = None
+
         smb_api.delete_file("share", "/path/to/file")
         smb_api.connection.deleteFiles.assert_called_once_with("share", "/path/to/file")
         smb_api.connection.reset_mock()
 
+        smb_api.connection.retrieveFile.side_effect = lambda _share, _path, f: f.write(b"data")
+        assert smb_api.read_file("share", "/path/to/file") == b"data"
+        smb_api.connection.retrieveFile.side_effect = OperationFailure("msg", "sub-msg")
+        assert smb_api.read_file("share", "/path/to/file") is None
+        smb_api.connection.reset_mock()
+
         smb_api.rename("share", "/path/to/file", "/new/path/to/file")
         smb_api.connection.rename.assert_called_once_with("share", "/path/to/file", "/new/path/to/file")
         smb_api.connection.reset_mock()
 
-        smb_api.atomic_write("share", "/path/to", "file", b"data")
+        assert smb_api.atomic_write("share", "/path/to", "file", b"data") == 3
         smb_api.connection.storeFile.assert_called_once()
         assert smb_api.connection.storeFile.mock_calls[0][1][0] == "share"
-        assert len(smb_api.connection.deleteFiles.mock_calls) == 2
+        # target deleted, temp file not cleaned up after success
+        assert len(smb_api.connection.deleteFiles.mock_calls) == 1
         assert smb_api.connection.deleteFiles.mock_calls[0][1][0] == "share"
         assert smb_api.connection.deleteFiles.mock_calls[0][1][1] == "/path/to/file"
-        assert smb_api.connection.deleteFiles.mock_calls[1][1][0] == "share"
         smb_api.connection.rename.assert_called_once()
         assert smb_api.connection.rename.mock_calls[0][1][0] == "share"
         assert smb_api.connection.rename.mock_calls[0][1][2] == "/path/to/file"
@@ -123,3 +185,152 @@ def test_smb_api_file_ops(smb_api):
 
     # disconnected on exit
     assert smb_api._conn is None
+
+
+@pytest.fixture(name="smb_pool")
+def fixture_smb_pool():
+    with patch("protect_with_atakama.smb_api.SMBConnection") as mock_conn_cls:
+        mock_conn_cls.side_effect = lambda *_args, **_kwargs: MagicMock()
+        pool = SmbPool()
+        pool.acquire_timeout = 0.01
+        yield pool
+        pool.clear()
+
+
+def test_smb_pool_reuse(smb_pool):
+    smb = Smb("user", "password", "1.2.3.4", pool=smb_pool)
+    with smb:
+        conn = smb.connection
+        conn.connect.assert_called_once_with("1.2.3.4", port=445)
+
+    # returned to the pool, not closed
+    conn.close.assert_not_called()
+    assert smb._conn is None
+
+    # same server and creds - reused
+    with Smb("user", "password", "1.2.3.4", pool=smb_pool) as smb2:
+        assert smb2.connection is conn
+
+    # different creds - new connection
+    with Smb("user", "password2", "1.2.3.4", pool=smb_pool) as smb3:
+        assert smb3.connection is not conn
+
+    # protocol errors keep the connection
+    with pytest.raises(OperationFailure):
+        with smb:
+            raise OperationFailure("msg", "sub-msg")
+    with smb:
+        assert smb.connection is conn
+
+    # other errors discard it
+    with pytest.raises(RuntimeError):
+        with smb:
+            raise RuntimeError("broken")
+    conn.close.assert_called_once()
+    with smb:
+        assert smb.connection is not conn
+
+
+def test_smb_pool_health_check(smb_pool):
+    smb = Smb("user", "password", "1.2.3.4", pool=smb_pool)
+    with smb:
+        conn = smb.connection
+
+    # idle long enough to be checked - healthy
+    smb_pool.check_after = 0
+    with smb:
+        assert smb.connection is conn
+    conn.echo.assert_called_once()
+
+    # unhealthy - replaced
+    conn.echo.side_effect = ConnectionError
+    conn.close.side_effect = ConnectionError
+    with smb:
+        assert smb.connection is not conn
+    conn.close.assert_called_once()
+
+
+def test_smb_pool_idle_ttl(smb_pool):
+    smb = Smb("user", "password", "1.2.3.4", pool=smb_pool)
+    with smb:
+        conn = smb.connection
+
+    smb_pool.idle_ttl = 0
+    with smb:
+        assert smb.connection is not conn
+    conn.close.assert_called_once()
+
+
+def test_smb_pool_server_limit(smb_pool):
+    smb_pool.max_per_server = 1
+    smb = Smb("user", "password", "1.2.3.4", pool=smb_pool)
+    other_user = Smb("user2", "password", "1.2.3.4", pool=smb_pool)
+    other_server = Smb("user", "password", "5.6.7.8", pool=smb_pool)
+
+    with smb:
+        # limit reached for this server
+        with pytest.raises(RuntimeError):
+            with other_user:
+                pass
+
+        # other servers are not affected
+        with other_server:
+            pass
+
+        conn = smb.connection
+
+    # idle connection held by other creds is closed to make room
+    with other_user:
+        assert other_user.connection is not conn
+    conn.close.assert_called_once()
+
+
+def test_smb_pool_connect_fails(smb_pool):
+    smb_pool.max_per_server = 1
+    with patch("protect_with_atakama.smb_api.SMBConnection") as mock_conn_cls:
+        mock_conn_cls.return_value.connect.return_value = False
+        with pytest.raises(RuntimeError):
+            with Smb("user", "password", "1.2.3.4", pool=smb_pool):
+                pass
+
+    # failed connection does not count against the limit
+    with Smb("user", "password", "1.2.3.4", pool=smb_pool) as smb:
+        assert smb.connection
+
+
+def test_smb_dir_cache():
+    entries = {
+        "/": ["a", "b"],
+        "a": ["x", "y", "z"],
+        "b": ["only"],
+    }
+    listings = []
+
+    def list_path(_share, path, pattern="*"):
+        listings.append((path, pattern))
+        if path not in entries:
+            raise OperationFailure("msg", "sub-msg")
+        names = [n for n in [".", ".."] + entries[path] if pattern in ("*", n)]
+        return [MagicMock(filename=n, isDirectory=True) for n in names] + [
+            MagicMock(filename="file.txt", isDirectory=False)
+        ]
+
+    smb = MagicMock()
+    smb.list_dirs = lambda share, path, pattern: Smb.list_dirs(smb, share, path, pattern)
+    smb.connection.listPath = list_path
+    smb.is_dir.return_value = True
+
+    dirs = [("s", "a/x"), ("s", "a/y"), ("s", "A/Z"), ("s", "a/w"), ("s", "b/only"), ("s", "c/d"), ("s", ".")]
+    cache = DirCache(dirs)
+    assert cache.is_dir(smb, "s", "a/x")
+    assert cache.is_dir(smb, "s", "a/y")
+    assert cache.is_dir(smb, "s", "A/Z")
+    assert not cache.is_dir(smb, "s", "a/w")
+    assert cache.is_dir(smb, "s", "b/only")
+    assert not cache.is_dir(smb, "s", "c/d")
+    assert not cache.is_dir(smb, "s", "a/file.txt")
+    assert cache.is_dir(smb, "s", ".")
+    smb.is_dir.assert_called_once_with("s", ".")
+
+    # one listing per parent, by name for single children
+    assert listings == [("a", "*"), ("b", "only"), ("c", "d")]
@@ -0,0 +1,157 @@
+import os
+import sqlite3
+import threading
+import time
+from tempfile import TemporaryDirectory
+
+import pytest
+
+from protect_with_atakama.state import LabelStore
+
+
+@pytest.fixture(name="store")
+def fixture_store():
+    with TemporaryDirectory() as state_dir:
+        store = LabelStore(os.path.join(state_dir, "sub", "state.sqlite"))
+        yield store
+        store.close()
+
+
+def test_state_verified(store):
+    store.record("ds", "run-1", [("share", "a", "hash-a", 1)])
+    assert store.hashes("ds", max_age=60) == {("share", "a"): "hash-a"}
+    time.sleep(0.01)
+    assert store.hashes("ds", max_age=0) == {}
+    assert store.hashes("ds") == {("share", "a"): "hash-a"}
+
+    # seen, not verified
+    store.mark_seen("ds", "run-2", [("share", "a")])
+    assert store.hashes("ds", max_age=0) == {}
+
+
+def test_state_migrate():
+    with TemporaryDirectory() as state_dir:
+        path = os.path.join(state_dir, "state.sqlite")
+        conn = sqlite3.connect(path)
+        conn.execute(
+            "CREATE TABLE labels (data_source TEXT NOT NULL, share TEXT NOT NULL, path TEXT NOT NULL, "
+            "hash TEXT NOT NULL, written_at REAL NOT NULL, row_count INTEGER NOT NULL, run_id TEXT NOT NULL, "
+            "PRIMARY KEY (data_source, share, path))"
+        )
+        conn.execute("INSERT INTO labels VALUES ('ds', 'share', 'a', 'hash-a', 0, 1, 'run-1')")
+        conn.execute(
+            "CREATE TABLE checkpoints (execution_id TEXT NOT NULL, data_source TEXT NOT NULL, "
+            "share TEXT NOT NULL, path TEXT NOT NULL, created_at REAL NOT NULL, "
+            "PRIMARY KEY (execution_id, data_source, share, path))"
+        )
+        conn.execute("INSERT INTO checkpoints VALUES ('exec-1', 'ds', 'share', 'a', 0)")
+        conn.commit()
+        conn.close()
+
+        store = LabelStore(path)
+        # never verified
+        assert store.hashes("ds", max_age=3600) == {}
+        store.record("ds", "run-2", [("share", "a", "hash-a", 1)])
+        assert store.hashes("ds", max_age=3600) == {("share", "a"): "hash-a"}
+        # checkpoints without a hash never match
+        assert store.checkpoints("exec-1", "ds") == {("share", "a"): ""}
+        store.checkpoint("exec-1", "ds", [("share", "a", "hash-a")])
+        assert store.checkpoints("exec-1", "ds") == {("share", "a"): "hash-a"}
+        store.close()
+
+
+def test_state_record(store):
+    assert store.hashes("ds") == {}
+
+    store.record("ds", "run-1", [("share", "a", "hash-a", 1), ("share", "b", "hash-b", 2)])
+    assert store.hashes("ds") == {("share", "a"): "hash-a", ("share", "b"): "hash-b"}
+    assert store.hashes("other-ds") == {}
+
+    # written_at only changes with the hash
+    before = time.time()
+    written = dict(((s, p), t) for s, p, t in store.changed_since("ds", 0))
+    time.sleep(0.01)
+    store.record("ds", "run-2", [("share", "a", "hash-a", 1), ("share", "b", "hash-b2", 3)])
+    assert store.hashes("ds") == {("share", "a"): "hash-a", ("share", "b"): "hash-b2"}
+    changed = store.changed_since("ds", before)
+    assert [(s, p) for s, p, _ in changed] == [("share", "b")]
+    assert store.changed_since("ds", 0)[0][2] == written[("share", "a")]
+
+
+def test_state_prune(store):
+    store.record("ds", "run-1", [("share", "a", "hash-a", 1), ("share", "b", "hash-b", 1)])
+    store.record("other-ds", "run-1", [("share", "a", "hash-a", 1)])
+
+    started = time.time()
+    store.mark_seen("ds", "run-2", [("share", "a"), ("share", "not-recorded")])
+    assert store.prune("ds", started) == 1
+    assert store.hashes("ds") == {("share", "a"): "hash-a"}
+    assert store.hashes("other-ds") == {("share", "a"): "hash-a"}
+
+
+def test_state_prune_overlapping(store):
+    store.record("ds", "run-0", [("share", "a", "hash-a", 1), ("share", "b", "hash-b", 1)])
+    time.sleep(0.01)
+
+    # runs 1 and 2 overlap - run 2 sees "b", then run 1 sees "a" and prunes
+    started_1 = time.time()
+    started_2 = time.time()
+    store.mark_seen("ds", "run-2", [("share", "b")])
+    store.record("ds", "run-1", [("share", "c", "hash-c", 1)])
+    store.mark_seen("ds", "run-1", [("share", "a")])
+    assert store.prune("ds", started_1) == 0
+    assert set(store.hashes("ds")) == {("share", "a"), ("share", "b"), ("share", "c")}
+
+    # run 2 didn't see "a", but run 1 did after run 2 started
+    store.mark_seen("ds", "run-2", [("share", "c")])
+    assert store.prune("ds", started_2) == 0
+    assert len(store.hashes("ds")) == 3
+
+    # a later run that only sees "a"
+    time.sleep(0.01)
+    started_3 = time.time()
+    store.mark_seen("ds", "run-3", [("share", "a")])
+    assert store.prune("ds", started_3) == 2
+    assert set(store.hashes("ds")) == {("share", "a")}
+
+
+def test_state_threads(store):
+    # connections are per thread, the database is shared
+    def record(i):
+        store.record("ds", "run", [("share", f"dir-{i}", "hash", 1)])
+        store.close()
+
+    threads = [threading.Thread(target=record, args=(i,)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(store.hashes("ds")) == 4
+
+
+def test_state_checkpoints(store):
+    assert store.checkpoints("exec-1", "ds") == {}
+    assert not store.is_data_source_complete("exec-1", "ds")
+
+    store.checkpoint("exec-1", "ds", [("share", "a", "hash-a"), ("share", "b", "hash-b")])
+    store.checkpoint("exec-1", "ds", [("share", "a", "hash-a2")])
+    store.checkpoint("exec-2", "ds", [("share", "c", "hash-c")])
+    store.complete_data_source("exec-1", "ds")
+    assert store.checkpoints("exec-1", "ds") == {("share", "a"): "hash-a2", ("share", "b"): "hash-b"}
+    assert store.checkpoints("exec-1", "other-ds") == {}
+    assert store.is_data_source_complete("exec-1", "ds")
+    assert not store.is_data_source_complete("exec-2", "ds")
+
+    store.clear_checkpoints("exec-1")
+    assert store.checkpoints("exec-1", "ds") == {}
+    assert not store.is_data_source_complete("exec-1", "ds")
+    assert store.checkpoints("exec-2", "ds") == {("share", "c"): "hash-c"}
+
+    # expired
+    store.complete_data_source("exec-2", "ds")
+    store.prune_checkpoints()
+    assert store.is_data_source_complete("exec-2", "ds")
+    store.checkpoint_ttl = -1
+    store.prune_checkpoints()
+    assert store.checkpoints("exec-2", "ds") == {}
+    assert not store.is_data_source_complete("exec-2", "ds")
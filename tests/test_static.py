@@ -0,0 +1,63 @@
+import gzip
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import falcon
+import pytest
+from falcon import testing
+
+from protect_with_atakama.static import StaticAsset
+
+MANIFEST = "protect_with_atakama/assets/manifest.json"
+
+
+@pytest.fixture(name="fake_brotli")
+def fixture_fake_brotli():
+    fake = SimpleNamespace(compress=lambda data: b"br:" + data[:10])
+    with patch("protect_with_atakama.static.brotli", fake):
+        yield fake
+
+
+def test_static_asset_encoding(fake_brotli):
+    asset = StaticAsset(MANIFEST, falcon.MEDIA_JSON)
+    assert asset.encoding(None) is None
+    assert asset.encoding("") is None
+    assert asset.encoding("identity") is None
+    assert asset.encoding("gzip") == "gzip"
+    assert asset.encoding("gzip, br") == "br"
+    assert asset.encoding("br;q=0.5, gzip") == "gzip"
+    assert asset.encoding("br;q=0, gzip;q=0") is None
+    assert asset.encoding("br;q=bad, gzip") == "gzip"
+    assert asset.encoding("*") == "br"
+    assert asset.encoding("*;q=0.1, gzip;q=0.5") == "gzip"
+
+
+def test_static_asset_no_larger_variants():
+    # compressing an empty file doesn't pay
+    with patch("protect_with_atakama.static.open", create=True) as mock_open:
+        mock_open.return_value.__enter__.return_value.read.return_value = b""
+        asset = StaticAsset("empty", "text/plain")
+    assert asset.encoding("gzip, br") is None
+
+
+def test_static_asset_serve(fake_brotli):
+    asset = StaticAsset(MANIFEST, falcon.MEDIA_JSON)
+    app = falcon.App()
+    app.add_route("/asset", SimpleNamespace(on_get=asset.serve))
+    client = testing.TestClient(app)
+
+    response = client.simulate_get("/asset", headers={"Accept-Encoding": "br"})
+    assert response.headers["content-encoding"] == "br"
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert response.content == fake_brotli.compress(asset.data)
+
+    response = client.simulate_get("/asset", headers={"Accept-Encoding": "gzip"})
+    assert gzip.decompress(response.content) == asset.data
+
+    response = client.simulate_get("/asset", headers={"If-None-Match": "*"})
+    assert response.status == falcon.HTTP_304
+    response = client.simulate_get("/asset", headers={"If-None-Match": f'W/"{asset.etag}"'})
+    assert response.status == falcon.HTTP_304
+    response = client.simulate_get("/asset", headers={"If-None-Match": '"other"'})
+    assert response.status == falcon.HTTP_200
+    assert response.content == asset.data
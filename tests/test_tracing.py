@@ -0,0 +1,126 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from protect_with_atakama.tracing import Trace, Tracer, activate, span, submit
+
+
+def test_span_outside_trace():
+    with span("nothing"):
+        pass
+
+
+def test_trace():
+    trace = Trace("execution-1", "Encrypt")
+    with activate(trace, "execute"):
+        with span("outer", data_source="ds"):
+            with span("inner"):
+                pass
+        with ThreadPoolExecutor(max_workers=2) as workers:
+            with span("pooled"):
+                submit(workers, _traced, "task").result()
+
+    chrome = trace.to_chrome()
+    other = chrome["otherData"]
+    assert {key: other[key] for key in ("executionId", "action", "droppedSpans")} == {
+        "executionId": "execution-1",
+        "action": "Encrypt",
+        "droppedSpans": 0,
+    }
+    assert other["spanStats"]["inner"]["count"] == 1
+    events = {e["name"]: e for e in chrome["traceEvents"] if e["ph"] == "X"}
+    assert set(events) == {"execute", "outer", "inner", "pooled", "task"}
+    assert events["execute"]["args"]["parent"] is None
+    assert events["outer"]["args"]["parent"] == events["execute"]["args"]["id"]
+    assert events["outer"]["args"]["data_source"] == "ds"
+    assert events["outer"]["cat"] == "outer"
+    assert events["inner"]["args"]["parent"] == events["outer"]["args"]["id"]
+    # spans of pool threads belong to the submitting span
+    assert events["task"]["args"]["parent"] == events["pooled"]["args"]["id"]
+    assert events["task"]["tid"] != events["pooled"]["tid"]
+    assert events["outer"]["ts"] <= events["inner"]["ts"]
+    assert events["inner"]["dur"] <= events["outer"]["dur"]
+
+    threads = [e for e in chrome["traceEvents"] if e["ph"] == "M"]
+    assert {e["tid"] for e in threads} == {e["tid"] for e in events.values()}
+
+
+def _traced(name):
+    with span(name):
+        pass
+
+
+def test_trace_sampled():
+    trace = Trace("execution-1", "Encrypt")
+    trace.sample_first = 2
+    trace.sample_every = 3
+    with activate(trace, "execute"):
+        for i in range(9):
+            with span("op", sampled=True, i=i):
+                pass
+        # an enclosing span shows as running until it ends
+        running = [e for e in trace.to_chrome()["traceEvents"] if e["ph"] == "X"]
+    assert running[0]["name"] == "execute"
+    assert running[0]["args"]["running"] and running[0]["dur"] >= 0
+
+    chrome = trace.to_chrome()
+    events = [e for e in chrome["traceEvents"] if e["ph"] == "X"]
+    assert [e["args"]["i"] for e in events if e["name"] == "op"] == [0, 1, 4, 7]
+    assert "running" not in events[0]["args"]
+    assert chrome["otherData"]["droppedSpans"] == 5
+    # all spans are counted
+    assert chrome["otherData"]["spanStats"]["op"]["count"] == 9
+    assert chrome["otherData"]["spanStats"]["execute"]["count"] == 1
+
+
+def test_tracer():
+    tracer = Tracer()
+    tracer.max_traces = 2
+    first = Trace("a", "Encrypt")
+    tracer.add(first)
+    tracer.add(Trace("b", "Encrypt"))
+    rerun = Trace("a", "Encrypt")
+    tracer.add(rerun)
+    assert tracer.get("a") is rerun
+    assert tracer.execution_ids() == ["b", "a"]
+
+    tracer.add(Trace("c", "Encrypt"))
+    assert tracer.execution_ids() == ["a", "c"]
+    assert tracer.get("b") is None
+
+    tracer.clear()
+    assert tracer.execution_ids() == []
+
+
+def test_tracer_max_spans():
+    tracer = Tracer()
+    tracer.max_spans = 4
+    old = Trace("old", "Encrypt")
+    tracer.add(old)
+    with activate(old, "execute"):
+        pass
+    new = Trace("new", "Encrypt")
+    tracer.add(new)
+    with activate(new, "execute"):
+        for _ in range(3):
+            with span("op", sampled=True):
+                pass
+        # the oldest trace is evicted to make room
+        assert tracer.execution_ids() == ["new"]
+        with span("op", sampled=True):
+            pass
+        # a trace over the budget on its own keeps its spans that aren't sampled
+        with span("outer"):
+            pass
+
+    names = [e["name"] for e in new.to_chrome()["traceEvents"] if e["ph"] == "X"]
+    assert names == ["execute", "op", "op", "op", "outer"]
+    assert new.to_chrome()["otherData"]["droppedSpans"] == 1
+
+    # spans of an evicted trace aren't counted
+    tracer.add(Trace("newer", "Encrypt"))
+    tracer.max_traces = 1
+    tracer.add(Trace("newest", "Encrypt"))
+    with activate(new, "evicted"):
+        with span("op", sampled=True):
+            pass
+    names = [e["name"] for e in new.to_chrome()["traceEvents"] if e["ph"] == "X"]
+    assert names[-2:] == ["outer", "evicted"]
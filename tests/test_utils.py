@@ -0,0 +1,158 @@
+import json
+import logging
+import os
+import sys
+import threading
+from logging.handlers import QueueHandler
+from tempfile import TemporaryDirectory
+from unittest.mock import patch
+
+import pytest
+
+from protect_with_atakama import utils
+from protect_with_atakama.tracing import Trace, activate, span
+from protect_with_atakama.utils import (
+    JsonFormatter,
+    LogSampler,
+    flush_logging,
+    init_logging,
+    log_index,
+    log_levels,
+    set_log_levels,
+    stop_logging,
+)
+
+
+def test_init_logging():
+    stop_logging()
+    try:
+        with TemporaryDirectory() as log_dir:
+            log_file = os.path.join(log_dir, "log.txt")
+            with patch.object(utils, "LOG_FILE", log_file):
+                init_logging()
+                init_logging()
+                handlers = [h for h in logging.root.handlers if isinstance(h, QueueHandler)]
+                assert len(handlers) == 1
+
+                caller = threading.get_ident()
+                logging.getLogger("test_utils").info("queued %s", "record")
+                stop_logging()
+                stop_logging()
+                assert not any(isinstance(h, QueueHandler) for h in logging.root.handlers)
+
+            with open(log_file, encoding="utf-8") as f:
+                line = f.read()
+            # formatted on the writer thread, with the thread and line of the caller
+            assert line.endswith(" queued record\n")
+            assert f":{caller} [test_utils.py:" in line
+    finally:
+        init_logging()
+
+
+def test_init_logging_json():
+    stop_logging()
+    try:
+        with TemporaryDirectory() as log_dir:
+            log_file = os.path.join(log_dir, "log.txt")
+            index_file = os.path.join(log_dir, "log-index.sqlite")
+            with patch.object(utils, "LOG_FILE", log_file), patch.object(
+                utils, "LOG_INDEX_FILE", index_file
+            ):
+                init_logging(json_lines=True)
+                logger = logging.getLogger("test_utils")
+                logger.info("outside")
+                with activate(Trace("execution-1", "Encrypt"), "execute"):
+                    with span("executor.data_source", data_source="ds", files=3):
+                        with span("smb.storeFile"):
+                            logger.warning("stored %s", "é", extra={"duration": 0.5})
+                        try:
+                            raise ValueError("bad")
+                        except ValueError:
+                            logger.exception("failed")
+                flush_logging()
+                assert log_index().get("execution-1") is not None
+                stop_logging()
+                assert log_index() is None
+
+            with open(log_file, encoding="utf-8") as f:
+                records = [json.loads(line) for line in f]
+    finally:
+        init_logging()
+
+    outside, stored, failed = records
+    assert "execution_id" not in outside
+    assert outside["message"] == "outside"
+    assert list(stored)[:2] == ["time", "level"]
+    assert stored["level"] == "WARNING"
+    assert stored["message"] == "stored é"
+    assert stored["file"] == "test_utils.py"
+    assert stored["execution_id"] == "execution-1"
+    assert stored["data_source"] == "ds"
+    assert stored["operation"] == "smb.storeFile"
+    assert stored["duration"] == 0.5
+    assert "files" not in stored
+    assert failed["operation"] == "executor.data_source"
+    assert failed["message"].startswith("failed\nTraceback")
+
+
+def test_json_formatter():
+    try:
+        raise ValueError("bad")
+    except ValueError:
+        record = logging.getLogger("test").makeRecord(
+            "test", logging.ERROR, "a.py", 1, "failed %s", ("x",), exc_info=sys.exc_info()
+        )
+    line = JsonFormatter().format(record)
+    assert "\n" not in line
+    data = json.loads(line)
+    assert data["message"].startswith("failed x\nTraceback")
+    assert data["message"].endswith("ValueError: bad")
+
+
+def test_log_levels():
+    logging.getLogger("test_utils.a")
+    logging.getLogger("test_utils.b")
+    try:
+        set_log_levels({"test_utils.a": "info", "test_utils.b": "WARNING"})
+        assert logging.getLogger("test_utils.a").level == logging.INFO
+        assert log_levels()["test_utils.b"] == "WARNING"
+        assert log_levels()["root"] == "DEBUG"
+
+        # nothing is set if any level is unknown
+        with pytest.raises(ValueError):
+            set_log_levels({"test_utils.a": "DEBUG", "test_utils.b": "loud"})
+        assert logging.getLogger("test_utils.a").level == logging.INFO
+
+        # or any logger doesn't exist - it isn't created
+        with pytest.raises(ValueError, match="unknown logger"):
+            set_log_levels({"test_utils.a": "DEBUG", "test_utils.c": "INFO"})
+        assert logging.getLogger("test_utils.a").level == logging.INFO
+        assert "test_utils.c" not in logging.root.manager.loggerDict
+
+        set_log_levels({"test_utils.a": None, "root": "ERROR"})
+        assert "test_utils.a" not in log_levels()
+        assert log_levels()["root"] == "ERROR"
+    finally:
+        set_log_levels({"test_utils.a": None, "test_utils.b": None, "root": "DEBUG"})
+
+
+def test_log_sampler(caplog):
+    logger = logging.getLogger("test_utils.sampler")
+    with caplog.at_level(logging.DEBUG, logger="test_utils.sampler"):
+        sampler = LogSampler(logger, logging.DEBUG, first=2, every=3)
+        for i in range(10):
+            sampler.log("row %s", i)
+    assert [r.getMessage() for r in caplog.records] == ["row 0", "row 1", "row 4", "row 7"]
+    assert all(r.filename == "test_utils.py" for r in caplog.records)
+    assert (sampler.calls, sampler.logged, sampler.skipped) == (10, 4, 6)
+
+    caplog.clear()
+    logger.setLevel(logging.INFO)
+    try:
+        sampler = LogSampler(logger, logging.DEBUG)
+        sampler.log("row %s", 0)
+        assert not sampler.enabled
+        assert sampler.calls == 0
+        assert not caplog.records
+    finally:
+        logger.setLevel(logging.NOTSET)